@@ -0,0 +1,364 @@
+import argparse
+import time
+from typing import Callable, Dict, List, Tuple
+
+import torch
+
+from mlora.model.args import ModelData, ModelDataConfig
+from mlora.model.modules import Linear, LinearGroup, LoRA, LoRAFunction, VeRA
+from mlora.model.modules.attention import repeat_kv
+from mlora.model.modules.attention_backend import (
+    ATTENTION_BACKEND,
+    select_attention_backend,
+)
+
+
+def synchronize(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize(device)
+
+
+def bench_time(func: Callable, args: argparse.Namespace) -> float:
+    # return the average time (ms) of forward and backward
+    for _ in range(args.warmup):
+        func()
+    synchronize(args.device)
+
+    start_time = time.perf_counter()
+    for _ in range(args.iters):
+        func()
+    synchronize(args.device)
+
+    return (time.perf_counter() - start_time) * 1000 / args.iters
+
+
+def bench_peak_memory(func: Callable, args: argparse.Namespace) -> float:
+    # return the peak memory (MB) of one forward and backward, only for cuda
+    if not args.device.startswith("cuda"):
+        return 0.0
+    synchronize(args.device)
+    torch.cuda.reset_peak_memory_stats(args.device)
+    func()
+    synchronize(args.device)
+    return torch.cuda.max_memory_allocated(args.device) / (1024 * 1024)
+
+
+def create_input_args(n_adapters: int, args: argparse.Namespace) -> ModelData:
+    data_config = [
+        ModelDataConfig(
+            f"adapter_{idx}",
+            "lora",
+            idx * args.batch_size,
+            (idx + 1) * args.batch_size,
+        )
+        for idx in range(n_adapters)
+    ]
+    return ModelData(
+        batch_tokens_=[],
+        batch_mask_=[],
+        data_config_=data_config,
+        enable_checkpoint_=False,
+        random_id_=n_adapters,
+        task_name_=[config.adapter_name_ for config in data_config],
+    )
+
+
+def create_lora_linear(
+    n_adapters: int, args: argparse.Namespace
+) -> Tuple[Linear, List[LoRA]]:
+    weight = torch.nn.Linear(
+        args.dim, args.dim, bias=False, device=args.device, dtype=args.dtype
+    )
+    linear = Linear(weight)
+
+    adapters: List[LoRA] = []
+    for idx in range(n_adapters):
+        # mixed ranks are put into the power of two rank buckets
+        rank = args.ranks[idx % len(args.ranks)]
+        adapter = LoRA(f"adapter_{idx}", args.dim, args.dim, rank, 16, 0.05)
+        adapter.init_weight()
+        with torch.no_grad():
+            torch.nn.init.normal_(adapter.lora_b_)
+        adapter.lora_a_.data = adapter.lora_a_.data.to(args.device)
+        adapter.lora_b_.data = adapter.lora_b_.data.to(args.device)
+        linear.load_adapter(adapter)
+        adapters.append(adapter)
+
+    return linear, adapters
+
+
+def create_data(n_adapters: int, args: argparse.Namespace) -> torch.Tensor:
+    return torch.randn(
+        n_adapters * args.batch_size,
+        args.seq_len,
+        args.dim,
+        device=args.device,
+        dtype=args.dtype,
+        requires_grad=True,
+    )
+
+
+def bench_lora(args: argparse.Namespace):
+    # per-adapter loop kernel vs the batched kernel selected by the Linear
+    print("adapters | loop (ms) | batch (ms) | speedup")
+    for n_adapters in args.adapters:
+        input_args = create_input_args(n_adapters, args)
+        linear, adapters = create_lora_linear(n_adapters, args)
+        data = create_data(n_adapters, args)
+
+        def loop_step():
+            loras: Tuple[torch.Tensor, ...] = ()
+            for adapter in adapters:
+                loras += (adapter.lora_a_, adapter.lora_b_)
+            result = linear.weight_.forward(data)
+            result = LoRAFunction.apply(
+                result,
+                data,
+                input_args,
+                [adapter.dropout_ for adapter in adapters],
+                [adapter.scaling_ for adapter in adapters],
+                [adapter.dropout_seed() for adapter in adapters],
+                *loras,
+            )
+            result.sum().backward()
+
+        def batch_step():
+            linear.forward(data, input_args).sum().backward()
+
+        loop_time = bench_time(loop_step, args)
+        batch_time = bench_time(batch_step, args)
+        print(
+            f"{n_adapters:8d} | {loop_time:9.3f} | {batch_time:10.3f} | "
+            f"{loop_time / batch_time:.2f}x"
+        )
+
+
+def create_linear_group(
+    n_adapters: int, args: argparse.Namespace, fuse: bool
+) -> LinearGroup:
+    # like the q/k/v linears, each one has all the adapters
+    group = LinearGroup([create_lora_linear(n_adapters, args)[0] for _ in range(3)])
+    if fuse:
+        assert group.fuse_weight()
+    return group
+
+
+def bench_fuse_linear(args: argparse.Namespace):
+    # separate linears vs the linear group (fused lora) vs the fused frozen weight
+    print("adapters | separate (ms) | group (ms) | fused weight (ms) | speedup")
+    for n_adapters in args.adapters:
+        input_args = create_input_args(n_adapters, args)
+        data = create_data(n_adapters, args)
+        group = create_linear_group(n_adapters, args, False)
+        fused_group = create_linear_group(n_adapters, args, True)
+
+        def separate_step():
+            outputs = [linear.forward(data, input_args) for linear in group.linears_]
+            sum(output.sum() for output in outputs).backward()
+
+        def group_step():
+            outputs = group.forward(data, input_args)
+            sum(output.sum() for output in outputs).backward()
+
+        def fused_step():
+            outputs = fused_group.forward(data, input_args)
+            sum(output.sum() for output in outputs).backward()
+
+        separate_time = bench_time(separate_step, args)
+        group_time = bench_time(group_step, args)
+        fused_time = bench_time(fused_step, args)
+        print(
+            f"{n_adapters:8d} | {separate_time:13.3f} | {group_time:10.3f} | "
+            f"{fused_time:17.3f} | {separate_time / fused_time:.2f}x"
+        )
+
+
+def create_vera_linear(
+    n_adapters: int, args: argparse.Namespace
+) -> Tuple[Linear, List[VeRA]]:
+    weight = torch.nn.Linear(
+        args.dim, args.dim, bias=False, device=args.device, dtype=args.dtype
+    )
+    linear = Linear(weight)
+
+    adapters: List[VeRA] = []
+    for idx in range(n_adapters):
+        rank = args.ranks[idx % len(args.ranks)]
+        name = f"adapter_{idx}"
+        adapter = VeRA(name, "q_proj", args.dim, args.dim, rank, 16, 0.05, 0.1)
+        VeRA.init_lora_weight(name, "q_proj")
+        adapter.init_vec_weight(torch.randn(1, args.dim))
+        for tensor in adapter.get_all_tensors():
+            tensor.data = tensor.data.to(args.device)
+        adapter.enable_grad()
+        linear.load_adapter(adapter)
+        adapters.append(adapter)
+
+    return linear, adapters
+
+
+def bench_vera(args: argparse.Namespace):
+    # the generic ops (out-of-place index_add per adapter) vs the VeRAFunction
+    print("adapters | ops (ms) | ops peak (MB) | kernel (ms) | kernel peak (MB)")
+    for n_adapters in args.adapters:
+        input_args = create_input_args(n_adapters, args)
+        linear, adapters = create_vera_linear(n_adapters, args)
+        data = create_data(n_adapters, args)
+
+        def ops_step():
+            result = linear.weight_.forward(data)
+            for adapter, config in zip(adapters, input_args.data_config_):
+                start_idx = config.batch_start_idx_
+                end_idx = config.batch_end_idx_
+                lora_data = torch.nn.functional.dropout(
+                    data[start_idx:end_idx].to(torch.float32), p=adapter.dropout_
+                )
+                lora_data = lora_data.mul(adapter.scaling_)
+                lora_data = lora_data @ adapter.lora_a_.transpose(0, 1)
+                lora_data = lora_data * adapter.d_vec_
+                lora_data = lora_data @ adapter.lora_b_.transpose(0, 1)
+                lora_data = (lora_data * adapter.b_vec_).to(result.dtype)
+                index = torch.arange(start_idx, end_idx, device=args.device)
+                result = result.index_add(dim=0, index=index, source=lora_data)
+            result.sum().backward()
+
+        def kernel_step():
+            linear.forward(data, input_args).sum().backward()
+
+        ops_time = bench_time(ops_step, args)
+        ops_memory = bench_peak_memory(ops_step, args)
+        kernel_time = bench_time(kernel_step, args)
+        kernel_memory = bench_peak_memory(kernel_step, args)
+        print(
+            f"{n_adapters:8d} | {ops_time:8.3f} | {ops_memory:13.1f} | "
+            f"{kernel_time:11.3f} | {kernel_memory:16.1f}"
+        )
+
+
+def bench_accumulate(args: argparse.Namespace):
+    # the adapter's rows are contiguous, scatter them by index_add with the
+    #   range index vs add to the slice view, and the same for the gradient
+    #   copy in backward
+    print("adapters | index (ms) | slice (ms) | speedup")
+    for n_adapters in args.adapters:
+        input_args = create_input_args(n_adapters, args)
+        result = create_data(n_adapters, args).detach()
+        grad_data = torch.empty_like(result)
+        lora_data = torch.randn_like(result[: args.batch_size])
+        rows = torch.arange(result.shape[0], device=args.device)
+
+        def index_step():
+            for config in input_args.data_config_:
+                index = rows[config.batch_start_idx_ : config.batch_end_idx_]
+                result.index_add_(0, index, lora_data)
+                grad_data.index_copy_(0, index, lora_data)
+
+        def slice_step():
+            for config in input_args.data_config_:
+                start_idx = config.batch_start_idx_
+                end_idx = config.batch_end_idx_
+                result[start_idx:end_idx].add_(lora_data)
+                grad_data[start_idx:end_idx].copy_(lora_data)
+
+        index_time = bench_time(index_step, args)
+        slice_time = bench_time(slice_step, args)
+        print(
+            f"{n_adapters:8d} | {index_time:10.3f} | {slice_time:10.3f} | "
+            f"{index_time / slice_time:.2f}x"
+        )
+
+
+def bench_attention(args: argparse.Namespace):
+    # repeat the kv heads to n_heads (repeat_kv) vs the grouped kv heads, the
+    #   output shows the time and the peak memory (only for cuda) of one
+    #   forward and backward
+    attention = ATTENTION_BACKEND[
+        select_attention_backend(args.attention_backend, args.device)
+    ]
+    head_dim = args.dim // args.n_heads
+    n_rep = args.n_heads // args.n_kv_heads
+
+    print(
+        "adapters | repeat (ms) | repeat peak (MB) | "
+        "grouped (ms) | grouped peak (MB)"
+    )
+    for n_adapters in args.adapters:
+
+        def create_heads(n_heads: int) -> torch.Tensor:
+            return torch.randn(
+                n_adapters * args.batch_size,
+                n_heads,
+                args.seq_len,
+                head_dim,
+                device=args.device,
+                dtype=args.dtype,
+                requires_grad=True,
+            )
+
+        query = create_heads(args.n_heads)
+        key = create_heads(args.n_kv_heads)
+        value = create_heads(args.n_kv_heads)
+
+        def repeat_step():
+            repeat_key = repeat_kv(key, n_rep)
+            repeat_value = repeat_kv(value, n_rep)
+            attention(query, repeat_key, repeat_value, None).sum().backward()
+
+        def grouped_step():
+            attention(query, key, value, None).sum().backward()
+
+        repeat_time = bench_time(repeat_step, args)
+        repeat_memory = bench_peak_memory(repeat_step, args)
+        grouped_time = bench_time(grouped_step, args)
+        grouped_memory = bench_peak_memory(grouped_step, args)
+        print(
+            f"{n_adapters:8d} | {repeat_time:11.3f} | {repeat_memory:16.1f} | "
+            f"{grouped_time:12.3f} | {grouped_memory:17.1f}"
+        )
+
+
+BENCH_CASE: Dict[str, Callable[[argparse.Namespace], None]] = {
+    "lora": bench_lora,
+    "fuse_linear": bench_fuse_linear,
+    "vera": bench_vera,
+    "accumulate": bench_accumulate,
+    "attention": bench_attention,
+}
+
+
+def get_bench_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="m-LoRA operator benchmark")
+    parser.add_argument("--case", type=str, default="lora", choices=BENCH_CASE)
+    parser.add_argument("--device", type=str, default="cuda:0")
+    parser.add_argument("--precision", type=str, default="fp32")
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument(
+        "--ranks", type=int, nargs="+", default=[16], help="The ranks of adapters"
+    )
+    parser.add_argument("--seq_len", type=int, default=512)
+    parser.add_argument(
+        "--batch_size", type=int, default=2, help="The batch size of each adapter"
+    )
+    parser.add_argument(
+        "--adapters", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64]
+    )
+    parser.add_argument("--n_heads", type=int, default=32)
+    parser.add_argument("--n_kv_heads", type=int, default=8)
+    parser.add_argument("--attention_backend", type=str, default="auto")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    args.dtype = {
+        "fp32": torch.float32,
+        "fp16": torch.float16,
+        "bf16": torch.bfloat16,
+    }[args.precision]
+
+    return args
+
+
+if __name__ == "__main__":
+    args = get_bench_args()
+    torch.manual_seed(42)
+    BENCH_CASE[args.case](args)
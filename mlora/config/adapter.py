@@ -59,6 +59,11 @@ class LoRAConfig(AdapterConfig):
     alpha_: int
     dropout_: float
     target_: Dict[str, bool]
+    # the dtype to compute the adapter: fp32, fp16 or bf16
+    #   the weights are always saved in fp32
+    compute_dtype_: str
+    # regenerate the dropout mask in backward from the rng seed
+    recompute_dropout_: bool
 
     __params_map: Dict[str, str] = {
         "r_": "r",
@@ -74,6 +79,14 @@ class LoRAConfig(AdapterConfig):
         self.r_ = int(self.r_)
         self.alpha_ = int(self.alpha_)
         self.dropout_ = float(self.dropout_)
+        # dropout: 0 disable the dropout, the adapter do not copy the input
+        assert 0.0 <= self.dropout_ < 1.0, f"error dropout - {self.dropout_}."
+
+        self.compute_dtype_ = str(config.get("compute_dtype", "fp32"))
+        if self.compute_dtype_ not in ["fp32", "fp16", "bf16"]:
+            raise NotImplementedError
+
+        self.recompute_dropout_ = bool(config.get("recompute_dropout", False))
 
         for key, value in self.target_.items():
             self.target_[key] = bool(value)
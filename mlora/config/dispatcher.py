@@ -6,6 +6,7 @@ from .config import DictConfig
 class DispatcherConfig(DictConfig):
     name_: str
     concurrency_num_: int
+    micro_batch_num_: int
 
     __params_map: Dict[str, str] = {
         "name_": "name",
@@ -17,3 +18,6 @@ class DispatcherConfig(DictConfig):
         self.init(self.__params_map, config)
 
         self.concurrency_num_ = int(self.concurrency_num_)
+        # split one step into at most micro_batch_num forward by the length
+        self.micro_batch_num_ = int(config.get("micro_batch_num", 1))
+        assert self.micro_batch_num_ >= 1
@@ -43,6 +43,7 @@ class TrainTaskConfig(TaskConfig):
     num_epochs_: int
     cutoff_len_: int
     save_step_: int
+    packing_: bool
 
     __params_map: Dict[str, str] = {
         "batch_size_": "batch_size",
@@ -70,6 +71,10 @@ class TrainTaskConfig(TaskConfig):
         assert self.mini_batch_size_ <= self.batch_size_
         assert self.batch_size_ % self.mini_batch_size_ == 0
 
+        # packing: pack several samples into one row of cutoff_len tokens, the
+        #   mini_batch_size is the number of the rows (not the samples)
+        self.packing_ = bool(config.get("packing", False))
+
     @property
     def accumulate_step_(self) -> int:
         return self.batch_size_ // self.mini_batch_size_
@@ -169,6 +174,9 @@ class PPOTaskConfig(TrainTaskConfig):
     actor_adapter_: AdapterConfig
     kl_coefficient_: float
     optim_num_: int
+    temperature_: float
+    top_k_: int
+    top_p_: float
 
     __params_map: Dict[str, str] = {
         "gamma_": "gamma",
@@ -198,6 +206,12 @@ class PPOTaskConfig(TrainTaskConfig):
         self.generate_num_ = int(self.generate_num_)
         self.kl_coefficient_ = float(self.kl_coefficient_)
 
+        # the sampling of the rollout, temperature 0 is greedy, the top_k 0 and
+        #   the top_p 1.0 keep all the tokens
+        self.temperature_ = float(config.get("temperature", 1.0))
+        self.top_k_ = int(config.get("top_k", 0))
+        self.top_p_ = float(config.get("top_p", 1.0))
+
         if config["reference"] not in adapters:
             self.reference_ = None
             logging.info("PPOTask - use the base model as reference model.")
@@ -6,7 +6,7 @@ from mlora.model.args import LinearInfo
 from mlora.model.modules import DoRA
 
 from .context import TaskContext
-from .lora import InferenceLoRAContext, TrainLoRAContext
+from .lora import LORA_COMPUTE_DTYPE, InferenceLoRAContext, TrainLoRAContext
 
 
 def _init_dora_weight(
@@ -30,6 +30,8 @@ def _init_dora_weight(
             config.alpha_,
             config.dropout_,
             linear_info.base_weight_,
+            LORA_COMPUTE_DTYPE[config.compute_dtype_],
+            config.recompute_dropout_,
         )
     for _, module in context.adapter_model_.items():
         module.init_weight(None, None)
@@ -61,3 +63,11 @@ class TrainDoRAContext(TrainLoRAContext):
     @override
     def load_weight(self, linears_info: OrderedDict[str, LinearInfo]):
         _init_dora_weight(self, self.config_, linears_info)
+
+    @override
+    def step(self) -> None:
+        super().step()
+        # the lora weight is changed, so the cached weight norm is stale
+        for module in self.adapter_model_.values():
+            assert isinstance(module, DoRA)
+            module.invalidate_weight_norm()
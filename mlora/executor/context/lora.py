@@ -11,6 +11,12 @@ from .context import TaskContext
 from .inference import InferenceTaskContext
 from .train import TrainTaskContext
 
+LORA_COMPUTE_DTYPE = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
 
 def _init_lora_weight(
     context: TaskContext,
@@ -32,6 +38,8 @@ def _init_lora_weight(
             config.r_,
             config.alpha_,
             config.dropout_,
+            LORA_COMPUTE_DTYPE[config.compute_dtype_],
+            config.recompute_dropout_,
         )
     for _, module in context.adapter_model_.items():
         module.init_weight(None, None)
@@ -1,6 +1,8 @@
+import logging
 import math
 from typing import Any, Callable, Dict, List, Tuple
 
+import mlora.profiler
 from mlora.config.dispatcher import DispatcherConfig
 from mlora.config.task import TaskConfig
 from mlora.executor.task import TASK_CLASS, Task
@@ -21,6 +23,47 @@ class DispatcherEvent:
             func(task)
 
 
+def align_len(seq_len: int) -> int:
+    return math.ceil(seq_len / 8) * 8
+
+
+def length_groups(rows: List[int], lengths: List[int], max_groups: int) -> List[int]:
+    # partition the items (rows * length) into at most max_groups groups, each
+    #   group is padded to its max length, minimize the total padded tokens,
+    #   the items sorted by the length make the optimal groups contiguous
+    #   return the group id of each item
+    order = sorted(range(len(rows)), key=lambda idx: lengths[idx])
+    n_items = len(order)
+    prefix_rows = [0]
+    for idx in order:
+        prefix_rows.append(prefix_rows[-1] + rows[idx])
+
+    # cost[k][i] - the min padded tokens of the first i items in k groups
+    inf = float("inf")
+    cost = [[inf] * (n_items + 1) for _ in range(max_groups + 1)]
+    split = [[0] * (n_items + 1) for _ in range(max_groups + 1)]
+    cost[0][0] = 0
+    for k in range(1, max_groups + 1):
+        for i in range(1, n_items + 1):
+            for j in range(k - 1, i):
+                # the group is the items j...i-1, the item i-1 is the longest
+                group_cost = (prefix_rows[i] - prefix_rows[j]) * lengths[order[i - 1]]
+                if cost[k - 1][j] + group_cost < cost[k][i]:
+                    cost[k][i] = cost[k - 1][j] + group_cost
+                    split[k][i] = j
+
+    n_groups = min(range(1, max_groups + 1), key=lambda k: cost[k][n_items])
+    group_id = [0] * n_items
+    end_idx = n_items
+    for k in range(n_groups, 0, -1):
+        start_idx = split[k][end_idx]
+        for i in range(start_idx, end_idx):
+            group_id[order[i]] = k - 1
+        end_idx = start_idx
+
+    return group_id
+
+
 class Dispatcher:
     name_: str
 
@@ -33,12 +76,22 @@ class Dispatcher:
     done_event_: DispatcherEvent
     step_event_: DispatcherEvent
     terminate_event_: DispatcherEvent
+    rollout_event_: DispatcherEvent
 
     concurrency_num_: int = 2
 
+    # one step is split into micro batches grouped by the length, the tasks
+    #   step after all the micro batches are executed
+    micro_batch_num_: int = 1
+    micro_batches_: List[MLoRAData]
+    step_cnt_: int
+
     def __init__(self, config: DispatcherConfig) -> None:
         self.name_ = config.name_
         self.concurrency_num_ = config.concurrency_num_
+        self.micro_batch_num_ = config.micro_batch_num_
+        self.micro_batches_ = []
+        self.step_cnt_ = 0
 
         self.ready_ = []
         self.running_ = []
@@ -49,9 +102,14 @@ class Dispatcher:
         self.done_event_ = DispatcherEvent()
         self.step_event_ = DispatcherEvent()
         self.terminate_event_ = DispatcherEvent()
+        self.rollout_event_ = DispatcherEvent()
 
     def info(self) -> Dict[str, Any]:
-        return {"name": self.name_, "concurrency_num": self.concurrency_num_}
+        return {
+            "name": self.name_,
+            "concurrency_num": self.concurrency_num_,
+            "micro_batch_num": self.micro_batch_num_,
+        }
 
     def register_hook(self, name: str, cb: Callable) -> None:
         event_map = {
@@ -61,6 +119,7 @@ class Dispatcher:
             "done": self.done_event_,
             "step": self.step_event_,
             "terminate": self.terminate_event_,
+            "rollout": self.rollout_event_,
         }
 
         assert name in event_map
@@ -113,11 +172,16 @@ class Dispatcher:
         for task in done_task:
             self.done_event_.notify(task)
 
+    def _rollout(self):
+        # the task's generation runs before its data, not as training steps
+        for task in self.running_:
+            if task.need_rollout():
+                self.rollout_event_.notify(task)
+
     def _align_batch_tokens(
         self, batch_tokens: List[Tokens], configs: List[MLoRADataConfig]
     ) -> Tuple[List[Tokens], List[Masks]]:
-        max_seq_len = max(map(lambda x: len(x), batch_tokens))
-        max_seq_len = math.ceil(max_seq_len / 8) * 8
+        max_seq_len = align_len(max(map(lambda x: len(x), batch_tokens)))
 
         batch_masks: List[Masks] = []
 
@@ -131,8 +195,70 @@ class Dispatcher:
 
         return batch_tokens, batch_masks
 
+    def _micro_batches(self) -> List[MLoRAData]:
+        # build each task's data from row 0, then group the tasks by the length
+        task_datas = [task.data(0) for task in self.running_]
+        rows = [len(data) for data, _ in task_datas]
+        lengths = [align_len(max(map(len, data))) for data, _ in task_datas]
+        group_id = length_groups(rows, lengths, self.micro_batch_num_)
+
+        micro_batches: List[MLoRAData] = []
+        for group in sorted(set(group_id)):
+            batch_tokens: List[Tokens] = []
+            data_configs: List[MLoRADataConfig] = []
+            for idx, (data, data_config) in enumerate(task_datas):
+                if group_id[idx] != group:
+                    continue
+                for config in data_config:
+                    config.shift(len(batch_tokens))
+                data_configs.extend(data_config)
+                batch_tokens.extend(data)
+
+            batch_tokens, batch_masks = self._align_batch_tokens(
+                batch_tokens, data_configs
+            )
+            micro_batches.append(
+                MLoRAData(
+                    batch_tokens=batch_tokens,
+                    batch_mask=batch_masks,
+                    data_config=data_configs,
+                )
+            )
+
+        real_tokens = sum(len(tokens) for data, _ in task_datas for tokens in data)
+        self._log_padding(real_tokens, micro_batches)
+
+        return micro_batches
+
+    def _log_padding(self, real_tokens: int, micro_batches: List[MLoRAData]):
+        # the ratio of the real tokens in the padded batches of this step
+        padded_tokens = sum(
+            batch.batch_size() * batch.token_len() for batch in micro_batches
+        )
+        # no task is running, no batch in this step
+        if padded_tokens == 0:
+            return
+        efficiency = real_tokens / padded_tokens
+
+        logging.info(
+            f"Dispatcher step {self.step_cnt_} micro batches: {len(micro_batches)} "
+            f"padding efficiency: {efficiency:.4f}"
+        )
+        mlora.profiler.metric_log("padding_efficiency", efficiency, self.step_cnt_)
+
     def data(self) -> MLoRAData | None:
+        # the step is not done, execute its next micro batch
+        if len(self.micro_batches_) > 0:
+            return self.micro_batches_.pop(0)
+
         self._dispatch_task_in()
+        self._rollout()
+
+        if self.micro_batch_num_ > 1:
+            self.micro_batches_ = self._micro_batches()
+            if len(self.micro_batches_) == 0:
+                return None
+            return self.micro_batches_.pop(0)
 
         batch_tokens: List[Tokens] = []
         batch_masks: List[Masks] = []
@@ -146,14 +272,27 @@ class Dispatcher:
             batch_tokens.extend(data)
             start_idx = start_idx + len(data)
 
+        # all the tasks are terminated or done before this step
+        if len(batch_tokens) == 0:
+            return None
+
         # post process this batch data
+        real_tokens = sum(len(tokens) for tokens in batch_tokens)
         batch_tokens, batch_masks = self._align_batch_tokens(batch_tokens, data_configs)
 
-        return MLoRAData(
+        batch = MLoRAData(
             batch_tokens=batch_tokens, batch_mask=batch_masks, data_config=data_configs
         )
+        self._log_padding(real_tokens, [batch])
+
+        return batch
 
     def step(self):
+        # the loss of the micro batch is accumulated, step after the last one
+        if len(self.micro_batches_) > 0:
+            return
+
+        self.step_cnt_ += 1
         for _, task in enumerate(self.running_):
             task.step()
             self.step_event_.notify(task)
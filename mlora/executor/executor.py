@@ -35,6 +35,7 @@ class Executor:
             "ready": self.__task_to_ready_hook,
             "done": self.__task_to_done_hook,
             "terminate": self.__task_to_terminate_hook,
+            "rollout": self.__task_rollout_hook,
         }
 
         for hook, cb in hook_func.items():
@@ -86,6 +87,10 @@ class Executor:
         task.switch_device("cpu")
         task.terminate()
 
+    def __task_rollout_hook(self, task: Task):
+        logging.info(f"Task - {task.task_name()} rollout.")
+        task.rollout(self.model_)
+
     def dispatcher_info(self) -> Dict[str, str]:
         return self.dispatcher_.info()
 
@@ -95,6 +100,42 @@ class Executor:
     def notify_terminate_task(self, task_name: str):
         self.dispatcher_.notify_terminate_task(task_name)
 
+    def __forward(self, data: MLoRAData, output_hidden: bool) -> torch.Tensor:
+        if all(config.requires_grad_ for config in data.data_config_):
+            return self.model_.forward(data.model_data(output_hidden))
+
+        # the rows without grad (the reference model) are forwarded without
+        #   the autograd graph and the checkpoint, then merged to one output
+        with torch.no_grad():
+            no_grad_output = self.model_.forward(
+                data.split_grad(False, output_hidden).model_data(output_hidden)
+            )
+        grad_output = self.model_.forward(
+            data.split_grad(True, output_hidden).model_data(output_hidden)
+        )
+        return data.merge_output(grad_output, no_grad_output, output_hidden)
+
+    def __total_loss(
+        self, data: MLoRAData, output: torch.Tensor, output_hidden: bool
+    ) -> Optional[torch.Tensor]:
+        total_loss: Optional[torch.Tensor] = None
+
+        loss_inputs = data.loss_inputs(output, output_hidden)
+
+        for config, (loss_input, labels, masks) in zip(data.data_config_, loss_inputs):
+            if output_hidden:
+                assert config.fused_loss_fn_ is not None
+                loss = config.fused_loss_fn_(
+                    loss_input, self.model_.output_weight(), labels, masks
+                )
+            else:
+                loss = config.loss_fn_(loss_input, labels, masks)
+            if loss is None:
+                continue
+            total_loss = loss if total_loss is None else total_loss + loss
+
+        return total_loss
+
     def execute(self) -> None:
         mm_collect_step = 0
 
@@ -107,19 +148,21 @@ class Executor:
             batch_size = data.batch_size()
             token_len = data.token_len()
 
-            output = self.model_.forward(data.model_data())
-            labels = torch.tensor(data.batch_tokens_, dtype=torch.long)
-
-            total_loss: Optional[torch.Tensor] = None
-
-            for config in data.data_config_:
-                loss = config.loss_fn_(output, labels, torch.tensor(data.batch_mask_))
-                if loss is None:
-                    continue
-                total_loss = loss if total_loss is None else total_loss + loss
-
-            if total_loss is not None:
-                total_loss.backward()
+            # all the tasks in the batch can compute the loss from the hidden
+            #   states, so the full logits are never materialized
+            output_hidden = data.fused_loss()
+            if data.requires_grad():
+                output = self.__forward(data, output_hidden)
+                total_loss = self.__total_loss(data, output, output_hidden)
+                if total_loss is not None:
+                    total_loss.backward()
+            else:
+                # no loss needs the grad (the generation), so no graph is built,
+                #   not the inference_mode, the shared caches built by it (the
+                #   rope table, the lora layouts) can not be saved for backward
+                with torch.no_grad():
+                    output = self.model_.forward(data.model_data(output_hidden))
+                    self.__total_loss(data, output, output_hidden)
 
             self.dispatcher_.step()
             mm_collect_step += 1
@@ -266,13 +266,12 @@ class PipeExecutor(Executor):
 
         assert message.model_data_ is not None
         train_data: MLoRAData = self.input_cache_[message.model_data_.random_id_]
-        labels = torch.tensor(train_data.batch_tokens_, dtype=torch.long)
-        masks = torch.tensor(train_data.batch_mask_)
-
         total_loss: torch.Tensor | None = None
 
-        for config in train_data.data_config_:
-            loss = config.loss_fn_(output, labels, masks)
+        for config, loss_args in zip(
+            train_data.data_config_, train_data.loss_inputs(output)
+        ):
+            loss = config.loss_fn_(*loss_args)
             if loss is None:
                 continue
             total_loss = loss if total_loss is None else total_loss + loss
@@ -323,7 +322,10 @@ class PipeExecutor(Executor):
 
     def __forward(self, tensor_data: torch.Tensor, batch_data: ModelData):
         mask = precompute_mask(
-            tensor_data, self.heads_, self.device_, batch_data.batch_mask_
+            tensor_data,
+            self.device_,
+            batch_data.batch_mask_,
+            batch_positions=batch_data.batch_positions_,
         )
         data = (tensor_data, mask, batch_data, self.recompute_)
 
@@ -1,5 +1,5 @@
 import logging
-from typing import List, Tuple, override
+from typing import List, Optional, Tuple, override
 
 import torch
 import torch.nn.functional as F
@@ -9,7 +9,7 @@ from mlora.config import CITTaskConfig
 from mlora.executor.context import TrainLoRAContext
 from mlora.model.args import MLoRADataConfig, Tokens
 
-from .train_task import TrainTask
+from .train_task import TrainTask, packed_last_index, packed_target
 
 
 class CITTask(TrainTask):
@@ -24,40 +24,50 @@ class CITTask(TrainTask):
                 self.now_epoch_}/{self.config_.num_epochs_}"
             f" iteration: {self.now_data_idx_}/{len(self.data_)} step: {self.now_step_}"
         )
-        data_idx_s = self.now_data_idx_
-        data_idx_e = self.now_data_idx_ + self.config_.mini_batch_size_
-
-        # get the train raw string
-        batch_str = self.prompter_.generate_prompt(self.data_[data_idx_s:data_idx_e])
-
-        # convert the string to tokens
-        ret_tokens = list(
-            map(
-                lambda raw_str: self.tokenizer_.encode(
-                    raw_str, bos=True, eos=True, cutoff_len=self.config_.cutoff_len_
-                ),
-                batch_str,
+        # the original data rows then the paraphrased data rows
+        doc_lens: Optional[List[List[int]]] = None
+        if self.config_.packing_:
+            original_packer, paraphrased_packer = self._pack_data(2)
+            ret_tokens = original_packer.rows_ + paraphrased_packer.rows_
+            doc_lens = original_packer.doc_lens_ + paraphrased_packer.doc_lens_
+        else:
+            ret_tokens = self._encode_data(
+                self.now_data_idx_, self.now_data_idx_ + self.config_.mini_batch_size_
             )
-        )
         end_idx = start_idx + len(ret_tokens)
 
+        def packed_hidden_states(
+            input: torch.Tensor, mask: torch.Tensor
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
+            # each document is a sample, the last token of the document is pooled
+            assert doc_lens is not None
+            rows, positions = packed_last_index(mask[start_idx:end_idx], doc_lens)
+            hidden_states = input[start_idx:end_idx][rows, positions]
+            data_len = len(rows) // 2
+            return hidden_states[:data_len], hidden_states[data_len:]
+
         def loss_fn(
             input: torch.Tensor, target: torch.Tensor, mask: torch.Tensor
         ) -> torch.Tensor:
-            mask = ~mask[start_idx:end_idx:, 1:]
+            batch_label = target[start_idx:end_idx]
+            if doc_lens is not None:
+                batch_label = packed_target(
+                    batch_label, mask[start_idx:end_idx], doc_lens
+                )
+            batch_label = batch_label[:, 1:].contiguous().to(input.device)
 
-            data_len = end_idx - start_idx
-            assert data_len % 2 == 0
-            data_len = data_len // 2
             batch_input = input[start_idx:end_idx, :-1, :].contiguous()
-            batch_label = target[start_idx:end_idx, 1:].contiguous().to(input.device)
-            mask = mask.long().to(input.device)
             # step1. calc the contrastive loss
-            original_entire_hidden_states = batch_input[:data_len]
-            paraphrased_entire_hidden_states = batch_input[data_len:]
-            if self.config_.contrastive_pooling_method_ == "last":
-                original_hidden_states = original_entire_hidden_states[:, -1, :]
-                paraphrased_hidden_states = paraphrased_entire_hidden_states[:, -1, :]
+            if doc_lens is not None:
+                original_hidden_states, paraphrased_hidden_states = (
+                    packed_hidden_states(input, mask)
+                )
+            elif self.config_.contrastive_pooling_method_ == "last":
+                data_len = end_idx - start_idx
+                assert data_len % 2 == 0
+                data_len = data_len // 2
+                original_hidden_states = batch_input[:data_len, -1, :]
+                paraphrased_hidden_states = batch_input[data_len:, -1, :]
 
             batch_size = original_hidden_states.size(0)
             labels = torch.arange(batch_size).to(original_hidden_states.device)
@@ -109,6 +119,7 @@ class CITTask(TrainTask):
             self._expand_batch_tokens,
             loss_fn,
             self.task_name(),
+            doc_lens=doc_lens,
         )
 
         return ret_tokens, [data_config]
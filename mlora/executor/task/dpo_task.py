@@ -9,7 +9,7 @@ import mlora.profiler
 from mlora.config import DPOTaskConfig
 from mlora.executor.context import INFERENCECONTEXT_CLASS, TaskContext, TrainTaskContext
 from mlora.model.args import LinearInfo, MLoRADataConfig, Tokens
-from mlora.model.modules import AdapterModel
+from mlora.model.modules import AdapterModel, LMHeadLogProbFunction
 from mlora.model.tokenizer import Tokenizer
 
 from .train_task import TrainTask
@@ -118,16 +118,36 @@ class DPOTask(TrainTask):
         def loss_fn(
             input: torch.Tensor, target: torch.Tensor, mask: torch.Tensor
         ) -> torch.Tensor:
-            mask = ~mask[ref_start_idx:policy_end_idx, 1:]
-
             logits = input[ref_start_idx:policy_end_idx, :-1, :].log_softmax(-1)
             labels = target[ref_start_idx:policy_end_idx, 1:].to(input.device)
-            mask = mask.long().to(input.device)
 
             per_token_logps = torch.gather(
                 logits, dim=2, index=labels.unsqueeze(2)
             ).squeeze(2)
 
+            return dpo_loss(per_token_logps, mask)
+
+        def fused_loss_fn(
+            input: torch.Tensor,
+            weight: torch.Tensor,
+            target: torch.Tensor,
+            mask: torch.Tensor,
+        ) -> torch.Tensor:
+            # the input is the hidden states, only the log prob of the label is
+            #   computed from the lm_head chunk by chunk
+            hidden = input[ref_start_idx:policy_end_idx, :-1, :]
+            labels = target[ref_start_idx:policy_end_idx, 1:].to(input.device)
+
+            per_token_logps = LMHeadLogProbFunction.apply(
+                hidden.reshape(-1, hidden.shape[-1]), weight, labels.reshape(-1)
+            ).view(labels.shape)
+
+            return dpo_loss(per_token_logps, mask)
+
+        def dpo_loss(per_token_logps: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+            mask = ~mask[ref_start_idx:policy_end_idx, 1:]
+            mask = mask.long().to(per_token_logps.device)
+
             logps = (per_token_logps * mask).sum(-1)
 
             data_len = policy_end_idx - ref_start_idx
@@ -186,6 +206,8 @@ class DPOTask(TrainTask):
             self._expand_batch_tokens,
             lambda *_: None,
             self.task_name(),
+            lambda *_: None,
+            requires_grad=False,
         )
 
         policy_model_config = MLoRADataConfig(
@@ -196,6 +218,7 @@ class DPOTask(TrainTask):
             self._expand_batch_tokens,
             loss_fn,
             self.task_name(),
+            fused_loss_fn,
         )
 
         return ret_tokens, [ref_model_config, policy_model_config]
@@ -6,6 +6,7 @@ from enum import Enum
 from typing import Callable, Dict, List, Optional, OrderedDict, Tuple, override
 
 import torch
+import torch.nn.functional as F
 from datasets import load_dataset
 from torch.distributions import Categorical
 from tqdm import tqdm
@@ -17,7 +18,9 @@ from mlora.executor.context import (
     TaskContext,
     TrainTaskContext,
 )
-from mlora.model.args import LinearInfo, MLoRADataConfig, Tokens
+from mlora.model.args import LinearInfo, MLoRADataConfig, ModelDataConfig, Tokens
+from mlora.model.generator import generate
+from mlora.model.llm import LLMModel
 from mlora.model.modules import AdapterModel
 from mlora.model.tokenizer import Tokenizer
 from mlora.prompter import PrompterFactory
@@ -25,6 +28,91 @@ from mlora.prompter import PrompterFactory
 from .train_task import TrainTask
 
 
+def normalize(data: torch.Tensor, eps: float) -> torch.Tensor:
+    return (data - data.mean()) / (data.std() + eps)
+
+
+def discounted_cumsum(data: torch.Tensor, discount: float) -> torch.Tensor:
+    # the reverse scan of the last dim: out[j] = sum(discount^(k - j) * data[k]),
+    #   k >= j, one matmul with the triangular discount matrix for all the rows
+    idx = torch.arange(data.size(-1), device=data.device)
+    exponent = (idx.unsqueeze(0) - idx.unsqueeze(1)).to(data.dtype)
+    weight = torch.where(
+        exponent >= 0, discount ** exponent.clamp(min=0), exponent.new_zeros(())
+    )
+    return data @ weight.T
+
+
+def ppo_advantage(
+    rewards: torch.Tensor,
+    values: torch.Tensor,
+    gamma: float,
+    lamdb: float,
+    eps: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # rewards: batch_size * T, values: batch_size * (T + 1), the last value is
+    #   the terminal (0), return the advantage and the td target: batch_size * T
+    deltas = rewards + gamma * values[:, 1:] - values[:, :-1]
+    # the gae of the terminal position is 0, it is normalized with the others
+    advantage = F.pad(discounted_cumsum(deltas, gamma * lamdb), (0, 1))
+    advantage = normalize(advantage, eps)
+
+    advantage = torch.flip(advantage, [-1])[:, :-1]
+    td_target = advantage + values[:, :-1]
+    return advantage, td_target
+
+
+class RolloutBuffer:
+    # the rollout of one batch, the actions are the generated tokens, the old
+    #   policy's log probs, values, rewards and the advantages are recorded by
+    #   the first update iteration and reused by all the K epochs
+    actions_: torch.Tensor
+    log_probs_: torch.Tensor
+    values_: torch.Tensor
+    rewards_: torch.Tensor
+    advantages_: torch.Tensor
+    td_targets_: torch.Tensor
+
+    def __init__(self, actions: torch.Tensor):
+        # actions: batch_size * T
+        self.actions_ = actions
+        self.log_probs_ = torch.zeros(actions.shape, dtype=torch.float32)
+        self.values_ = torch.zeros(actions.shape[0], actions.shape[1] + 1)
+        self.rewards_ = torch.zeros(actions.shape)
+        self.advantages_ = torch.zeros(actions.shape)
+        self.td_targets_ = torch.zeros(actions.shape)
+
+    def to(self, device: str | torch.device):
+        for name in [
+            "actions_",
+            "log_probs_",
+            "values_",
+            "rewards_",
+            "advantages_",
+            "td_targets_",
+        ]:
+            setattr(self, name, getattr(self, name).to(device))
+
+    @torch.no_grad()
+    def record(
+        self,
+        log_probs: torch.Tensor,
+        values: torch.Tensor,
+        rewards: torch.Tensor,
+        config: PPOTaskConfig,
+        eps: float,
+    ):
+        self.log_probs_.copy_(log_probs)
+        self.values_.copy_(values)
+        self.rewards_.copy_(rewards)
+
+        advantage, td_target = ppo_advantage(
+            self.rewards_, self.values_, config.gamma_, config.lamdb_, eps
+        )
+        self.advantages_.copy_(advantage)
+        self.td_targets_.copy_(td_target)
+
+
 class PPOTrainStage(Enum):
     REWARD_MODEL_TRAINING = 0
     INIT = 1
@@ -46,8 +134,7 @@ class PPOTask(TrainTask):
     generate_index: int
     now_K_epochs: int
     now_optim_iter_num: int
-    advantage: torch.Tensor
-    td_target: torch.Tensor
+    rollout_buffer_: Optional[RolloutBuffer]
     policy_tokens: list[list[int]]
     stage: PPOTrainStage
 
@@ -60,19 +147,15 @@ class PPOTask(TrainTask):
         self.now_optim_iter_num = 0
         self.eps = 1e-6
         self.generate_index = 0
-        self.advantage = torch.zeros(1)
-        self.td_target = torch.zeros(1)
+        self.rollout_buffer_ = None
         self.perm = torch.zeros(1)
 
     def __normalize(self, loss: torch.Tensor) -> torch.Tensor:
-        loss_mean = loss.mean()
-        loss_std = loss.std()
-        normalized_loss = (loss - loss_mean) / (loss_std + self.eps)
-        return normalized_loss
+        return normalize(loss, self.eps)
 
     def reward_func(self, reward_t: torch.Tensor) -> torch.Tensor:
         dim = reward_t.shape[-1]
-        device = self.td_target.device
+        device = reward_t.device
         if PPOTask.reward_linear_tensor.shape[0] != dim:
             PPOTask.reward_linear_tensor = torch.randn(
                 (dim, 1), requires_grad=False, device=device
@@ -81,7 +164,7 @@ class PPOTask(TrainTask):
 
     def critic_func(self, critic_t: torch.Tensor) -> torch.Tensor:
         dim = critic_t.shape[-1]
-        device = self.td_target.device
+        device = critic_t.device
         if PPOTask.critic_linear_tensor.shape[0] != dim:
             PPOTask.critic_linear_tensor = torch.randn(
                 (dim, 1), requires_grad=False, device=device
@@ -181,16 +264,14 @@ class PPOTask(TrainTask):
 
     @staticmethod
     def ppo_adv_loss(
-        prob: torch.Tensor,
-        old_prob: torch.Tensor,
+        log_prob: torch.Tensor,
+        old_log_prob: torch.Tensor,
         advantage: torch.Tensor,
-        action: torch.Tensor,
     ) -> torch.Tensor:
+        # the log prob of the action under the policy and the old policy
 
         clip_rate_ = 0.2
-        prob_a = prob.gather(-1, action).squeeze(-1)
-        old_prob_a = old_prob.gather(-1, action).squeeze(-1)
-        ratio = torch.exp(torch.log(prob_a) - torch.log(old_prob_a))
+        ratio = torch.exp(log_prob - old_log_prob)
 
         surr1 = ratio * advantage
         surr2 = torch.clamp(ratio, 1 - clip_rate_, 1 + clip_rate_) * advantage
@@ -242,8 +323,8 @@ class PPOTask(TrainTask):
         self.critic_context_.switch_device(device)
         self.actor_context_.switch_device(device)
         self.reward_context_.switch_device(device)
-        self.advantage = self.advantage.to(device)
-        self.td_target = self.td_target.to(device)
+        if self.rollout_buffer_ is not None:
+            self.rollout_buffer_.to(device)
         self.perm = self.perm.to(device)
 
         PPOTask.reward_linear_tensor = PPOTask.reward_linear_tensor.to(device)
@@ -275,7 +356,7 @@ class PPOTask(TrainTask):
             reward = self.reward_func(input)
             reward = reward.squeeze(dim=-1)
             reward_batch = int(len(reward) / 2)
-            mask = mask.to(self.td_target.device)
+            mask = mask.to(reward.device)
             reward_chosen = reward[:reward_batch] * mask[:reward_batch]
             reward_reject = reward[reward_batch:] * mask[reward_batch:]
             loss = self.reward_context_.loss_fn_(reward_chosen, reward_reject)
@@ -296,7 +377,7 @@ class PPOTask(TrainTask):
 
         return reward_tokens, [reward_data_config]
 
-    def stage_init(self, start_idx: int):
+    def _init_policy_tokens(self):
         logging.info("reward_model's ready")
 
         data_idx_s = self.now_data_idx_
@@ -320,8 +401,44 @@ class PPOTask(TrainTask):
 
         self.stage = PPOTrainStage.DECISION
 
+    def stage_init(self, start_idx: int):
+        self._init_policy_tokens()
         return self.stage_decision(start_idx)
 
+    @override
+    def need_rollout(self) -> bool:
+        return self.stage in [PPOTrainStage.INIT, PPOTrainStage.DECISION]
+
+    @override
+    def rollout(self, model: LLMModel):
+        # generate all the response tokens of the batch with the actor by one
+        #   kv cached generation, the next data is the update stage, the
+        #   stage_decision (one token each step) is used when no rollout
+        if self.stage == PPOTrainStage.INIT:
+            self._init_policy_tokens()
+
+        actor_config = ModelDataConfig(
+            self.actor_context_.name_,
+            self.actor_context_.type_,
+            0,
+            len(self.policy_tokens),
+        )
+        responses = generate(
+            model,
+            self.policy_tokens,
+            [actor_config],
+            self.config_.generate_num_ - self.generate_index,
+            self.tokenizer_.pad_id_,
+            self.config_.temperature_,
+            self.config_.top_k_,
+            self.config_.top_p_,
+        )
+        for tokens, response in zip(self.policy_tokens, responses):
+            tokens.extend(response)
+
+        self.generate_index = self.config_.generate_num_
+        self.stage = PPOTrainStage.UPDATE
+
     def stage_decision(
         self,
         start_idx: int,
@@ -340,17 +457,12 @@ class PPOTask(TrainTask):
             deterministic: bool = False,
         ) -> Optional[torch.Tensor]:
 
+            # the input is the output of the actor_len - 1 position, in the
+            #   compact or the full output, rows * 1 * vocab_size
             if deterministic:
-                a = torch.argmax(
-                    input[actor_start_idx:actor_end_idx, actor_len - 1], dim=-1
-                )
+                a = torch.argmax(input[:, 0], dim=-1)
             else:
-                input_ = torch.softmax(
-                    input[actor_start_idx:actor_end_idx, actor_len - 1].view(
-                        -1, input[actor_start_idx:actor_end_idx].shape[-1]
-                    ),
-                    dim=-1,
-                )
+                input_ = torch.softmax(input[:, 0], dim=-1)
                 m = Categorical(input_)
                 a = m.sample()
                 a = a.view(batch_num, -1)
@@ -372,6 +484,8 @@ class PPOTask(TrainTask):
             self._expand_batch_tokens,
             loss_fn,
             self.task_name(),
+            output_positions=[actor_len - 1],
+            requires_grad=False,
         )
 
         return actor_tokens, [actor_data_config]
@@ -400,6 +514,14 @@ class PPOTask(TrainTask):
         critic_start_idx = actor_end_idx
         critic_end_idx = critic_start_idx + batch_num
 
+        # the generated tokens of the batch, one tensor for all the iterations
+        if self.now_K_epochs == 0 and self.now_optim_iter_num == 0:
+            self.rollout_buffer_ = RolloutBuffer(
+                torch.tensor(
+                    [tokens[actor_len - generate_text_len :] for tokens in actor_tokens]
+                )
+            )
+
         def loss_fn(
             input: torch.Tensor, _: torch.Tensor, __: torch.Tensor
         ) -> Optional[torch.Tensor]:
@@ -408,25 +530,16 @@ class PPOTask(TrainTask):
             assert generate_text_len % self.config_.optim_num_ == 0
             data_len = int(generate_text_len / self.config_.optim_num_)
 
+            buffer = self.rollout_buffer_
+            assert buffer is not None
+            buffer.to(input.device)
+            action = buffer.actions_.unsqueeze(dim=-1)
+
             actor_slice = input[
                 actor_start_idx:actor_end_idx,
                 actor_len - generate_text_len - 1 : actor_len - 1,
             ]
-            ref_slice = input[
-                ref_start_idx:ref_end_idx, ref_len - generate_text_len - 1 : ref_len - 1
-            ]
-            p = actor_slice.softmax(dim=-1)
-            log_p = actor_slice.log_softmax(dim=-1)
-            log_ref_p = ref_slice.log_softmax(dim=-1)
-            action = torch.tensor(self.policy_tokens, device=self.advantage.device)[
-                :, actor_len - generate_text_len :
-            ].unsqueeze(dim=-1)
-            log_prob = log_p.gather(-1, action).squeeze(-1)
-            ref_log_prob = log_ref_p.gather(-1, action).squeeze(-1)
-            r = -self.config_.kl_coefficient_ * (log_prob - ref_log_prob)
-            r[:, -1] += (
-                self.reward_func(input[reward_start_idx:reward_end_idx, actor_len - 1])
-            ).squeeze(dim=-1)
+            log_prob = actor_slice.log_softmax(dim=-1).gather(-1, action).squeeze(-1)
 
             v = (
                 self.critic_func(
@@ -442,56 +555,34 @@ class PPOTask(TrainTask):
 
             # For multiple updates,we need to record the initial advantage
             if self.now_K_epochs == 0 and self.now_optim_iter_num == 0:
-                deltas = torch.zeros_like(v_)
-                for j in range(1, len(deltas[0])):
-                    deltas[:, j - 1] = (
-                        r[:, j - 1] + self.config_.gamma_ * v_[:, j] - v_[:, j - 1]
-                    )
-
-                advantage = torch.zeros_like(v_)
-
-                for j in range(len(advantage[0]) - 2, -1, -1):
-                    advantage[:, j] = (
-                        deltas[:, j]
-                        + self.config_.gamma_
-                        * self.config_.lamdb_
-                        * advantage[:, j + 1]
+                ref_slice = input[
+                    ref_start_idx:ref_end_idx,
+                    ref_len - generate_text_len - 1 : ref_len - 1,
+                ]
+                ref_log_prob = (
+                    ref_slice.log_softmax(dim=-1).gather(-1, action).squeeze(-1)
+                )
+                r = -self.config_.kl_coefficient_ * (log_prob - ref_log_prob)
+                r[:, -1] += (
+                    self.reward_func(
+                        input[reward_start_idx:reward_end_idx, actor_len - 1]
                     )
-                advantage = self.__normalize(advantage)
-
-                advantage = torch.flip(advantage, [-1])
-                advantage = advantage[:, 0:-1]
-                v_ = v_[:, 0:-1]
-                td_target = advantage + v_
-                self.advantage = advantage
-                self.td_target = td_target
-                self.old_p = p
+                ).squeeze(dim=-1)
+                buffer.record(log_prob, v_, r, self.config_, self.eps)
 
             if self.now_optim_iter_num == 0:
-                self.perm = torch.randperm(len(self.advantage[0]))
-
-            advantage_ = self.advantage[:, self.perm].clone().detach()
-            td_target_ = self.td_target[:, self.perm].clone().detach()
-            old_p = self.old_p[:, self.perm].clone().detach()
-            p = p[:, self.perm]
-            v_ = v_[:, self.perm]
-            action = action.to(self.advantage.device)
-            action = action[:, self.perm]
-
-            index = [
-                i
-                for i in range(
-                    self.now_optim_iter_num * data_len,
-                    min(
-                        (self.now_optim_iter_num + 1) * data_len, len(self.advantage[0])
-                    ),
-                )
-            ]
+                self.perm = torch.randperm(generate_text_len)
+
+            # the positions of this iteration in the permutation
+            perm_start_idx = self.now_optim_iter_num * data_len
+            index = self.perm[perm_start_idx : perm_start_idx + data_len]
             loss1 = self.critic_context_.loss_fn_(
-                v_[:, index].view(-1), td_target_[:, index].view(-1)
+                v_[:, index].reshape(-1), buffer.td_targets_[:, index].reshape(-1)
             )
             loss2 = self.actor_context_.loss_fn_(
-                p[:, index], old_p[:, index], advantage_[:, index], action[:, index]
+                log_prob[:, index],
+                buffer.log_probs_[:, index],
+                buffer.advantages_[:, index],
             )
             loss = loss1 + loss2
 
@@ -525,6 +616,7 @@ class PPOTask(TrainTask):
             self._expand_batch_tokens,
             lambda *_: None,
             self.task_name(),
+            requires_grad=False,
         )
         ref_data_config = MLoRADataConfig(
             ref_model_name,
@@ -534,6 +626,7 @@ class PPOTask(TrainTask):
             self._expand_batch_tokens,
             lambda *_: None,
             self.task_name(),
+            requires_grad=False,
         )
         actor_data_config = MLoRADataConfig(
             self.actor_context_.name_,
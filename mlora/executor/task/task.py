@@ -11,6 +11,7 @@ from tqdm import tqdm
 from mlora.config import TaskConfig
 from mlora.executor.context import TRAINCONTEXT_CLASS, TaskContext
 from mlora.model.args import LinearInfo, Masks, MLoRADataConfig, Tokens
+from mlora.model.llm import LLMModel
 from mlora.model.modules import AdapterModel
 from mlora.model.tokenizer import Tokenizer
 from mlora.prompter import Prompter, PrompterFactory
@@ -72,6 +73,14 @@ class Task:
     @abstractmethod
     def task_progress(self) -> int: ...
 
+    def need_rollout(self) -> bool:
+        # the task generates its samples by the model before its next data
+        return False
+
+    def rollout(self, model: LLMModel):
+        # generate the samples out of the training step, without the autograd
+        ...
+
     def notify_terminate(self):
         self.terminate_ = True
 
@@ -10,6 +10,7 @@ import mlora.profiler
 from mlora.config import TaskConfig, TrainTaskConfig
 from mlora.executor.context import TrainTaskContext
 from mlora.model.args import LinearInfo, Masks, MLoRADataConfig, Tokens
+from mlora.model.modules import LMHeadCrossEntropyFunction
 from mlora.model.tokenizer import Tokenizer
 
 from .task import Task
@@ -25,8 +26,81 @@ def _get_context_state_from_folder_name(dir_name: str) -> Tuple[int, int, int]:
     return epoch, data_idx, step
 
 
+# the label ignored by the loss, same as the torch.nn.CrossEntropyLoss default
+IGNORE_INDEX = -100
+
+
+class TokenPacker:
+    # pack the samples in order into at most max_rows rows of row_len tokens,
+    #   the sample do not fit the last row starts a new row
+    rows_: List[Tokens]
+    doc_lens_: List[List[int]]
+
+    def __init__(self, max_rows: int, row_len: int) -> None:
+        self.max_rows_ = max_rows
+        self.row_len_ = row_len
+
+        self.rows_ = []
+        self.doc_lens_ = []
+
+    def __fit_last_row(self, tokens: Tokens) -> bool:
+        return len(self.rows_) > 0 and (
+            len(self.rows_[-1]) + len(tokens) <= self.row_len_
+        )
+
+    def fit(self, tokens: Tokens) -> bool:
+        return self.__fit_last_row(tokens) or len(self.rows_) < self.max_rows_
+
+    def add(self, tokens: Tokens):
+        if self.__fit_last_row(tokens):
+            self.rows_[-1].extend(tokens)
+            self.doc_lens_[-1].append(len(tokens))
+            return
+        self.rows_.append(list(tokens))
+        self.doc_lens_.append([len(tokens)])
+
+
+def _doc_start(mask: torch.Tensor) -> int:
+    # the first document starts after the left padding
+    return int(mask.sum()) if mask[0] else 0
+
+
+def packed_target(
+    target: torch.Tensor, mask: torch.Tensor, doc_lens: List[List[int]]
+) -> torch.Tensor:
+    # the padding and the first token of each document are ignored, the first
+    #   token is not predicted by the last token of the previous document
+    target = target.masked_fill(mask, IGNORE_INDEX)
+    for row, row_doc_lens in enumerate(doc_lens):
+        offset = _doc_start(mask[row])
+        for doc_len in row_doc_lens:
+            target[row, offset] = IGNORE_INDEX
+            offset += doc_len
+    return target
+
+
+def packed_last_index(
+    mask: torch.Tensor, doc_lens: List[List[int]]
+) -> Tuple[List[int], List[int]]:
+    # the (row, position) of the last token of each document
+    rows: List[int] = []
+    positions: List[int] = []
+    for row, row_doc_lens in enumerate(doc_lens):
+        offset = _doc_start(mask[row])
+        for doc_len in row_doc_lens:
+            offset += doc_len
+            rows.append(row)
+            positions.append(offset - 1)
+    return rows, positions
+
+
 class TrainTask(Task):
     now_epoch_: int
+    # the number of the samples in this step's data
+    step_data_num_: int
+    # the sample not fit the last packed step, the next step starts from it:
+    #   (its data index, its tokens of each stream)
+    pack_overflow_: Optional[Tuple[int, List[Tokens]]]
 
     context_: TrainTaskContext
     config_: TrainTaskConfig
@@ -34,6 +108,8 @@ class TrainTask(Task):
     def __init__(self, config: TaskConfig, llm_name: str) -> None:
         super().__init__(config, llm_name)
         self.now_epoch_ = 1
+        self.step_data_num_ = self.config_.mini_batch_size_
+        self.pack_overflow_ = None
 
     @override
     def is_done(self) -> bool:
@@ -115,44 +191,64 @@ class TrainTask(Task):
             f"epoch: {self.now_epoch_}/{self.config_.num_epochs_} "
             f"iteration: {self.now_data_idx_}/{len(self.data_)} step: {self.now_step_}"
         )
-        data_idx_s = self.now_data_idx_
-        data_idx_e = self.now_data_idx_ + self.config_.mini_batch_size_
+        doc_lens: Optional[List[List[int]]] = None
+        if self.config_.packing_:
+            (packer,) = self._pack_data(1)
+            ret_tokens, doc_lens = packer.rows_, packer.doc_lens_
+        else:
+            ret_tokens = self._encode_data(
+                self.now_data_idx_, self.now_data_idx_ + self.config_.mini_batch_size_
+            )
+        end_idx = start_idx + len(ret_tokens)
 
-        # get the train raw string
-        batch_str = self.prompter_.generate_prompt(self.data_[data_idx_s:data_idx_e])
+        def loss_target(target: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+            target = target[start_idx:end_idx]
+            if doc_lens is not None:
+                target = packed_target(target, mask[start_idx:end_idx], doc_lens)
+            return target[:, 1:].contiguous().view(-1)
 
-        # convert the string to tokens
-        ret_tokens = list(
-            map(
-                lambda raw_str: self.tokenizer_.encode(
-                    raw_str, bos=True, eos=True, cutoff_len=self.config_.cutoff_len_
-                ),
-                batch_str,
+        def log_loss(loss: torch.Tensor):
+            logging.info(f"Adapter {self.context_.name_} loss: {loss}")
+
+            mlora.profiler.metric_log(
+                self.context_.path_ + "_loss", loss.item(), self.now_step_
             )
-        )
-        end_idx = start_idx + len(ret_tokens)
 
         def loss_fn(
-            input: torch.Tensor, target: torch.Tensor, _: torch.Tensor
+            input: torch.Tensor, target: torch.Tensor, mask: torch.Tensor
         ) -> torch.Tensor:
             vacab_size = input.shape[-1]
             loss_input = (
                 input[start_idx:end_idx, :-1, :].contiguous().view(-1, vacab_size)
             )
-            loss_target = (
-                target[start_idx:end_idx, 1:]
-                .contiguous()
-                .view(-1)
-                .to(loss_input.device)
+            loss: torch.Tensor = self.context_.loss_fn_(
+                loss_input, loss_target(target, mask).to(loss_input.device)
             )
-            loss: torch.Tensor = self.context_.loss_fn_(loss_input, loss_target)
 
-            logging.info(f"Adapter {self.context_.name_} loss: {loss}")
+            log_loss(loss)
 
-            mlora.profiler.metric_log(
-                self.context_.path_ + "_loss", loss.item(), self.now_step_
+            return loss
+
+        def fused_loss_fn(
+            input: torch.Tensor,
+            weight: torch.Tensor,
+            target: torch.Tensor,
+            mask: torch.Tensor,
+        ) -> torch.Tensor:
+            # the input is the hidden states, same as the loss_fn without logits
+            loss_fn = self.context_.loss_fn_
+            assert isinstance(loss_fn, torch.nn.CrossEntropyLoss)
+            dim = input.shape[-1]
+            loss_input = input[start_idx:end_idx, :-1, :].reshape(-1, dim)
+            loss: torch.Tensor = LMHeadCrossEntropyFunction.apply(
+                loss_input,
+                weight,
+                loss_target(target, mask).to(loss_input.device),
+                loss_fn.ignore_index,
             )
 
+            log_loss(loss)
+
             return loss
 
         data_config = MLoRADataConfig(
@@ -163,10 +259,66 @@ class TrainTask(Task):
             self._expand_batch_tokens,
             loss_fn,
             self.task_name(),
+            fused_loss_fn if self._fused_loss() else None,
+            doc_lens=doc_lens,
         )
 
         return ret_tokens, [data_config]
 
+    def _encode_data(self, data_idx_s: int, data_idx_e: int) -> List[Tokens]:
+        # get the train raw string
+        batch_str = self.prompter_.generate_prompt(self.data_[data_idx_s:data_idx_e])
+
+        # convert the string to tokens
+        return list(
+            map(
+                lambda raw_str: self.tokenizer_.encode(
+                    raw_str, bos=True, eos=True, cutoff_len=self.config_.cutoff_len_
+                ),
+                batch_str,
+            )
+        )
+
+    def _pack_data(self, n_stream: int) -> List[TokenPacker]:
+        # fill the rows from the now_data_idx_ sample until the token budget
+        #   (mini_batch_size rows of cutoff_len tokens) is full, a sample is
+        #   encoded to n_stream sequences, each stream is packed into its rows
+        packers = [
+            TokenPacker(self.config_.mini_batch_size_, self.config_.cutoff_len_)
+            for _ in range(n_stream)
+        ]
+
+        overflow, self.pack_overflow_ = self.pack_overflow_, None
+
+        data_idx = self.now_data_idx_
+        while data_idx < len(self.data_):
+            if overflow is not None and overflow[0] == data_idx:
+                sample_tokens = overflow[1]
+            else:
+                sample_tokens = self._encode_data(data_idx, data_idx + 1)
+            assert len(sample_tokens) == n_stream
+            if not all(map(TokenPacker.fit, packers, sample_tokens)):
+                # keep the encoded sample, do not encode it again next step
+                self.pack_overflow_ = (data_idx, sample_tokens)
+                break
+            for packer, tokens in zip(packers, sample_tokens):
+                packer.add(tokens)
+            data_idx += 1
+
+        self.step_data_num_ = data_idx - self.now_data_idx_
+
+        return packers
+
+    def _fused_loss(self) -> bool:
+        # only the default mean cross entropy loss can be fused with the lm_head
+        loss_fn = self.context_.loss_fn_
+        return (
+            isinstance(loss_fn, torch.nn.CrossEntropyLoss)
+            and loss_fn.weight is None
+            and loss_fn.reduction == "mean"
+            and loss_fn.label_smoothing == 0.0
+        )
+
     def _expand_batch_tokens(
         self, batch_tokens: List[Tokens], align_len: Optional[int] = None
     ) -> Tuple[List[Tokens], List[Masks]]:
@@ -254,7 +406,7 @@ class TrainTask(Task):
             need_checkpoint = True
 
         self.now_step_ += 1
-        self.now_data_idx_ += self.config_.mini_batch_size_
+        self.now_data_idx_ += self.step_data_num_
 
         if self.now_data_idx_ >= len(self.data_):
             self.now_epoch_ += 1
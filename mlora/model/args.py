@@ -1,7 +1,8 @@
+import copy
 import logging
 import uuid
-from dataclasses import dataclass
-from typing import Callable, List, Optional, Tuple
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import torch
 from transformers import PretrainedConfig
@@ -10,6 +11,16 @@ Tokens = List[int]
 Masks = List[bool]
 
 
+def packed_positions(doc_lens: List[int], masks: Masks) -> List[int]:
+    # the rope position of a packed row restarts from 0 at each document, the
+    #   padding tokens are one more document on the padding side (True mask)
+    positions = [pos for doc_len in doc_lens for pos in range(doc_len)]
+    pad_positions = list(range(len(masks) - len(positions)))
+    if len(pad_positions) > 0 and masks[0]:
+        return pad_positions + positions
+    return positions + pad_positions
+
+
 @dataclass
 class LLMModelArgs:
     name_or_path_: str
@@ -26,6 +37,9 @@ class LLMModelArgs:
     max_seq_len_: int
     device_: str
     dtype_: torch.dtype
+    attention_backend_: str
+    checkpoint_: str
+    checkpoint_budget_: Optional[float]
 
     def __init__(self, config: PretrainedConfig):
         self.__from_pretrained_config(config)
@@ -61,6 +75,13 @@ class LLMModelArgs:
 
         self.device_ = ""
         self.dtype_ = torch.float32
+        # auto: choose the attention backend by the device
+        self.attention_backend_ = "auto"
+        # the activation checkpoint of the decoder: none, recompute or offload
+        self.checkpoint_ = "recompute"
+        # the activation memory budget (GiB) of the decoders, plan the checkpoint
+        #   of each layer by the budget, None is the checkpoint_ for all layers
+        self.checkpoint_budget_ = None
 
 
 @dataclass
@@ -79,6 +100,9 @@ class ModelDataConfig:
     batch_start_idx_: int
     batch_end_idx_: int
 
+    # the positions of each row read by the loss, None is all the positions
+    output_positions_: Optional[List[int]] = None
+
 
 @dataclass
 class ModelData:
@@ -92,6 +116,76 @@ class ModelData:
     random_id_: int
     task_name_: List[str]
 
+    # the output layer returns the hidden states instead of the logits,
+    #   the loss is computed by the fused lm_head and loss
+    output_hidden_: bool = False
+
+    # the rope position of each token, None is 0...seq_len - 1 for all the rows,
+    #   the position 0 starts a new document in the packed row
+    batch_positions_: Optional[List[List[int]]] = None
+    position_ids_: Optional[torch.Tensor] = field(
+        default=None, repr=False, compare=False
+    )
+
+    # the CHECKPOINT_CLASS of each decoder layer (layer_id_) for this batch,
+    #   chosen by the checkpoint planner, None is the decoder's checkpoint_
+    checkpoint_plan_: Optional[Dict[int, str]] = None
+
+    # the adapter dispatch plan of each module for this batch (random_id_),
+    #   built by the first forward and reused by the recompute, it refers
+    #   the local adapters, so it is not serialized
+    dispatch_plan_: Dict[int, Any] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+
+    # the LoRABatchLayout of each group of configs (the config indexes) for
+    #   this batch, shared by all the linears, not serialized
+    lora_layouts_: Dict[Tuple[int, ...], Any] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+
+    # the KVCache of the incremental decoding, the batch_tokens_ are the new
+    #   tokens after the cached ones, None is the full sequence forward
+    kv_cache_: Optional[Any] = field(default=None, repr=False, compare=False)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["dispatch_plan_"] = {}
+        state["lora_layouts_"] = {}
+        state["position_ids_"] = None
+        state["kv_cache_"] = None
+        return state
+
+    def position_ids(self, device: torch.device) -> Optional[torch.Tensor]:
+        # the batch_positions_ tensor, shared by all the layers on the device
+        if self.batch_positions_ is None:
+            return None
+        if self.position_ids_ is None or self.position_ids_.device != device:
+            self.position_ids_ = torch.tensor(
+                self.batch_positions_, dtype=torch.long, device=device
+            )
+        return self.position_ids_
+
+    def checkpoint(self, layer_id: int, default: str) -> str:
+        if self.checkpoint_plan_ is None:
+            return default
+        return self.checkpoint_plan_.get(layer_id, default)
+
+    def output_index(self, seq_len: int) -> Optional[List[int]]:
+        # the flatten index (row * seq_len + position) of the positions read by
+        #   all the configs, None means the output of all the positions is needed
+        if self.output_hidden_:
+            return None
+
+        index: List[int] = []
+        for config in self.data_config_:
+            if config.output_positions_ is None:
+                return None
+            positions = [pos % seq_len for pos in config.output_positions_]
+            for row in range(config.batch_start_idx_, config.batch_end_idx_):
+                index.extend(row * seq_len + pos for pos in positions)
+        return index
+
 
 class MLoRADataConfig:
     adapter_name_: str
@@ -106,6 +200,32 @@ class MLoRADataConfig:
     loss_fn_: Callable[
         [torch.Tensor, torch.Tensor, torch.Tensor], Optional[torch.Tensor]
     ]
+    # the loss computed from the hidden states and the lm_head weight without
+    #   the full logits, None means the task needs the full logits
+    fused_loss_fn_: Optional[
+        Callable[
+            [torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+            Optional[torch.Tensor],
+        ]
+    ]
+
+    # the positions of each row read by the loss_fn, None is all the positions,
+    #   when all the configs in the batch declare it, the lm_head only projects
+    #   these positions and the loss_fn gets the compact output of its rows:
+    #   rows * len(positions) * vocab_size, [i, j] is the row batch_start_idx_ + i
+    #   and the position positions[j]
+    output_positions_: Optional[List[int]]
+
+    # the length of the documents packed in each row, None is one document
+    doc_lens_: Optional[List[List[int]]]
+
+    # the loss_fn indexes the rows from the loss_offset_ row of the batch, the
+    #   task's data is built from row 0 and then moved to a micro batch
+    loss_offset_: int
+
+    # the loss needs the grad of the rows' output, the rows without it (the
+    #   reference model, the generation) are forwarded without the autograd
+    requires_grad_: bool
 
     task_name_: str
 
@@ -118,6 +238,10 @@ class MLoRADataConfig:
         expand_fn: Callable,
         loss_fn: Callable,
         task_name: str,
+        fused_loss_fn: Optional[Callable] = None,
+        output_positions: Optional[List[int]] = None,
+        doc_lens: Optional[List[List[int]]] = None,
+        requires_grad: bool = True,
     ) -> None:
         self.adapter_name_ = adapter_name
         self.adapter_type_ = adapter_type
@@ -126,15 +250,27 @@ class MLoRADataConfig:
 
         self.expand_fn_ = expand_fn
         self.loss_fn_ = loss_fn
+        self.fused_loss_fn_ = fused_loss_fn
+        self.output_positions_ = output_positions
+        self.doc_lens_ = doc_lens
+        self.loss_offset_ = 0
+        self.requires_grad_ = requires_grad
 
         self.task_name_ = task_name
 
+    def shift(self, offset: int):
+        # move the config's rows to start from the offset row of the batch
+        self.batch_start_idx_ += offset
+        self.batch_end_idx_ += offset
+        self.loss_offset_ += offset
+
     def model_data_config(self) -> ModelDataConfig:
         return ModelDataConfig(
             adapter_name_=self.adapter_name_,
             adapter_type_=self.adapter_type_,
             batch_start_idx_=self.batch_start_idx_,
             batch_end_idx_=self.batch_end_idx_,
+            output_positions_=self.output_positions_,
         )
 
 
@@ -158,14 +294,137 @@ class MLoRAData:
         self.data_config_ = data_config
         self.random_id_ = uuid.uuid4().int
 
-    def model_data(self) -> ModelData:
+    def requires_grad(self) -> bool:
+        return any(config.requires_grad_ for config in self.data_config_)
+
+    def compact_output(self, output_hidden: bool = False) -> bool:
+        # the output only has the positions declared by the configs
+        return not output_hidden and all(
+            config.output_positions_ is not None for config in self.data_config_
+        )
+
+    def split_grad(
+        self, requires_grad: bool, output_hidden: bool = False
+    ) -> "MLoRAData":
+        # the rows of the configs with (or without) the grad as a new batch, the
+        #   output has the same layout as this batch, so they can be merged
+        compact = self.compact_output(output_hidden)
+
+        batch_tokens: List[Tokens] = []
+        batch_mask: List[Masks] = []
+        data_config: List[MLoRADataConfig] = []
+        for config in self.data_config_:
+            if config.requires_grad_ != requires_grad:
+                continue
+            start_idx, end_idx = config.batch_start_idx_, config.batch_end_idx_
+
+            split_config = copy.copy(config)
+            split_config.batch_start_idx_ = len(batch_tokens)
+            split_config.batch_end_idx_ = len(batch_tokens) + end_idx - start_idx
+            if not compact:
+                split_config.output_positions_ = None
+            data_config.append(split_config)
+
+            batch_tokens.extend(self.batch_tokens_[start_idx:end_idx])
+            batch_mask.extend(self.batch_mask_[start_idx:end_idx])
+
+        return MLoRAData(batch_tokens, batch_mask, data_config)
+
+    def merge_output(
+        self,
+        grad_output: torch.Tensor,
+        no_grad_output: torch.Tensor,
+        output_hidden: bool = False,
+    ) -> torch.Tensor:
+        # the output of the split_grad batches in the order of this batch's
+        #   configs, the configs cover the rows in order
+        compact = self.compact_output(output_hidden)
+        outputs = {True: grad_output, False: no_grad_output}
+        offsets = {True: 0, False: 0}
+
+        chunks: List[torch.Tensor] = []
+        next_row = 0
+        for config in self.data_config_:
+            assert config.batch_start_idx_ == next_row, "the rows are not in order"
+            next_row = config.batch_end_idx_
+
+            size = config.batch_end_idx_ - config.batch_start_idx_
+            if compact:
+                assert config.output_positions_ is not None
+                size *= len(config.output_positions_)
+            offset = offsets[config.requires_grad_]
+            chunks.append(outputs[config.requires_grad_][offset : offset + size])
+            offsets[config.requires_grad_] = offset + size
+        return torch.cat(chunks)
+
+    def fused_loss(self) -> bool:
+        return all(config.fused_loss_fn_ is not None for config in self.data_config_)
+
+    def config_output(
+        self, output: torch.Tensor, output_hidden: bool = False
+    ) -> List[torch.Tensor]:
+        # split the output to the input of each config's loss_fn, same as the
+        #   ModelData.output_index, the positions selected output is compact,
+        #   the config declared the positions always gets them (rows *
+        #   n_positions * dim), even if the others need the full output
+        compact = self.compact_output(output_hidden)
+
+        ret_output = []
+        offset = 0
+        for config in self.data_config_:
+            if config.output_positions_ is None:
+                ret_output.append(output[config.loss_offset_ :])
+                continue
+
+            rows = config.batch_end_idx_ - config.batch_start_idx_
+            n_positions = len(config.output_positions_)
+            if compact:
+                config_output = output[offset : offset + rows * n_positions]
+                offset += rows * n_positions
+            else:
+                config_output = output[
+                    config.batch_start_idx_ : config.batch_end_idx_,
+                    config.output_positions_,
+                ]
+            ret_output.append(config_output.view(rows, n_positions, -1))
+        return ret_output
+
+    def loss_inputs(
+        self, output: torch.Tensor, output_hidden: bool = False
+    ) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        # the (input, target, mask) of each config's loss_fn
+        labels = torch.tensor(self.batch_tokens_, dtype=torch.long)
+        masks = torch.tensor(self.batch_mask_)
+
+        return [
+            (loss_input, labels[config.loss_offset_ :], masks[config.loss_offset_ :])
+            for config, loss_input in zip(
+                self.data_config_, self.config_output(output, output_hidden)
+            )
+        ]
+
+    def batch_positions(self) -> Optional[List[List[int]]]:
+        if all(config.doc_lens_ is None for config in self.data_config_):
+            return None
+
+        positions = [list(range(self.token_len()))] * self.batch_size()
+        for config in self.data_config_:
+            if config.doc_lens_ is None:
+                continue
+            for row, doc_lens in enumerate(config.doc_lens_, config.batch_start_idx_):
+                positions[row] = packed_positions(doc_lens, self.batch_mask_[row])
+        return positions
+
+    def model_data(self, output_hidden: bool = False) -> ModelData:
         return ModelData(
             batch_tokens_=self.batch_tokens_,
             batch_mask_=self.batch_mask_,
             data_config_=[config.model_data_config() for config in self.data_config_],
-            enable_checkpoint_=True,
+            enable_checkpoint_=self.requires_grad(),
             task_name_=[config.task_name_ for config in self.data_config_],
             random_id_=self.random_id_,
+            output_hidden_=output_hidden,
+            batch_positions_=self.batch_positions(),
         )
 
     def batch_size(self) -> int:
@@ -1,5 +1,16 @@
-from .checkpoint import CheckpointRecomputeFunction
+from .checkpoint import (
+    CHECKPOINT_CLASS,
+    CheckpointNoneFunction,
+    CheckpointOffloadFunction,
+    CheckpointRecomputeFunction,
+)
+from .planner import CheckpointPlanner, LayerCost
 
 __all__ = [
+    "CheckpointNoneFunction",
     "CheckpointRecomputeFunction",
+    "CheckpointOffloadFunction",
+    "CHECKPOINT_CLASS",
+    "CheckpointPlanner",
+    "LayerCost",
 ]
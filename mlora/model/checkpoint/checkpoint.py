@@ -1,22 +1,206 @@
-from typing import Callable, Tuple
+import itertools
+import weakref
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 import torch
 
+# the saved tensor smaller than it is kept on the device, the copy of a small
+#   tensor costs more than the memory it saves
+OFFLOAD_MIN_NUMEL = 1 << 16
+# the bytes of the free pinned buffers kept by the pool, the buffer released
+#   over it is returned to the torch's host allocator
+PINNED_POOL_MAX_BYTES = 4 << 30
 
-def __pack_hook(to_offload: torch.Tensor) -> Tuple[torch.device, torch.Tensor]:
-    return to_offload.device, to_offload.to("cpu")
 
+def buffer_numel(numel: int) -> int:
+    # round up to the power of two, so the batches of different lengths
+    #   share the buffers
+    return 1 << max(numel - 1, 0).bit_length()
 
-def __unpack_hook(to_offload_info: Tuple[torch.device, torch.Tensor]) -> torch.Tensor:
-    device, to_offload = to_offload_info
-    return to_offload.to(device)
+
+class PinnedBufferPool:
+    # the pinned host buffers reused by the offloaded activations, each layer
+    #   of the same batch saves the same shapes, so the buffer is keyed by the
+    #   bucketed numel and dtype, a buffer is released with the event of its
+    #   last copy, it is reused after the copy is done
+    free_: Dict[Tuple[int, torch.dtype], List[Tuple[torch.Tensor, torch.cuda.Event]]]
+
+    def __init__(self, max_bytes: int = PINNED_POOL_MAX_BYTES) -> None:
+        self.free_ = defaultdict(list)
+        self.max_bytes_ = max_bytes
+        self.free_bytes_ = 0
+
+    def acquire(self, numel: int, dtype: torch.dtype) -> torch.Tensor:
+        # the buffer may be larger than the numel
+        numel = buffer_numel(numel)
+        free_buffers = self.free_[(numel, dtype)]
+        if len(free_buffers) > 0:
+            buffer, event = free_buffers.pop()
+            self.free_bytes_ -= buffer.numel() * buffer.element_size()
+            event.synchronize()
+            return buffer
+        return torch.empty(numel, dtype=dtype, pin_memory=True)
+
+    def release(self, buffer: torch.Tensor, event: torch.cuda.Event):
+        nbytes = buffer.numel() * buffer.element_size()
+        if self.free_bytes_ + nbytes > self.max_bytes_:
+            # the host allocator keeps it until the copy is done
+            return
+        self.free_bytes_ += nbytes
+        self.free_[(buffer.numel(), buffer.dtype)].append((buffer, event))
+
+
+g_pinned_pool = PinnedBufferPool()
+
+
+class OffloadedTensor:
+    # the saved tensor copied to the pinned buffer on the offload stream, it is
+    #   copied back by the prefetch or on demand, only unpacked once
+    def __init__(self, tensor: torch.Tensor, stream: torch.cuda.Stream):
+        self.device_ = tensor.device
+        self.shape_ = tensor.shape
+        self.event_ = torch.cuda.Event()
+        self.device_tensor_: Optional[torch.Tensor] = None
+
+        self.buffer_: Optional[torch.Tensor] = g_pinned_pool.acquire(
+            tensor.numel(), tensor.dtype
+        )
+        stream.wait_stream(torch.cuda.current_stream(self.device_))
+        with torch.cuda.stream(stream):
+            self.host_tensor().copy_(tensor, non_blocking=True)
+        # the tensor's memory is not reused before the copy is done
+        tensor.record_stream(stream)
+
+    def host_tensor(self) -> torch.Tensor:
+        assert self.buffer_ is not None
+        return self.buffer_[: self.shape_.numel()].view(self.shape_)
+
+    def prefetch(self, stream: torch.cuda.Stream):
+        if self.device_tensor_ is not None or self.buffer_ is None:
+            return
+        with torch.cuda.stream(stream):
+            self.device_tensor_ = self.host_tensor().to(self.device_, non_blocking=True)
+            self.event_.record(stream)
+        g_pinned_pool.release(self.buffer_, self.event_)
+        self.buffer_ = None
+
+    def get(self, stream: torch.cuda.Stream) -> torch.Tensor:
+        self.prefetch(stream)
+        assert self.device_tensor_ is not None, "the offloaded tensor is unpacked"
+
+        compute_stream = torch.cuda.current_stream(self.device_)
+        compute_stream.wait_event(self.event_)
+        self.device_tensor_.record_stream(compute_stream)
+
+        tensor, self.device_tensor_ = self.device_tensor_, None
+        return tensor
+
+
+class OffloadLayer:
+    # the offloaded tensors of one layer's forward, the backward of the layer
+    #   prefetches the previous layer (the next one in the backward)
+    def __init__(
+        self,
+        stream: torch.cuda.Stream,
+        prev: Optional["OffloadLayer"],
+        weights: Set[int],
+    ):
+        self.stream_ = stream
+        # the storages of the layer's weights, the saved tensor of a frozen
+        #   weight is a plain tensor without the grad, so it is matched by them
+        self.weights_ = weights
+        # the layer is kept by the autograd graph, a layer without backward
+        #   (no loss) is released with its graph
+        self.prev_ = None if prev is None else weakref.ref(prev)
+        self.tensors_: List[OffloadedTensor] = []
+
+    def prefetch(self):
+        for tensor in self.tensors_:
+            tensor.prefetch(self.stream_)
+
+    def pack(self, tensor: torch.Tensor) -> Any:
+        # keep the weights and the small tensors on the device
+        if (
+            not tensor.is_cuda
+            or tensor.numel() < OFFLOAD_MIN_NUMEL
+            or (tensor.is_leaf and tensor.requires_grad)
+            or tensor.untyped_storage().data_ptr() in self.weights_
+        ):
+            return tensor
+        offloaded_tensor = OffloadedTensor(tensor, self.stream_)
+        self.tensors_.append(offloaded_tensor)
+        return offloaded_tensor
+
+    def unpack(self, packed: Any) -> torch.Tensor:
+        if self.prev_ is not None:
+            prev = self.prev_()
+            if prev is not None:
+                prev.prefetch()
+            self.prev_ = None
+
+        if not isinstance(packed, OffloadedTensor):
+            return packed
+        return packed.get(self.stream_)
+
+
+class ActivationOffloader:
+    # the layers are chained in the forward order, one offload stream per device
+    streams_: Dict[torch.device, torch.cuda.Stream]
+    last_layer_: Optional[OffloadLayer]
+
+    def __init__(self) -> None:
+        self.streams_ = {}
+        self.last_layer_ = None
+
+    def new_layer(self, device: torch.device, weights: Set[int]) -> OffloadLayer:
+        if device not in self.streams_:
+            self.streams_[device] = torch.cuda.Stream(device)
+        self.last_layer_ = OffloadLayer(
+            self.streams_[device], self.last_layer_, weights
+        )
+        return self.last_layer_
+
+
+g_offloader = ActivationOffloader()
+
+
+def module_weights(run_function: Callable) -> Set[int]:
+    # the storages of the parameters and buffers of the run_function's module,
+    #   the fused weights share the storage with the linears' weights
+    module = getattr(run_function, "__self__", None)
+    if not isinstance(module, torch.nn.Module):
+        return set()
+    return {
+        tensor.untyped_storage().data_ptr()
+        for tensor in itertools.chain(module.parameters(), module.buffers())
+    }
 
 
 def CheckpointOffloadFunction(run_function: Callable, *args):
-    with torch.autograd.graph.saved_tensors_hooks(__pack_hook, __unpack_hook):
+    # the saved tensors of the forward are offloaded to the pinned host memory
+    #   asynchronously, the backward copies them back one layer ahead, so no
+    #   recompute, the cpu tensors are not offloaded
+    if not args[0].is_cuda:
+        return run_function(*args)
+
+    layer = g_offloader.new_layer(args[0].device, module_weights(run_function))
+    with torch.autograd.graph.saved_tensors_hooks(layer.pack, layer.unpack):
         outputs = run_function(*args)
     return outputs
 
 
+def CheckpointNoneFunction(run_function: Callable, *args):
+    # keep all the activations of the forward on the device
+    return run_function(*args)
+
+
 def CheckpointRecomputeFunction(run_function: Callable, *args):
     return torch.utils.checkpoint.checkpoint(run_function, *args, use_reentrant=True)
+
+
+CHECKPOINT_CLASS: Dict[str, Callable] = {
+    "none": CheckpointNoneFunction,
+    "recompute": CheckpointRecomputeFunction,
+    "offload": CheckpointOffloadFunction,
+}
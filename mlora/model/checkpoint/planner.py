@@ -0,0 +1,249 @@
+import dataclasses
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from mlora.model.args import ModelData
+
+# from keep to offload, the layer saves less device memory
+CHECKPOINT_ORDER = ["none", "recompute", "offload"]
+
+# the cost is per_token * tokens + per_adapter * adapters
+LinearCost = Tuple[float, float]
+
+
+def fit_linear_cost(
+    full: float, half: float, tokens: Tuple[int, int], adapters: int
+) -> LinearCost:
+    # two profiling points with the same adapters and tokens[0] > tokens[1],
+    #   the intercept is the fixed cost of the adapters
+    if tokens[0] == tokens[1]:
+        return max(0.0, full / tokens[0]), 0.0
+    per_token = max(0.0, (full - half) / (tokens[0] - tokens[1]))
+    per_adapter = max(0.0, full - per_token * tokens[0]) / max(adapters, 1)
+    return per_token, per_adapter
+
+
+@dataclass
+class LayerCost:
+    # the device memory saved by the layer's forward (the activations and the
+    #   output, not the input)
+    keep_bytes_: LinearCost
+    # the output of the layer, kept by the recompute to rerun the next layer
+    hidden_bytes_: float
+    # the forward time, the recompute reruns it in backward
+    forward_time_: LinearCost
+    # the seconds to copy one byte between the device and the pinned memory
+    copy_time_: float
+
+    def keep_bytes(self, tokens: int, adapters: int) -> float:
+        return self.keep_bytes_[0] * tokens + self.keep_bytes_[1] * adapters
+
+    def resident_bytes(self, kind: str, tokens: int, adapters: int) -> float:
+        # the memory held from the forward to the backward of the layer
+        if kind == "none":
+            return self.keep_bytes(tokens, adapters)
+        if kind == "recompute":
+            return self.hidden_bytes_ * tokens
+        return 0.0
+
+    def extra_time(self, kind: str, tokens: int, adapters: int) -> float:
+        forward = self.forward_time_[0] * tokens + self.forward_time_[1] * adapters
+        if kind == "none":
+            return 0.0
+        if kind == "recompute":
+            return forward
+        # the copy to host overlaps the next layer's forward, the copy back
+        #   overlaps the backward (about two forwards)
+        copy = self.copy_time_ * self.keep_bytes(tokens, adapters)
+        return max(0.0, copy - forward) + max(0.0, copy - 2 * forward)
+
+
+class CheckpointPlanner:
+    # choose keep (none), recompute or offload for each decoder layer, the plan
+    #   has the least extra time and its activations fit the budget, the cost
+    #   of each layer is calibrated by profiling the forward of the first batch
+    budget_: float
+    costs_: Dict[int, LayerCost]
+    plans_: Dict[Tuple[int, int, int], Dict[int, str]]
+
+    def __init__(self, budget: float) -> None:
+        # budget: the device memory (bytes) of the decoders' activations
+        self.budget_ = budget
+        self.costs_ = {}
+        self.plans_ = {}
+
+    def profiled(self) -> bool:
+        return len(self.costs_) > 0
+
+    def memory(self, plan: Dict[int, str], tokens: int, adapters: int) -> float:
+        # the peak is the end of the forward or the backward of one layer: the
+        #   layers before it are resident, its activations are rebuilt, and the
+        #   offloaded layer before it is prefetched
+        peak = resident = prefetch = 0.0
+        for layer_id in sorted(plan):
+            kind = plan[layer_id]
+            cost = self.costs_[layer_id]
+            keep = cost.keep_bytes(tokens, adapters)
+            working = keep + (prefetch if kind == "offload" else 0.0)
+            peak = max(peak, resident + working)
+            resident += cost.resident_bytes(kind, tokens, adapters)
+            if kind == "offload":
+                prefetch = keep
+        return max(peak, resident)
+
+    def extra_time(self, plan: Dict[int, str], tokens: int, adapters: int) -> float:
+        return sum(
+            self.costs_[layer_id].extra_time(kind, tokens, adapters)
+            for layer_id, kind in plan.items()
+        )
+
+    def __cheapest_move(
+        self, plan: Dict[int, str], tokens: int, adapters: int
+    ) -> Optional[Tuple[int, str]]:
+        # the move to less memory with the least extra time per saved byte
+        memory = self.memory(plan, tokens, adapters)
+        time_cost = self.extra_time(plan, tokens, adapters)
+
+        best_move: Optional[Tuple[int, str]] = None
+        best_ratio = 0.0
+        for layer_id, kind in plan.items():
+            for next_kind in CHECKPOINT_ORDER[CHECKPOINT_ORDER.index(kind) + 1 :]:
+                next_plan = {**plan, layer_id: next_kind}
+                saved = memory - self.memory(next_plan, tokens, adapters)
+                if saved <= 0:
+                    continue
+                cost = self.extra_time(next_plan, tokens, adapters) - time_cost
+                if best_move is None or cost / saved < best_ratio:
+                    best_move, best_ratio = (layer_id, next_kind), cost / saved
+        return best_move
+
+    def plan(self, tokens: int, rows: int, adapters: int) -> Dict[int, str]:
+        # the plan is cached by the batch shape, the cost is linear in the
+        #   tokens, the rows only tell the shapes apart
+        key = (tokens, rows, adapters)
+        if key in self.plans_:
+            return self.plans_[key]
+
+        plan = {layer_id: "none" for layer_id in self.costs_}
+        while self.memory(plan, tokens, adapters) > self.budget_:
+            move = self.__cheapest_move(plan, tokens, adapters)
+            if move is None:
+                logging.warning(
+                    f"The activations of {tokens} tokens exceed the checkpoint "
+                    f"budget {self.budget_ / (1 << 30):.2f}GiB."
+                )
+                break
+            plan[move[0]] = move[1]
+
+        kinds = list(plan.values())
+        logging.info(
+            f"Checkpoint plan of {rows} rows, {tokens} tokens, {adapters} adapters: "
+            + ", ".join(f"{kind} {kinds.count(kind)}" for kind in CHECKPOINT_ORDER)
+        )
+        self.plans_[key] = plan
+        return plan
+
+    def profile(
+        self,
+        layers: List[torch.nn.Module],
+        hidden_states: torch.Tensor,
+        mask: Optional[torch.Tensor],
+        input_args: ModelData,
+    ):
+        # run each layer's forward with the full and the half sequence, and fit
+        #   the per token and per adapter cost
+        seq_len = hidden_states.shape[1]
+        half_len = max(seq_len // 2, 1)
+        rows = hidden_states.shape[0]
+        adapters = len(input_args.data_config_)
+
+        full = self.__measure(layers, hidden_states, mask, input_args, seq_len)
+        half = self.__measure(layers, hidden_states, mask, input_args, half_len)
+        copy_time = measure_copy_time(hidden_states.device, int(max(full[0])))
+
+        tokens = (rows * seq_len, rows * half_len)
+        hidden_bytes = hidden_states[0, 0].numel() * hidden_states.element_size()
+        for idx, layer in enumerate(layers):
+            self.costs_[layer.layer_id_] = LayerCost(
+                keep_bytes_=fit_linear_cost(
+                    full[0][idx], half[0][idx], tokens, adapters
+                ),
+                hidden_bytes_=hidden_bytes,
+                forward_time_=fit_linear_cost(
+                    full[1][idx], half[1][idx], tokens, adapters
+                ),
+                copy_time_=copy_time,
+            )
+        self.plans_ = {}
+
+    @staticmethod
+    def __measure(
+        layers: List[torch.nn.Module],
+        hidden_states: torch.Tensor,
+        mask: Optional[torch.Tensor],
+        input_args: ModelData,
+        seq_len: int,
+    ) -> Tuple[List[float], List[float]]:
+        # the memory and time of each layer's forward, the graph of a layer is
+        #   released before the next one, so only one layer's activations exist
+        device = hidden_states.device
+        input_args = profile_data(input_args, seq_len)
+        if mask is not None:
+            mask = mask[..., :seq_len, :seq_len]
+        hidden_states = hidden_states[:, :seq_len].detach()
+
+        memory: List[float] = []
+        elapsed: List[float] = []
+        for layer in layers:
+            hidden_states.requires_grad_(True)
+            torch.cuda.synchronize(device)
+            start_memory = torch.cuda.memory_allocated(device)
+            start_time = time.perf_counter()
+
+            output = layer.forward(hidden_states, mask, input_args)
+
+            torch.cuda.synchronize(device)
+            elapsed.append(time.perf_counter() - start_time)
+            memory.append(torch.cuda.memory_allocated(device) - start_memory)
+
+            hidden_states = output.detach()
+            del output
+
+        return memory, elapsed
+
+
+def profile_data(input_args: ModelData, seq_len: int) -> ModelData:
+    # the first seq_len tokens of the batch, a new random_id_ so the dispatch
+    #   plan of the batch is not shared with the profiling
+    batch_positions = input_args.batch_positions_
+    if batch_positions is not None:
+        batch_positions = [positions[:seq_len] for positions in batch_positions]
+    return dataclasses.replace(
+        input_args,
+        batch_tokens_=[tokens[:seq_len] for tokens in input_args.batch_tokens_],
+        batch_mask_=[masks[:seq_len] for masks in input_args.batch_mask_],
+        random_id_=uuid.uuid4().int,
+        batch_positions_=batch_positions,
+        position_ids_=None,
+        dispatch_plan_={},
+        checkpoint_plan_=None,
+    )
+
+
+def measure_copy_time(device: torch.device, n_bytes: int) -> float:
+    # the seconds per byte of the device to pinned memory copy
+    n_bytes = max(n_bytes, 1 << 20)
+    src = torch.empty(n_bytes, dtype=torch.uint8, device=device)
+    dst = torch.empty(n_bytes, dtype=torch.uint8, pin_memory=True)
+
+    torch.cuda.synchronize(device)
+    start_time = time.perf_counter()
+    dst.copy_(src, non_blocking=True)
+    torch.cuda.synchronize(device)
+
+    return (time.perf_counter() - start_time) / n_bytes
@@ -0,0 +1,101 @@
+import dataclasses
+import uuid
+from typing import List
+
+import torch
+
+from mlora.model.args import Masks, ModelData, ModelDataConfig, Tokens
+from mlora.model.llm import LLMModel
+from mlora.model.modules import KVCache
+
+
+def sample_tokens(
+    logits: torch.Tensor,
+    temperature: float = 1.0,
+    top_k: int = 0,
+    top_p: float = 1.0,
+) -> torch.Tensor:
+    # logits: batch_size * vocab_size, sample one token of each row, the
+    #   temperature 0 is greedy, top_k 0 and top_p 1.0 keep all the tokens
+    if temperature <= 0:
+        return logits.argmax(dim=-1)
+
+    logits = logits.float() / temperature
+
+    if 0 < top_k < logits.size(-1):
+        kth_logits = torch.topk(logits, top_k, dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth_logits, float("-inf"))
+
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # drop the token when the tokens before it already cover the top_p,
+        #   so the most likely token is always kept
+        removed = sorted_probs.cumsum(dim=-1) - sorted_probs > top_p
+        sorted_logits = sorted_logits.masked_fill(removed, float("-inf"))
+        logits = logits.scatter(-1, sorted_idx, sorted_logits)
+
+    return torch.multinomial(logits.softmax(dim=-1), 1).squeeze(-1)
+
+
+@torch.no_grad()
+def generate(
+    model: LLMModel,
+    batch_tokens: List[Tokens],
+    data_config: List[ModelDataConfig],
+    max_new_tokens: int,
+    pad_id: int,
+    temperature: float = 1.0,
+    top_k: int = 0,
+    top_p: float = 1.0,
+) -> List[Tokens]:
+    # generate max_new_tokens tokens of each row with the kv cache, the prompt
+    #   is encoded once and then one token each step, the row uses the adapter
+    #   of its data config, return the new tokens of each row
+    prompt_len = max(map(len, batch_tokens))
+    # pad on the left, so the new tokens of all the rows are at the end
+    step_tokens = [[pad_id] * (prompt_len - len(t)) + t for t in batch_tokens]
+    step_masks: List[Masks] = [
+        [True] * (prompt_len - len(t)) + [False] * len(t) for t in batch_tokens
+    ]
+
+    # only the lm_head of the last position is needed, the output of the
+    #   configs is in the order of the configs' rows
+    data_config = [
+        dataclasses.replace(config, output_positions_=[-1]) for config in data_config
+    ]
+    rows = torch.tensor(
+        [
+            row
+            for config in data_config
+            for row in range(config.batch_start_idx_, config.batch_end_idx_)
+        ],
+        dtype=torch.long,
+    )
+
+    kv_cache = KVCache(prompt_len + max_new_tokens)
+    new_tokens: List[Tokens] = [[] for _ in batch_tokens]
+
+    for _ in range(max_new_tokens):
+        output = model.decode(
+            ModelData(
+                batch_tokens_=step_tokens,
+                batch_mask_=step_masks,
+                data_config_=data_config,
+                enable_checkpoint_=False,
+                random_id_=uuid.uuid4().int,
+                task_name_=[config.adapter_name_ for config in data_config],
+            ),
+            kv_cache,
+        )
+        logits = torch.empty_like(output)
+        logits[rows.to(output.device)] = output
+
+        next_tokens = sample_tokens(logits, temperature, top_k, top_p).tolist()
+        for tokens, token in zip(new_tokens, next_tokens):
+            tokens.append(token)
+
+        step_tokens = [[token] for token in next_tokens]
+        step_masks = [[False] for _ in next_tokens]
+
+    return new_tokens
@@ -7,8 +7,15 @@ from torch.nn.modules import Sequential
 from transformers import AutoConfig, AutoModelForCausalLM
 
 from mlora.model.args import LinearInfo, LLMModelArgs, Masks, ModelData
-from mlora.model.checkpoint import CheckpointRecomputeFunction
-from mlora.model.modules import AdapterModel, Decoder, Embedding, OutputLayer, RMSNorm
+from mlora.model.checkpoint import CHECKPOINT_CLASS, CheckpointPlanner
+from mlora.model.modules import (
+    AdapterModel,
+    Decoder,
+    Embedding,
+    KVCache,
+    OutputLayer,
+    RMSNorm,
+)
 from mlora.profiler import nvtx_wrapper, set_backward_tracepoint
 from mlora.utils import is_package_available
 
@@ -21,24 +28,24 @@ from .model_llm import LLMModel
 
 
 # input_tokens shape is: batch_size * seq_len
-#   default: upper triangular matrix like below, i.e. diagonal = 1
-#            0 -inf -inf
-#            0    0 -inf
-#            0    0    0
+#   the causal mask (upper triangular matrix, i.e. diagonal = 1) is implicit,
+#   the attention kernel applies it, so the mask is only the padding mask
+#   broadcast to all the heads and queries: batch_size * 1 * 1 * seq_len
 # additional_mask: batch_size * seq_len
-#   default: is None the matrix like default, if set true, the mask metric will be -inf
+#   default: is None (or no true) the mask is None, so the attention kernel
+#   only applies the causal mask, if set true, the key will be -inf
 #   example: [[True, False, False]]
-#           -inf -inf -inf
-#           -inf    0 -inf
 #           -inf    0    0
+# batch_positions: batch_size * seq_len, the rows packed with several documents
+#   (ModelData.batch_positions_), the token only attends to its own document,
+#   so the mask is batch_size * 1 * seq_len * seq_len
 def precompute_mask(
     input_tokens: torch.Tensor,
-    n_heads: int,
     device: str,
     additional_mask: List[Masks] | None = None,
-    diagonal: int = 1,
     dtype: torch.dtype = torch.float32,
-) -> torch.Tensor:
+    batch_positions: List[List[int]] | None = None,
+) -> Optional[torch.Tensor]:
     if input_tokens.dim() == 2:
         batch_size, seq_len = input_tokens.shape
     elif input_tokens.dim() == 3:
@@ -46,29 +53,49 @@ def precompute_mask(
     else:
         raise Exception("input dim is not correct {input_tokens.dim}")
 
-    TORCH_MIN_VALUE = torch.finfo(dtype).min
-    mask = torch.full(
-        (batch_size, n_heads, seq_len, seq_len),
-        TORCH_MIN_VALUE,
-        device=device,
-        dtype=dtype,
-    )
-    mask = torch.triu(mask, diagonal=diagonal)
+    if batch_positions is not None:
+        return precompute_document_mask(batch_positions, device, additional_mask, dtype)
+
+    if additional_mask is None or not any(any(masks) for masks in additional_mask):
+        return None
+
+    mask = torch.zeros((batch_size, 1, 1, seq_len), device=device, dtype=dtype)
+
+    masks_metric = torch.tensor(additional_mask, dtype=torch.bool, device=device)
+    masks_metric = masks_metric.view(batch_size, 1, 1, seq_len)
+    mask.masked_fill_(masks_metric, torch.finfo(dtype).min)
+
+    mask.requires_grad_(False)
+
+    return mask
+
+
+def precompute_document_mask(
+    batch_positions: List[List[int]],
+    device: str,
+    additional_mask: List[Masks] | None,
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    # the position 0 starts a new document, the key of other document is masked
+    positions = torch.tensor(batch_positions, dtype=torch.long, device=device)
+    doc_ids = (positions == 0).cumsum(dim=-1)
+    masks_metric = doc_ids.unsqueeze(-1) != doc_ids.unsqueeze(-2)
 
     if additional_mask is not None:
-        masks_metric = torch.tensor(additional_mask, dtype=torch.bool, device=device)
-        masks_metric = masks_metric.view(batch_size, 1, 1, seq_len)
-        masks_metric = masks_metric.expand(-1, n_heads, seq_len, -1)
-        mask = torch.masked_fill(mask, masks_metric, TORCH_MIN_VALUE)
+        pad_metric = torch.tensor(additional_mask, dtype=torch.bool, device=device)
+        masks_metric |= pad_metric.unsqueeze(1)
+
+    mask = torch.zeros(masks_metric.shape, device=device, dtype=dtype)
+    mask.masked_fill_(masks_metric, torch.finfo(dtype).min)
 
     mask.requires_grad_(False)
 
-    return mask.to(device=device, dtype=dtype)
+    return mask.unsqueeze(1)
 
 
 LlamaSequentialModuleIO = Tuple[
     torch.Tensor,  # the input batch tokens
-    torch.Tensor,  # the mask matrics
+    Optional[torch.Tensor],  # the padding (or document) mask, causal is implicit
     ModelData,  # batch data config
     bool,  # whether to use checkpoint
 ]
@@ -88,7 +115,7 @@ class LlamaSequentialWrapper(torch.nn.Module):
     def forward(self, input: LlamaSequentialModuleIO) -> LlamaSequentialModuleIO:
         assert len(input) == LEN_LLAMA_SEQUENTIAL_MODULE_IO
         assert isinstance(input[0], torch.Tensor)
-        assert isinstance(input[1], torch.Tensor)
+        assert input[1] is None or isinstance(input[1], torch.Tensor)
         assert isinstance(input[2], ModelData)
         assert isinstance(input[3], bool)
 
@@ -102,9 +129,12 @@ class LlamaSequentialWrapper(torch.nn.Module):
 
         def decoder_forward():
             if input[-1]:
-                output = CheckpointRecomputeFunction(
-                    self.wrapper_module_.forward, *input[:-1]
-                )
+                checkpoint = CHECKPOINT_CLASS[
+                    input[2].checkpoint(
+                        self.wrapper_module_.layer_id_, self.wrapper_module_.checkpoint_
+                    )
+                ]
+                output = checkpoint(self.wrapper_module_.forward, *input[:-1])
                 set_backward_tracepoint(output.grad_fn, "b_checkpoint")
             else:
                 output = self.wrapper_module_.forward(*input[:-1])
@@ -118,8 +148,11 @@ class LlamaSequentialWrapper(torch.nn.Module):
 
         @nvtx_wrapper("f_output")
         def output_layer_forward():
-            output = self.wrapper_module_.forward(input[0])
-            set_backward_tracepoint(output.grad_fn, "b_output")
+            output_hidden = input[2].output_hidden_
+            output_index = input[2].output_index(input[0].shape[1])
+            output = self.wrapper_module_.forward(input[0], output_hidden, output_index)
+            if not output_hidden:
+                set_backward_tracepoint(output.grad_fn, "b_output")
             return (output,) + input[1:]
 
         forward_func_dict = {
@@ -156,6 +189,34 @@ class LlamaModel(LLMModel):
         self.pad_token_id_ = args.pad_token_id_
         self.eos_token_id_ = -1
 
+        self.checkpoint_planner_: Optional[CheckpointPlanner] = None
+        if args.checkpoint_budget_ is not None:
+            self.checkpoint_planner_ = CheckpointPlanner(
+                args.checkpoint_budget_ * (1 << 30)
+            )
+
+    def checkpoint_plan(
+        self, tokens: torch.Tensor, mask: Optional[torch.Tensor], input: ModelData
+    ) -> Optional[Dict[int, str]]:
+        # the per layer checkpoint by the memory budget, the first batch
+        #   profiles the decoders to calibrate the planner's cost
+        planner = self.checkpoint_planner_
+        if planner is None or not input.enable_checkpoint_ or not tokens.is_cuda:
+            return None
+
+        if not planner.profiled():
+            decoders = [
+                module.wrapper_module_
+                for module in self.seq_module_
+                if module.name() == "Decoder"
+            ]
+            with torch.no_grad():
+                hidden_states = self.seq_module_[0].wrapper_module_.forward(tokens)
+            planner.profile(decoders, hidden_states, mask, input)
+
+        batch_size, seq_len = tokens.shape
+        return planner.plan(batch_size * seq_len, batch_size, len(input.data_config_))
+
     @override
     def forward(self, input: ModelData) -> torch.Tensor:
         # train model or inference model: output is probs
@@ -163,7 +224,14 @@ class LlamaModel(LLMModel):
             input.batch_tokens_, dtype=torch.int64, device=self.device_
         )
 
-        mask = precompute_mask(tokens, self.n_heads_, self.device_, input.batch_mask_)
+        mask = precompute_mask(
+            tokens,
+            self.device_,
+            input.batch_mask_,
+            batch_positions=input.batch_positions_,
+        )
+
+        input.checkpoint_plan_ = self.checkpoint_plan(tokens, mask, input)
 
         if input.enable_checkpoint_:
             data = (tokens, mask, input, True)
@@ -175,6 +243,34 @@ class LlamaModel(LLMModel):
 
         return data[0]
 
+    @override
+    @torch.no_grad()
+    def decode(self, input: ModelData, kv_cache: KVCache) -> torch.Tensor:
+        # the incremental forward: the input has the new tokens of each row, the
+        #   k/v of them are appended to the kv_cache, and the attention reads
+        #   the cached tokens, so the output is the same as the full sequence
+        assert input.batch_positions_ is None, "the packed rows can not be decoded"
+        tokens = torch.tensor(
+            input.batch_tokens_, dtype=torch.int64, device=self.device_
+        )
+        batch_size, seq_len = tokens.shape
+
+        # the padding mask of all the keys: the cached and the new tokens
+        kv_cache.append_mask(input.batch_mask_)
+        mask = precompute_mask(
+            tokens.new_empty(batch_size, kv_cache.seq_len_ + seq_len),
+            self.device_,
+            kv_cache.batch_mask_,
+        )
+
+        input.kv_cache_ = kv_cache
+        data = (tokens, mask, input, False)
+        for seq_layer in self.seq_module_:
+            data = seq_layer.forward(data)
+        kv_cache.step(seq_len)
+
+        return data[0]
+
     @override
     @staticmethod
     def from_pretrained(
@@ -182,6 +278,10 @@ class LlamaModel(LLMModel):
         device: str,
         precision: str,
         partial_model_to_device: Optional[List[int]] = None,
+        fuse_linear: bool = False,
+        attention_backend: str = "auto",
+        checkpoint: str = "recompute",
+        checkpoint_budget: Optional[float] = None,
     ) -> LLMModel:
         # create the device map for parallelism
         def create_device_map() -> str | Dict[str, str]:
@@ -255,15 +355,24 @@ class LlamaModel(LLMModel):
             llama_args.pad_token_id_ = -1
         llama_args.device_ = device
         llama_args.dtype_ = llama_model.dtype
+        llama_args.attention_backend_ = attention_backend
+        if checkpoint not in CHECKPOINT_CLASS:
+            raise NotImplementedError(f"Checkpoint {checkpoint} not support.")
+        llama_args.checkpoint_ = checkpoint
+        llama_args.checkpoint_budget_ = checkpoint_budget
 
         # load model from pretrained large model
-        model = LlamaModel.convert_model_from_huggingface(llama_model, llama_args)
+        model = LlamaModel.convert_model_from_huggingface(
+            llama_model, llama_args, fuse_linear
+        )
 
         return model
 
     @staticmethod
     def convert_model_from_huggingface(
-        llama_model: AutoModelForCausalLM, llama_args: LLMModelArgs
+        llama_model: AutoModelForCausalLM,
+        llama_args: LLMModelArgs,
+        fuse_linear: bool = False,
     ):
         llama_model.requires_grad_(False)
 
@@ -281,7 +390,7 @@ class LlamaModel(LLMModel):
 
         for idx, target_layer in enumerate(llama_model.model.layers):
             decoder = Decoder(idx, llama_args)
-            decoder.from_pretrained(target_layer, llama_args.norm_eps_)
+            decoder.from_pretrained(target_layer, llama_args.norm_eps_, fuse_linear)
             seq_model.update({f"layer{idx}": LlamaSequentialWrapper(decoder)})
 
         seq_model.update(
@@ -332,3 +441,11 @@ class LlamaModel(LLMModel):
     @override
     def sequential(self) -> Sequential:
         return self.seq_module_
+
+    @override
+    def output_weight(self) -> torch.Tensor:
+        for module in self.seq_module_:
+            if module.name() != "OutputLayer":
+                continue
+            return module.wrapper_module_.lm_head_.weight
+        raise RuntimeError("The model has no output layer.")
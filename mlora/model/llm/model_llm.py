@@ -5,7 +5,7 @@ from typing import List, Optional
 import torch
 
 from mlora.model.args import LinearInfo, ModelData
-from mlora.model.modules import AdapterModel
+from mlora.model.modules import AdapterModel, KVCache
 
 
 class LLMModel(metaclass=ABCMeta):
@@ -25,8 +25,15 @@ class LLMModel(metaclass=ABCMeta):
         device: str,
         precision: str,
         partial_model_to_device: Optional[List[int]] = None,
+        fuse_linear: bool = False,
+        attention_backend: str = "auto",
+        checkpoint: str = "recompute",
+        checkpoint_budget: Optional[float] = None,
     ) -> "LLMModel": ...
 
+    @abstractmethod
+    def decode(self, input: ModelData, kv_cache: KVCache) -> torch.Tensor: ...
+
     @abstractmethod
     def load_adapter(self, adapter_model: AdapterModel): ...
 
@@ -38,3 +45,6 @@ class LLMModel(metaclass=ABCMeta):
 
     @abstractmethod
     def sequential(self) -> torch.nn.Sequential: ...
+
+    @abstractmethod
+    def output_weight(self) -> torch.Tensor: ...
@@ -28,6 +28,10 @@ def load_partial_model(args) -> LLMModel:
         device=args.device,
         precision=args.precision,
         partial_model_to_device=partial_model_to_device,
+        fuse_linear=args.fuse_linear,
+        attention_backend=args.attention_backend,
+        checkpoint=args.checkpoint,
+        checkpoint_budget=args.checkpoint_budget,
     )
 
 
@@ -37,6 +41,10 @@ def load_full_model(args) -> LLMModel:
         device=args.device,
         precision=args.precision,
         partial_model_to_device=None,
+        fuse_linear=args.fuse_linear,
+        attention_backend=args.attention_backend,
+        checkpoint=args.checkpoint,
+        checkpoint_budget=args.checkpoint_budget,
     )
 
 
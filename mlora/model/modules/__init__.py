@@ -1,28 +1,53 @@
 from .adapter import Adapter, AdapterModel
 from .attention import Attention
 from .decoder import Decoder
-from .dora import DoRA
+from .dora import DoRA, DoRAFunction
 from .embedding import Embedding
-from .linear import Linear
-from .lora import LoRA, LoRAFunction
+from .kv_cache import KVCache
+from .linear import Linear, LinearGroup
+from .lora import (
+    BatchLoRAFunction,
+    FusedLoRAFunction,
+    LoRA,
+    LoRABatchLayout,
+    LoRABucket,
+    LoRAFunction,
+)
 from .mlp import MLP
-from .output_layer import OutputLayer
-from .rms_norm import RMSNorm
-from .vera import VeRA, vera_shared_weight
+from .output_layer import (
+    LM_HEAD_CHUNK_SIZE,
+    LMHeadCrossEntropyFunction,
+    LMHeadLogProbFunction,
+    OutputLayer,
+)
+from .rms_norm import RMSNorm, RMSNormFunction
+from .vera import VeRA, VeRAFunction, vera_shared_weight
 
 __all__ = [
     "Embedding",
     "Linear",
+    "LinearGroup",
     "OutputLayer",
+    "LM_HEAD_CHUNK_SIZE",
+    "LMHeadCrossEntropyFunction",
+    "LMHeadLogProbFunction",
     "Adapter",
     "AdapterModel",
     "RMSNorm",
+    "RMSNormFunction",
     "LoRA",
     "VeRA",
+    "VeRAFunction",
     "vera_shared_weight",
     "DoRA",
+    "DoRAFunction",
     "LoRAFunction",
+    "BatchLoRAFunction",
+    "LoRABatchLayout",
+    "LoRABucket",
+    "FusedLoRAFunction",
     "Attention",
     "MLP",
     "Decoder",
+    "KVCache",
 ]
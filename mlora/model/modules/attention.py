@@ -1,15 +1,14 @@
-import math
 from collections import OrderedDict
 from typing import Dict, Optional, Tuple
 
 import torch
-import torch.nn.functional as F
 
 from mlora.model.args import LinearInfo, LLMModelArgs, ModelData
 from mlora.model.modules import AdapterModel
 from mlora.profiler import nvtx_range, set_backward_tracepoint
 
-from .linear import Linear
+from .attention_backend import ATTENTION_BACKEND, select_attention_backend
+from .linear import Linear, LinearGroup
 
 
 def rotate_half(x: torch.Tensor) -> torch.Tensor:
@@ -52,24 +51,55 @@ def precompute_rope_angle(
     return (emb.cos(), emb.sin())
 
 
-@torch.jit.script
-def scaled_dot_product_attention(
-    query: torch.Tensor,
-    key: torch.Tensor,
-    value: torch.Tensor,
-    attention_mask: Optional[torch.Tensor] = None,
-) -> torch.Tensor:
-    attention_score = torch.matmul(query, key.transpose(2, 3)) / math.sqrt(
-        query.size(-1)
-    )
-    if attention_mask is not None:
-        attention_score = attention_score + attention_mask
-    attention_score = F.softmax(attention_score, dim=-1, dtype=torch.float32).to(
-        value.dtype
-    )
-    attention_score = torch.matmul(attention_score, value)
-    attention_score = attention_score.transpose(1, 2).contiguous()
-    return attention_score
+class RoPECache:
+    # the rope angle of one (head_dim, theta, device, dtype) shared by all the
+    #   layers, the table grows to the longest sequence seen (not max_seq_len_)
+    #   and the views of each seq_len are kept, so the forward do not convert
+    #   or slice it again
+    cos_: torch.Tensor
+    sin_: torch.Tensor
+
+    def __init__(
+        self, head_dim: int, theta: float, device: torch.device, dtype: torch.dtype
+    ):
+        self.head_dim_ = head_dim
+        self.theta_ = theta
+        self.device_ = device
+        self.dtype_ = dtype
+
+        self.seq_len_ = 0
+        self.views_: Dict[int, Tuple[torch.Tensor, torch.Tensor]] = {}
+
+    def __grow(self, seq_len: int):
+        # grow to the power of two, so the table is rebuilt only a few times
+        self.seq_len_ = 1 << (seq_len - 1).bit_length()
+        cos, sin = precompute_rope_angle(
+            self.head_dim_, self.seq_len_, self.theta_, str(self.device_)
+        )
+        self.cos_ = cos.to(self.dtype_)
+        self.sin_ = sin.to(self.dtype_)
+        self.views_.clear()
+
+    def get(self, seq_len: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        if seq_len in self.views_:
+            return self.views_[seq_len]
+        if seq_len > self.seq_len_:
+            self.__grow(seq_len)
+        self.views_[seq_len] = (self.cos_[:seq_len], self.sin_[:seq_len])
+        return self.views_[seq_len]
+
+
+g_rope_cache: Dict[Tuple[int, float, torch.device, torch.dtype], RoPECache] = {}
+
+
+def rope_angle(
+    head_dim: int, seq_len: int, theta: float, device: torch.device, dtype: torch.dtype
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # cos(angle), sin(angle) of the seq_len positions
+    key = (head_dim, theta, device, dtype)
+    if key not in g_rope_cache:
+        g_rope_cache[key] = RoPECache(head_dim, theta, device, dtype)
+    return g_rope_cache[key].get(seq_len)
 
 
 class Attention(torch.nn.Module):
@@ -77,6 +107,8 @@ class Attention(torch.nn.Module):
     wk_: Linear
     wv_: Linear
     wo_: Linear
+    # the q/k/v share the same input
+    wqkv_: LinearGroup
 
     def __init__(self, layer_id: int, args: LLMModelArgs):
         super().__init__()
@@ -87,22 +119,24 @@ class Attention(torch.nn.Module):
         self.n_heads_ = args.n_heads_
         self.n_kv_heads_ = args.n_kv_heads_
         self.head_dim_ = args.dim_ // args.n_heads_
-        self.n_rep_ = self.n_heads_ // self.n_kv_heads_
-
-        # rope angle cos and sin
-        self.cos_, self.sin_ = precompute_rope_angle(
-            args.dim_ // args.n_heads_,
-            args.max_seq_len_,
-            args.rope_theta_,
-            args.device_,
+
+        # the rope angle cos and sin are shared by all the layers
+        self.rope_theta_ = args.rope_theta_
+
+        # the attention kernel, chosen by the device if it is auto
+        self.attention_backend_ = select_attention_backend(
+            args.attention_backend_, args.device_
         )
 
-    def forward(self, data: torch.Tensor, mask: torch.Tensor, input_args: ModelData):
+    def forward(
+        self, data: torch.Tensor, mask: Optional[torch.Tensor], input_args: ModelData
+    ):
         batch_size, max_seq_len, _ = data.shape
+        # the incremental decoding, the new tokens follow the cached tokens
+        kv_cache = input_args.kv_cache_
+        start_pos = 0 if kv_cache is None else kv_cache.seq_len_
 
-        xq = self.wq_.forward(data, input_args)
-        xk = self.wk_.forward(data, input_args)
-        xv = self.wv_.forward(data, input_args)
+        xq, xk, xv = self.wqkv_.forward(data, input_args)
 
         # conver shape to multi head
         # the shape is batch_size * number_of_head * seq_len * dim_of_head
@@ -118,8 +152,18 @@ class Attention(torch.nn.Module):
 
         # apply rotary embedding
         assert xq.dtype == xk.dtype
-        cos = self.cos_[:max_seq_len].to(xq.dtype)
-        sin = self.sin_[:max_seq_len].to(xq.dtype)
+        end_pos = start_pos + max_seq_len
+        cos, sin = rope_angle(
+            self.head_dim_, end_pos, self.rope_theta_, xq.device, xq.dtype
+        )
+        if start_pos > 0:
+            cos, sin = cos[start_pos:], sin[start_pos:]
+        # the packed rows restart the position at each document, the angle of
+        #   each token is: batch_size * 1 * seq_len * head_dim
+        position_ids = input_args.position_ids(xq.device)
+        if position_ids is not None:
+            cos = cos[position_ids].unsqueeze(1)
+            sin = sin[position_ids].unsqueeze(1)
 
         with nvtx_range("f_rotray_emb"):
             xq, xk = apply_rotary_emb(xq, xk, cos, sin)
@@ -127,29 +171,31 @@ class Attention(torch.nn.Module):
         set_backward_tracepoint(xq.grad_fn, "b_q_rope")
         set_backward_tracepoint(xk.grad_fn, "b_k_rope")
 
-        # for llama2 need to repeat the heads
-        # before dim: batch_size, n_kv_head, seq_len, head_dim
-        # after dim: batch_size, n_head, seq_len, head_dim
-        xk = repeat_kv(xk, self.n_rep_)
-        xv = repeat_kv(xv, self.n_rep_)
-
-        set_backward_tracepoint(xk.grad_fn, "b_k_rep")
-        set_backward_tracepoint(xv.grad_fn, "b_v_rep")
+        if kv_cache is not None:
+            xk, xv = kv_cache.update(self.layer_id_, xk, xv)
 
+        # for llama2 the kv heads are not repeated, the attention backend
+        #   computes each group of n_head // n_kv_head query heads with its
+        #   kv head, so the xk and xv keep: batch_size, n_kv_head, seq_len, head_dim
         # must align with xformers memory efficient attention
         with nvtx_range("f_attention"):
-            attention_score = scaled_dot_product_attention(xq, xk, xv, mask)
+            attention_score = ATTENTION_BACKEND[self.attention_backend_](
+                xq, xk, xv, mask
+            )
         attention_score = attention_score.view(batch_size, max_seq_len, -1)
         set_backward_tracepoint(attention_score.grad_fn, "b_attention")
 
         # get output attention score
         return self.wo_.forward(attention_score, input_args)
 
-    def from_pretrained(self, attn_layer: torch.nn.Module):
+    def from_pretrained(self, attn_layer: torch.nn.Module, fuse_linear: bool = False):
         self.wq_ = Linear(attn_layer.q_proj)
         self.wk_ = Linear(attn_layer.k_proj)
         self.wv_ = Linear(attn_layer.v_proj)
         self.wo_ = Linear(attn_layer.o_proj)
+        self.wqkv_ = LinearGroup([self.wq_, self.wk_, self.wv_])
+        if fuse_linear:
+            self.wqkv_.fuse_weight()
 
     @property
     def linear_dict(self) -> Dict[str, Linear]:
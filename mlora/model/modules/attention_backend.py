@@ -0,0 +1,199 @@
+import math
+from typing import Callable, Dict, Optional
+
+import torch
+import torch.nn.functional as F
+import torch.utils.checkpoint
+
+# the number of queries computed in one chunk by the chunked backend
+ATTENTION_CHUNK_SIZE = 512
+
+# the sdpa support the grouped kv heads since torch 2.5
+SDPA_ENABLE_GQA = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 5)
+# the enable_gqa is not in the signature of the older torch
+sdpa_gqa_kernel: Callable[..., torch.Tensor] = F.scaled_dot_product_attention
+
+
+@torch.jit.script
+def causal_mask(q_len: int, k_len: int, device: torch.device) -> torch.Tensor:
+    # the queries are the last q_len positions of the keys, True is masked
+    return torch.ones((q_len, k_len), dtype=torch.bool, device=device).triu(
+        k_len - q_len + 1
+    )
+
+
+# all the backends have the same input and output:
+#   query: batch_size * n_head * q_len * head_dim
+#   key, value: batch_size * n_kv_head * k_len * head_dim, each kv head is
+#     shared by n_head // n_kv_head query heads (not repeated)
+#   attention_mask: the padding mask broadcast to the score (None is no padding),
+#     batch_size * 1 * 1 * k_len, or the document mask of the packed rows,
+#     batch_size * 1 * q_len * k_len, the causal mask is always applied
+#   output: batch_size * q_len * n_head * head_dim
+@torch.jit.script
+def eager_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    batch_size, n_heads, q_len, head_dim = query.shape
+    n_kv_heads, k_len = key.size(1), key.size(2)
+
+    # fold the query heads of one kv head into the query length, so one
+    #   matmul with the kv head: batch_size * n_kv_head * (n_rep * q_len) * dim
+    query = query.reshape(batch_size, n_kv_heads, -1, head_dim)
+    attention_score = torch.matmul(query, key.transpose(2, 3)) / math.sqrt(head_dim)
+    # batch_size * n_kv_head * n_rep * q_len * k_len
+    attention_score = attention_score.view(batch_size, n_kv_heads, -1, q_len, k_len)
+    if attention_mask is not None:
+        attention_score = attention_score + attention_mask.unsqueeze(1)
+    attention_score.masked_fill_(causal_mask(q_len, k_len, query.device), float("-inf"))
+    attention_score = F.softmax(attention_score, dim=-1, dtype=torch.float32).to(
+        value.dtype
+    )
+    attention_score = torch.matmul(
+        attention_score.view(batch_size, n_kv_heads, -1, k_len), value
+    )
+    attention_score = attention_score.view(batch_size, n_heads, q_len, head_dim)
+    attention_score = attention_score.transpose(1, 2).contiguous()
+    return attention_score
+
+
+def sdpa_mask(
+    query: torch.Tensor, key: torch.Tensor, attention_mask: Optional[torch.Tensor]
+) -> torch.Tensor:
+    # merge the causal mask and the padding mask, the is_causal can not be
+    #   used with a mask, the merged mask is (batch_size or 1) * 1 * q_len * k_len
+    #   (not repeat for the heads)
+    min_value = torch.finfo(query.dtype).min
+    q_len, k_len = query.size(-2), key.size(-2)
+    if attention_mask is None:
+        attn_mask = query.new_zeros((1, 1, q_len, k_len))
+    else:
+        attn_mask = attention_mask.clamp(min=min_value).to(query.dtype)
+    return attn_mask.masked_fill(causal_mask(q_len, k_len, query.device), min_value)
+
+
+def sdpa_fold_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    # the sdpa without enable_gqa, fold the query heads of one kv head into the
+    #   query length like the eager backend, so the causal mask is repeated for
+    #   the folded query heads instead of the k/v
+    batch_size, n_heads, q_len, head_dim = query.shape
+    n_kv_heads, k_len = key.size(1), key.size(2)
+
+    attn_mask = sdpa_mask(query, key, attention_mask)
+    attn_mask = attn_mask.unsqueeze(2).expand(-1, -1, n_heads // n_kv_heads, -1, -1)
+    attn_mask = attn_mask.reshape(attn_mask.size(0), 1, -1, k_len)
+
+    output = F.scaled_dot_product_attention(
+        query.reshape(batch_size, n_kv_heads, -1, head_dim),
+        key,
+        value,
+        attn_mask=attn_mask,
+    )
+    output = output.view(batch_size, n_heads, q_len, head_dim)
+    return output.transpose(1, 2).contiguous()
+
+
+def sdpa_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    # torch picks the flash or memory-efficient kernel, the score matrix is
+    #   not materialized, the flash kernel only supports no padding mask
+    grouped = query.size(1) != key.size(1)
+    if grouped and not SDPA_ENABLE_GQA:
+        return sdpa_fold_attention(query, key, value, attention_mask)
+
+    # the is_causal aligns the queries to the first keys, so the queries after
+    #   the cached keys use the merged mask
+    is_causal = attention_mask is None and query.size(-2) == key.size(-2)
+    attn_mask = None if is_causal else sdpa_mask(query, key, attention_mask)
+    if grouped:
+        output = sdpa_gqa_kernel(
+            query, key, value, attn_mask=attn_mask, is_causal=is_causal, enable_gqa=True
+        )
+    else:
+        output = F.scaled_dot_product_attention(
+            query, key, value, attn_mask=attn_mask, is_causal=is_causal
+        )
+    return output.transpose(1, 2).contiguous()
+
+
+def eager_chunk_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor],
+) -> torch.Tensor:
+    # the checkpoint stops the recomputation by an exception, it can not pass
+    #   through the scripted function, so the early stop is disabled
+    with torch.utils.checkpoint.set_checkpoint_early_stop(False):
+        return torch.utils.checkpoint.checkpoint(
+            eager_attention, query, key, value, attention_mask, use_reentrant=False
+        )
+
+
+def chunked_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    # compute ATTENTION_CHUNK_SIZE queries each time, so the score is at most
+    #   chunk_size * k_len, one chunk only attends to the keys before its end,
+    #   the score of each chunk is recomputed in backward instead of saved
+    q_len, k_len = query.size(-2), key.size(-2)
+    if q_len <= ATTENTION_CHUNK_SIZE:
+        return eager_attention(query, key, value, attention_mask)
+
+    outputs = []
+    for start_idx in range(0, q_len, ATTENTION_CHUNK_SIZE):
+        end_idx = min(start_idx + ATTENTION_CHUNK_SIZE, q_len)
+        chunk_k_len = k_len - q_len + end_idx
+        chunk_mask = attention_mask
+        if chunk_mask is not None:
+            # the document mask has the queries, the padding mask do not
+            if chunk_mask.size(-2) > 1:
+                chunk_mask = chunk_mask[..., start_idx:end_idx, :]
+            chunk_mask = chunk_mask[..., :chunk_k_len]
+        chunk_args = (
+            query[..., start_idx:end_idx, :],
+            key[..., :chunk_k_len, :],
+            value[..., :chunk_k_len, :],
+            chunk_mask,
+        )
+        if torch.is_grad_enabled():
+            outputs.append(eager_chunk_attention(*chunk_args))
+        else:
+            outputs.append(eager_attention(*chunk_args))
+
+    return torch.cat(outputs, dim=1)
+
+
+AttentionBackend = Callable[
+    [torch.Tensor, torch.Tensor, torch.Tensor, Optional[torch.Tensor]], torch.Tensor
+]
+
+ATTENTION_BACKEND: Dict[str, AttentionBackend] = {
+    "eager": eager_attention,
+    "sdpa": sdpa_attention,
+    "chunked": chunked_attention,
+}
+
+
+def select_attention_backend(name: str, device: str) -> str:
+    # auto: the sdpa for the gpu, the chunked for the cpu
+    if name == "auto":
+        return "chunked" if torch.device(device).type == "cpu" else "sdpa"
+    if name not in ATTENTION_BACKEND:
+        raise NotImplementedError(f"Attention backend {name} not support.")
+    return name
@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from typing import Optional
 
 import torch
 
@@ -19,12 +20,17 @@ class Decoder(torch.nn.Module):
         super().__init__()
 
         self.layer_id_ = layer_id
+        # the CHECKPOINT_CLASS used by the sequential wrapper
+        self.checkpoint_ = args.checkpoint_
 
         self.attn_: Attention = Attention(layer_id, args)
         self.mlp_: MLP = MLP(layer_id)
 
     def forward(
-        self, hidden_states: torch.Tensor, mask: torch.Tensor, input_args: ModelData
+        self,
+        hidden_states: torch.Tensor,
+        mask: Optional[torch.Tensor],
+        input_args: ModelData,
     ):
         # Attention
         with nvtx_range("f_attention_norm"):
@@ -50,15 +56,19 @@ class Decoder(torch.nn.Module):
         return hidden_states
 
     def from_pretrained(
-        self, transformer_layer: torch.nn.Module, norm_eps: float
+        self,
+        transformer_layer: torch.nn.Module,
+        norm_eps: float,
+        fuse_linear: bool = False,
     ) -> None:
         self.mlp_norm_ = RMSNorm(
             transformer_layer.post_attention_layernorm.weight, norm_eps
         )
         self.attn_norm_ = RMSNorm(transformer_layer.input_layernorm.weight, norm_eps)
 
-        self.attn_.from_pretrained(transformer_layer.self_attn)
-        self.mlp_.from_pretrained(transformer_layer.mlp)
+        # fuse_linear: compute the q/k/v and gate/up by one gemm
+        self.attn_.from_pretrained(transformer_layer.self_attn, fuse_linear)
+        self.mlp_.from_pretrained(transformer_layer.mlp, fuse_linear)
 
     def load_adapter(self, adapter_model: AdapterModel):
         self.attn_.load_adapter(adapter_model)
@@ -1,9 +1,171 @@
 import math
-from typing import override
+from typing import Any, List, Optional, Tuple, override
 
 import torch
 
-from .lora import LoRA
+from mlora.model.args import ModelData
+
+from .lora import (
+    LoRA,
+    lora_compute_dtype,
+    lora_dropout,
+    lora_dropout_mask,
+    lora_dropout_seed,
+)
+
+# the number of rows to compute the weight norm in one block, so the dense
+#   out_dim * in_dim weight is never allocated
+DORA_NORM_BLOCK_SIZE = 1024
+
+
+class DoRAFunction(torch.autograd.Function):
+    # update the rows of each adapter in place:
+    #   result = result * (mag_norm_scale - 1)
+    #            + mag_norm_scale * (dropout(x) @ lora_a^T @ lora_b^T) * scaling
+    #   the mag_norm_scale is a constant (the weight norm is detached)
+    @staticmethod
+    def forward(
+        ctx,
+        result: torch.Tensor,
+        data: torch.Tensor,
+        input_args: ModelData,
+        dropouts: List[Optional[float]],
+        scalings: List[Optional[float]],
+        seeds: List[Optional[int]],
+        *args,
+    ):
+        # args: (lora_a, lora_b, mag_norm_scale) for each config
+        # the dora module is f32 precision by default, or its compute dtype
+        lora_as = [lora_a for lora_a in args[::3] if lora_a is not None]
+        data = data.to(lora_compute_dtype(lora_a.dtype for lora_a in lora_as))
+
+        save_inputs: Tuple[torch.Tensor | None, ...] = (data,)
+
+        for lora_a, lora_b, mag_norm_scale, lora_config, dropout, scaling, seed in zip(
+            args[::3],
+            args[1::3],
+            args[2::3],
+            input_args.data_config_,
+            dropouts,
+            scalings,
+            seeds,
+        ):
+            if lora_a is None:
+                save_inputs += (None, None, None, None)
+                continue
+
+            start_idx = lora_config.batch_start_idx_
+            end_idx = lora_config.batch_end_idx_
+
+            # drop_data shape is batch_size * seq_len * r
+            lora_data = lora_dropout(data[start_idx:end_idx], dropout, seed)
+            drop_data = lora_data @ lora_a.transpose(0, 1)
+            drop_data.mul_(scaling)
+            lora_data = (drop_data @ lora_b.transpose(0, 1)).mul_(mag_norm_scale)
+
+            # update the rows of this adapter in place
+            result_rows = result[start_idx:end_idx]
+            result_rows.mul_((mag_norm_scale - 1).to(result.dtype))
+            result_rows.add_(lora_data.to(result.dtype))
+
+            save_inputs += (lora_a, lora_b, mag_norm_scale, drop_data)
+
+        ctx.input_args = input_args
+        ctx.dropouts = dropouts
+        ctx.scalings = scalings
+        ctx.seeds = seeds
+        ctx.save_for_backward(*save_inputs)
+
+        return result
+
+    @staticmethod
+    def lora_backward(
+        grad_y: torch.Tensor,
+        lora_data: torch.Tensor,
+        lora_a: torch.Tensor,
+        lora_b: torch.Tensor,
+        drop_data: torch.Tensor,
+        coefficient: float,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        # grad_y is scaled by the mag_norm_scale, return grad of lora_a, lora_b
+        #   and the bstage (batch_size * seq_len * r) for the input's grad
+        bstage = grad_y @ lora_b
+        bstage *= coefficient
+
+        grad_a = torch.sum(bstage.transpose(1, 2) @ lora_data, dim=0)
+        grad_b = torch.sum(grad_y.transpose(1, 2) @ drop_data, dim=0)
+
+        return grad_a, grad_b, bstage
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        grad_output: torch.Tensor = grad_outputs[0]
+        grad_result: torch.Tensor | None = None
+        grad_data: torch.Tensor | None = None
+        grad_loras: Tuple[torch.Tensor | None, ...] = ()
+
+        data, *doras = ctx.saved_tensors
+
+        if ctx.needs_input_grad[0]:
+            grad_result = grad_output.clone()
+        if ctx.needs_input_grad[1]:
+            grad_data = torch.zeros_like(data)
+
+        # the dora module is fp32 precision by default, or its compute dtype
+        grad_y = grad_output.to(data.dtype)
+        for idx, lora_config, dropout, scaling, seed in zip(
+            range(0, len(doras), 4),
+            ctx.input_args.data_config_,
+            ctx.dropouts,
+            ctx.scalings,
+            ctx.seeds,
+        ):
+            lora_a, lora_b, mag_norm_scale, drop_data = doras[idx : idx + 4]
+            if lora_a is None:
+                grad_loras += (None, None, None)
+                continue
+
+            start_idx = lora_config.batch_start_idx_
+            end_idx = lora_config.batch_end_idx_
+
+            if grad_result is not None:
+                grad_rows = grad_result[start_idx:end_idx]
+                grad_rows.mul_((mag_norm_scale - 1).to(grad_rows.dtype))
+
+            # lora_data shape is batch_size * seq_len * in_dim
+            lora_data = data[start_idx:end_idx].to(lora_a.dtype)
+            keep_mask = None
+            if seed is not None and dropout > 0.0:
+                keep_mask = lora_dropout_mask(lora_data, dropout, seed)
+                lora_data = lora_data * keep_mask
+
+            grad_a, grad_b, bstage = DoRAFunction.lora_backward(
+                grad_y[start_idx:end_idx].to(lora_b.dtype) * mag_norm_scale,
+                lora_data,
+                lora_a,
+                lora_b,
+                drop_data,
+                scaling / (1 - dropout),
+            )
+            grad_loras += (grad_a, grad_b, None)
+
+            if grad_data is None:
+                continue
+
+            grad_x = bstage @ lora_a
+            if keep_mask is not None:
+                grad_x = grad_x * keep_mask
+            grad_data[start_idx:end_idx].add_(grad_x.to(grad_data.dtype))
+
+        return (
+            grad_result,
+            grad_data,
+            None,
+            None,
+            None,
+            None,
+            *grad_loras,
+        )
 
 
 class DoRA(LoRA):
@@ -20,8 +182,19 @@ class DoRA(LoRA):
         alpha: int,
         dropout: float,
         base_weight: torch.nn.Linear,
+        compute_dtype: torch.dtype = torch.float32,
+        recompute_dropout: bool = False,
     ):
-        super().__init__(adapter_name, in_dim, out_dim, r, alpha, dropout)
+        super().__init__(
+            adapter_name,
+            in_dim,
+            out_dim,
+            r,
+            alpha,
+            dropout,
+            compute_dtype,
+            recompute_dropout,
+        )
         self.adapter_type_ = "dora"
 
         # just refer the base weight, do not change it!!!
@@ -31,6 +204,18 @@ class DoRA(LoRA):
             size=(1, out_dim), device="cpu", requires_grad=False, dtype=torch.float32
         )
 
+        # the weight norm only changes when the lora weight changes, so cache it
+        #   and recompute it after the optimizer step
+        self.weight_norm_: Optional[torch.Tensor] = None
+
+    @override
+    def dropout_seed(self) -> Optional[int]:
+        # the DoRAFunction only computes the exact grad from the regenerated
+        #   dropout mask, so the seed is drawn even without recompute_dropout
+        if self.dropout_ == 0.0:
+            return None
+        return lora_dropout_seed()
+
     @override
     def init_weight(
         self, lora_a: torch.Tensor | None = None, lora_b: torch.Tensor | None = None
@@ -44,20 +229,38 @@ class DoRA(LoRA):
             if lora_b is not None:
                 self.lora_b_.copy_(lora_b)
 
+            self.invalidate_weight_norm()
             self.magnitude_.copy_(self.get_weight_norm())
 
+    def invalidate_weight_norm(self):
+        self.weight_norm_ = None
+
+    def compute_weight_norm(self) -> torch.Tensor:
+        # compute the norm block by block (rows of the weight), the dim of
+        #   each block is DORA_NORM_BLOCK_SIZE * in_dim
+        base_weight = self.base_weight_.weight
+        lora_a = self.lora_a_.to(base_weight.device)
+        lora_b = self.lora_b_.to(base_weight.device)
+        out_dim = lora_b.shape[0]
+
+        weight_norm = torch.empty(
+            out_dim, device=base_weight.device, dtype=lora_a.dtype
+        )
+        for start_idx in range(0, out_dim, DORA_NORM_BLOCK_SIZE):
+            end_idx = min(start_idx + DORA_NORM_BLOCK_SIZE, out_dim)
+            weight = self.scaling_ * (lora_b[start_idx:end_idx] @ lora_a)
+            weight += base_weight[start_idx:end_idx]
+            weight_norm[start_idx:end_idx] = torch.linalg.norm(weight, dim=1)
+
+        return weight_norm.to(self.lora_a_.device)
+
     def get_weight_norm(self) -> torch.Tensor:
         with torch.no_grad():
-            # the dim is out_dim * in_dim
-            lora_weight = self.scaling_ * (self.lora_b_ @ self.lora_a_)
-            weight = (
-                lora_weight.to(self.base_weight_.weight.device)
-                + self.base_weight_.weight
-            )
-            weight = weight.to(self.lora_a_.device)
-            weight_norm: torch.Tensor = torch.linalg.norm(weight, dim=1).to(
-                weight.dtype
-            )
+            if self.weight_norm_ is None:
+                self.weight_norm_ = self.compute_weight_norm()
+            elif self.weight_norm_.device != self.lora_a_.device:
+                self.weight_norm_ = self.weight_norm_.to(self.lora_a_.device)
+            weight_norm = self.weight_norm_
 
         assert weight_norm.requires_grad is False
         assert weight_norm.grad_fn is None
@@ -0,0 +1,56 @@
+from typing import Dict, List, Tuple
+
+import torch
+
+from mlora.model.args import Masks
+
+
+class KVCache:
+    # the key and value of each decoder layer for the incremental decoding,
+    #   the k/v of a row is computed with the row's adapter, so the rows keep
+    #   the same order and data config in all the steps
+    keys_: Dict[int, torch.Tensor]
+    values_: Dict[int, torch.Tensor]
+    # the padding mask of all the cached tokens: batch_size * seq_len_
+    batch_mask_: List[Masks]
+
+    def __init__(self, max_seq_len: int):
+        self.max_seq_len_ = max_seq_len
+        self.seq_len_ = 0
+
+        self.keys_ = {}
+        self.values_ = {}
+        self.batch_mask_ = []
+
+    def append_mask(self, batch_mask: List[Masks]):
+        if len(self.batch_mask_) == 0:
+            self.batch_mask_ = [list(masks) for masks in batch_mask]
+            return
+        assert len(batch_mask) == len(self.batch_mask_)
+        for cache_masks, masks in zip(self.batch_mask_, batch_mask):
+            cache_masks.extend(masks)
+
+    def update(
+        self, layer_id: int, key: torch.Tensor, value: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # key, value: batch_size * n_kv_head * q_len * head_dim, the buffer of
+        #   max_seq_len_ is allocated by the first step, return the k/v of all
+        #   the cached tokens and the new tokens
+        end_idx = self.seq_len_ + key.size(2)
+        assert end_idx <= self.max_seq_len_, "the kv cache is full"
+
+        if layer_id not in self.keys_:
+            shape = (key.size(0), key.size(1), self.max_seq_len_, key.size(3))
+            self.keys_[layer_id] = key.new_empty(shape)
+            self.values_[layer_id] = value.new_empty(shape)
+
+        cache_key = self.keys_[layer_id]
+        cache_value = self.values_[layer_id]
+        cache_key[:, :, self.seq_len_ : end_idx] = key
+        cache_value[:, :, self.seq_len_ : end_idx] = value
+
+        return cache_key[:, :, :end_idx], cache_value[:, :, :end_idx]
+
+    def step(self, n_tokens: int):
+        # all the layers cached the new tokens
+        self.seq_len_ += n_tokens
@@ -1,4 +1,4 @@
-from typing import Callable, List, MutableMapping, Optional, Tuple
+from typing import Callable, Dict, List, MutableMapping, Optional, Sequence, Set, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -13,9 +13,155 @@ else:
     from mlora.utils import Linear8bitLt, Linear4bit
 
 from .adapter import Adapter
-from .dora import DoRA
-from .lora import LoRA, LoRAFunction, get_range_tensor
-from .vera import VeRA
+from .dora import DoRA, DoRAFunction
+from .lora import (
+    BatchLoRAFunction,
+    FusedLoRAFunction,
+    LoRA,
+    LoRABatchLayout,
+    LoRABucket,
+    LoRAFunction,
+    lora_bucket_rank,
+    lora_compute_dtype,
+)
+from .vera import VeRA, VeRAFunction
+
+# the min number of adapters in one rank bucket to use the batched lora kernel
+BATCH_LORA_MIN_ADAPTERS = 2
+# the number of the adapter sets whose rank groups are cached by a linear
+LORA_GROUPS_CACHE_SIZE = 64
+
+# the bucket rank, the config indexes and the adapters of one rank bucket
+LoRAGroup = Tuple[int, List[int], List[LoRA]]
+
+
+def lora_layout(
+    input_args: ModelData, config_idx: List[int], device: torch.device
+) -> LoRABatchLayout:
+    # build once by the first linear of the batch
+    key = tuple(config_idx)
+    layout = input_args.lora_layouts_.get(key)
+    if layout is None:
+        configs = [input_args.data_config_[idx] for idx in config_idx]
+        layout = LoRABatchLayout(configs, device)
+        input_args.lora_layouts_[key] = layout
+    return layout
+
+
+class LinearDispatchPlan:
+    # the adapters of one linear for one batch, all the lists align with the
+    #   data_config_, so the forward does not look up and check the adapter
+    #   of each config again, the adapter is None if no kernel applies to it
+    lora_buckets_: List[LoRABucket]
+    loras_: List[Optional[LoRA]]
+    veras_: List[Optional[VeRA]]
+    doras_: List[Optional[DoRA]]
+
+    def __init__(
+        self,
+        lora_buckets: List[LoRABucket],
+        loras: List[Optional[LoRA]],
+        veras: List[Optional[VeRA]],
+        doras: List[Optional[DoRA]],
+    ):
+        self.lora_buckets_ = lora_buckets
+        self.loras_ = loras
+        self.veras_ = veras
+        self.doras_ = doras
+
+        self.lora_dropouts_, self.lora_scalings_ = adapter_args(loras)
+        self.vera_dropouts_, self.vera_scalings_ = adapter_args(veras)
+        self.dora_dropouts_, self.dora_scalings_ = adapter_args(doras)
+
+        # the vera weights are not casted, so the handles are fixed
+        self.vera_weights_: Tuple[torch.Tensor | None, ...] = ()
+        for vera in veras:
+            self.vera_weights_ += (
+                (None, None, None, None)
+                if vera is None
+                else (vera.lora_a_, vera.lora_b_, vera.d_vec_, vera.b_vec_)
+            )
+
+        self.has_lora_ = any(lora is not None for lora in loras)
+        self.has_vera_ = any(vera is not None for vera in veras)
+        self.has_dora_ = any(dora is not None for dora in doras)
+
+
+def adapter_args(
+    adapters: Sequence[Optional[LoRA | VeRA]],
+) -> Tuple[List[Optional[float]], List[Optional[float]]]:
+    dropouts = [None if adapter is None else adapter.dropout_ for adapter in adapters]
+    scalings = [None if adapter is None else adapter.scaling_ for adapter in adapters]
+    return dropouts, scalings
+
+
+def adapter_seeds(adapters: Sequence[Optional[LoRA]]) -> List[Optional[int]]:
+    # the seeds are drawn by each forward
+    return [None if adapter is None else adapter.dropout_seed() for adapter in adapters]
+
+
+def split_dropout_loras(
+    loras: List[Optional[LoRA]],
+) -> Tuple[List[Optional[LoRA]], List[Optional[LoRA]]]:
+    # the (fused, unfused) lora adapters, the adapter with the dropout is not
+    #   fused, the other list has None at its place
+    has_dropout = [lora is not None and lora.dropout_ > 0.0 for lora in loras]
+    return (
+        [None if dropout else lora for lora, dropout in zip(loras, has_dropout)],
+        [lora if dropout else None for lora, dropout in zip(loras, has_dropout)],
+    )
+
+
+class LinearGroupDispatchPlan:
+    # the fused lora adapters of the linear group for one batch, each config
+    #   has one target on each linear (None if it is computed by the batched
+    #   kernel, it has the dropout or it is not a trainable lora), the targets
+    #   of one config are the same adapter, so they have the same config
+    targets_: List[List[Optional[LoRA]]]
+    # the lora adapters with the dropout of each linear, the fused kernel
+    #   shares one dropout mask with all the targets, so they are computed by
+    #   each linear with its own mask, the same as the separate linears
+    unfused_: List[List[Optional[LoRA]]]
+    compute_dtype_: torch.dtype
+
+    def __init__(
+        self,
+        targets: List[List[Optional[LoRA]]],
+        unfused: List[List[Optional[LoRA]]],
+        compute_dtype: torch.dtype,
+    ):
+        self.targets_ = targets
+        self.unfused_ = unfused
+        self.compute_dtype_ = compute_dtype
+
+        self.unfused_args_ = [adapter_args(adapters) for adapters in unfused]
+        self.has_unfused_ = [
+            any(adapter is not None for adapter in adapters) for adapters in unfused
+        ]
+
+        self.adapters_: List[Optional[LoRA]] = [
+            next((target for target in config if target is not None), None)
+            for config in targets
+        ]
+        self.dropouts_, self.scalings_ = adapter_args(self.adapters_)
+        self.has_lora_ = any(adapter is not None for adapter in self.adapters_)
+
+    def lora_weights(self) -> Tuple[torch.Tensor | None, ...]:
+        # (lora_a of all the targets, lora_b of each target) for each config
+        loras: Tuple[torch.Tensor | None, ...] = ()
+        for adapter, targets in zip(self.adapters_, self.targets_):
+            if adapter is None:
+                loras += (None,) * (len(targets) + 1)
+                continue
+            weights = [
+                None if target is None else target.compute_weight()
+                for target in targets
+            ]
+            loras += (
+                torch.cat([weight[0] for weight in weights if weight is not None]),
+                *[None if weight is None else weight[1] for weight in weights],
+            )
+        return loras
 
 
 class Linear(torch.nn.Module):
@@ -34,6 +180,9 @@ class Linear(torch.nn.Module):
         self.device_ = weight.weight.device
         self.weight_ = weight
         self.adapters_: MutableMapping[str, Adapter] = {}
+        # the lora rank groups of the running adapters, keyed by the adapter
+        #   names of the batch's configs
+        self.lora_groups_: Dict[Tuple[str, ...], List[LoRAGroup]] = {}
 
     def forward(self, data: torch.Tensor, input_args: ModelData) -> torch.Tensor:
         # data shape is: batch_size * max_seq_len * dim
@@ -45,8 +194,15 @@ class Linear(torch.nn.Module):
             result = self.weight_.forward(data)
         set_backward_tracepoint(result.grad_fn, "b_linear")
 
+        result = self.__lora_forward(data, input_args, result)
+
+        return self.post_lora_forward(data, input_args, result)
+
+    def post_lora_forward(
+        self, data: torch.Tensor, input_args: ModelData, result: torch.Tensor
+    ) -> torch.Tensor:
+        # the adapters applied after the lora adapters
         adapter_func_list: List[Callable] = [
-            self.__lora_forward,
             self.__vera_forward,
             self.__dora_forward,
         ]
@@ -56,35 +212,150 @@ class Linear(torch.nn.Module):
 
         return result
 
-    def __lora_forward(
+    def trainable_lora(self, adapter_name: str) -> Optional[LoRA]:
+        adapter = self.adapters_.get(adapter_name)
+        if not isinstance(adapter, LoRA):
+            return None
+        # the frozen lora adapter will be skipped by the lora function
+        if not adapter.lora_a_.requires_grad:
+            return None
+        return adapter
+
+    def __build_lora_groups(self, input_args: ModelData) -> List[LoRAGroup]:
+        # put the lora adapters into the rank buckets, the bucket with more
+        #   than one adapter can be computed by the batched kernel
+        groups: Dict[Tuple[int, torch.dtype, bool], List[Tuple[int, LoRA]]] = {}
+
+        for idx, lora_config in enumerate(input_args.data_config_):
+            adapter = self.trainable_lora(lora_config.adapter_name_)
+            if adapter is None:
+                continue
+            key = (
+                lora_bucket_rank(adapter.r_),
+                adapter.compute_dtype_,
+                adapter.recompute_dropout_,
+            )
+            groups.setdefault(key, []).append((idx, adapter))
+
+        return [
+            (rank, [idx for idx, _ in group], [adapter for _, adapter in group])
+            for (rank, _, _), group in groups.items()
+            if len(group) >= BATCH_LORA_MIN_ADAPTERS
+        ]
+
+    def __lora_buckets(
+        self, input_args: ModelData, device: torch.device
+    ) -> List[LoRABucket]:
+        # the groups only change when the running adapters change, the rows
+        #   of each batch are laid out by the batch's LoRABatchLayout
+        key = tuple(config.adapter_name_ for config in input_args.data_config_)
+        groups = self.lora_groups_.get(key)
+        if groups is None:
+            if len(self.lora_groups_) >= LORA_GROUPS_CACHE_SIZE:
+                self.lora_groups_.clear()
+            groups = self.__build_lora_groups(input_args)
+            self.lora_groups_[key] = groups
+
+        return [
+            LoRABucket(
+                rank, config_idx, adapters, lora_layout(input_args, config_idx, device)
+            )
+            for rank, config_idx, adapters in groups
+        ]
+
+    def __build_dispatch_plan(
+        self, input_args: ModelData, device: torch.device
+    ) -> LinearDispatchPlan:
+        lora_buckets = self.__lora_buckets(input_args, device)
+        batched_idx = {idx for bucket in lora_buckets for idx in bucket.config_idx_}
+
+        adapter_names = [config.adapter_name_ for config in input_args.data_config_]
+        adapters = [self.adapters_.get(name) for name in adapter_names]
+
+        return LinearDispatchPlan(
+            lora_buckets,
+            [
+                None if idx in batched_idx else self.trainable_lora(name)
+                for idx, name in enumerate(adapter_names)
+            ],
+            [adapter if isinstance(adapter, VeRA) else None for adapter in adapters],
+            [adapter if isinstance(adapter, DoRA) else None for adapter in adapters],
+        )
+
+    def dispatch_plan(
+        self, input_args: ModelData, device: torch.device
+    ) -> LinearDispatchPlan:
+        # build once by the first forward of the batch
+        plan = input_args.dispatch_plan_.get(id(self))
+        if plan is None:
+            plan = self.__build_dispatch_plan(input_args, device)
+            input_args.dispatch_plan_[id(self)] = plan
+        return plan
+
+    def batch_lora_forward(
         self, data: torch.Tensor, input_args: ModelData, result: torch.Tensor
     ) -> torch.Tensor:
-        # split the data and result
-        dropouts: List[Optional[float]] = []
-        scalings: List[Optional[float]] = []
-        loras: Tuple[torch.Tensor | None, ...] = ()
-
-        for lora_config in input_args.data_config_:
-            adapter_name = lora_config.adapter_name_
+        for bucket in self.dispatch_plan(input_args, data.device).lora_buckets_:
+            lora_a, lora_b = bucket.lora_weight()
+
+            with nvtx_range("f_batch_lora"):
+                result = BatchLoRAFunction.apply(
+                    result,
+                    data,
+                    bucket.layout_,
+                    bucket.dropouts_,
+                    bucket.scalings_,
+                    bucket.dropout_seed(),
+                    lora_a,
+                    lora_b,
+                )
+            set_backward_tracepoint(result.grad_fn, "b_batch_lora")
 
-            if adapter_name not in self.adapters_ or not isinstance(
-                self.adapters_[adapter_name], LoRA
-            ):
-                loras += (None, None)
-                dropouts.append(None)
-                scalings.append(None)
-                continue
+        return result
 
-            loras += (
-                self.adapters_[adapter_name].lora_a_,
-                self.adapters_[adapter_name].lora_b_,
-            )
-            dropouts.append(self.adapters_[adapter_name].dropout_)
-            scalings.append(self.adapters_[adapter_name].scaling_)
+    def __lora_forward(
+        self, data: torch.Tensor, input_args: ModelData, result: torch.Tensor
+    ) -> torch.Tensor:
+        result = self.batch_lora_forward(data, input_args, result)
+
+        # all the adapters are computed by the batched kernel
+        plan = self.dispatch_plan(input_args, data.device)
+        if not plan.has_lora_:
+            return result
+
+        return self.loop_lora_forward(
+            data,
+            input_args,
+            result,
+            plan.loras_,
+            plan.lora_dropouts_,
+            plan.lora_scalings_,
+        )
+
+    def loop_lora_forward(
+        self,
+        data: torch.Tensor,
+        input_args: ModelData,
+        result: torch.Tensor,
+        adapters: List[Optional[LoRA]],
+        dropouts: List[Optional[float]],
+        scalings: List[Optional[float]],
+    ) -> torch.Tensor:
+        # the lora adapters of the configs computed one by one, the adapter is
+        #   None if the config is computed by the other kernels
+        loras: Tuple[torch.Tensor | None, ...] = ()
+        for adapter in adapters:
+            loras += (None, None) if adapter is None else adapter.compute_weight()
 
         with nvtx_range("f_lora"):
             result = LoRAFunction.apply(
-                result, data, input_args, dropouts, scalings, *loras
+                result,
+                data,
+                input_args,
+                dropouts,
+                scalings,
+                adapter_seeds(adapters),
+                *loras,
             )
         set_backward_tracepoint(result.grad_fn, "b_lora")
 
@@ -93,39 +364,19 @@ class Linear(torch.nn.Module):
     def __vera_forward(
         self, data: torch.Tensor, input_args: ModelData, result: torch.Tensor
     ) -> torch.Tensor:
-        lora_range = get_range_tensor(data.device, data.shape[0])
-
-        for lora_config in input_args.data_config_:
-            adapter_name = lora_config.adapter_name_
-
-            if adapter_name not in self.adapters_ or not isinstance(
-                self.adapters_[adapter_name], VeRA
-            ):
-                continue
-
-            adapter = self.adapters_[adapter_name]
-
-            start_idx = lora_config.batch_start_idx_
-            end_idx = lora_config.batch_end_idx_
-
-            with nvtx_range("f_vera"):
-                lora_data = F.dropout(
-                    data[start_idx:end_idx],
-                    p=adapter.dropout_,
-                    training=True,
-                    inplace=False,
-                )
-                lora_data = lora_data.mul(adapter.scaling_)
-                lora_data = lora_data @ adapter.lora_a_.transpose(0, 1)
-                lora_data = lora_data * adapter.d_vec_
-                lora_data = lora_data @ adapter.lora_b_.transpose(0, 1)
-                lora_data = lora_data * adapter.b_vec_
-                lora_data = lora_data.to(result.dtype)
-
-                result = result.index_add(
-                    dim=0, index=lora_range[start_idx:end_idx], source=lora_data
-                )
-
+        plan = self.dispatch_plan(input_args, data.device)
+        if not plan.has_vera_:
+            return result
+
+        with nvtx_range("f_vera"):
+            result = VeRAFunction.apply(
+                result,
+                data,
+                input_args,
+                plan.vera_dropouts_,
+                plan.vera_scalings_,
+                *plan.vera_weights_,
+            )
         set_backward_tracepoint(result.grad_fn, "b_vera")
 
         return result
@@ -133,43 +384,33 @@ class Linear(torch.nn.Module):
     def __dora_forward(
         self, data: torch.Tensor, input_args: ModelData, result: torch.Tensor
     ) -> torch.Tensor:
-        lora_range = get_range_tensor(data.device, data.shape[0])
-
-        for lora_config in input_args.data_config_:
-            adapter_name = lora_config.adapter_name_
-
-            if adapter_name not in self.adapters_ or not isinstance(
-                self.adapters_[adapter_name], DoRA
-            ):
+        plan = self.dispatch_plan(input_args, data.device)
+        if not plan.has_dora_:
+            return result
+
+        doras: Tuple[torch.Tensor | None, ...] = ()
+        for adapter in plan.doras_:
+            if adapter is None:
+                doras += (None, None, None)
                 continue
+            # the weight norm is cached until the optimizer step
+            weight_norm = adapter.get_weight_norm()
+            mag_norm_scale = (adapter.magnitude_ / weight_norm).view(1, -1)
+            doras += (
+                *adapter.compute_weight(),
+                mag_norm_scale.to(adapter.compute_dtype_),
+            )
 
-            adapter = self.adapters_[adapter_name]
-
-            start_idx = lora_config.batch_start_idx_
-            end_idx = lora_config.batch_end_idx_
-
-            with nvtx_range("f_dora"):
-                weight_norm = adapter.get_weight_norm()
-                mag_norm_scale = (adapter.magnitude_ / weight_norm).view(1, -1)
-
-                dora_data = F.dropout(
-                    data[start_idx:end_idx],
-                    p=adapter.dropout_,
-                    training=True,
-                    inplace=False,
-                )
-                lora_result = dora_data @ adapter.lora_a_.transpose(0, 1)
-                lora_result = lora_result @ adapter.lora_b_.transpose(0, 1)
-                lora_result = mag_norm_scale * lora_result * adapter.scaling_
-
-                base_result = (
-                    result[start_idx:end_idx] * (mag_norm_scale - 1) + lora_result
-                )
-
-                result = result.index_copy(
-                    dim=0, index=lora_range[start_idx:end_idx], source=base_result
-                )
-
+        with nvtx_range("f_dora"):
+            result = DoRAFunction.apply(
+                result,
+                data,
+                input_args,
+                plan.dora_dropouts_,
+                plan.dora_scalings_,
+                adapter_seeds(plan.doras_),
+                *doras,
+            )
         set_backward_tracepoint(result.grad_fn, "b_dora")
 
         return result
@@ -177,9 +418,163 @@ class Linear(torch.nn.Module):
     def load_adapter(self, adapter: Adapter):
         assert adapter.adapter_name_ not in self.adapters_
         self.adapters_[adapter.adapter_name_] = adapter
+        self.lora_groups_.clear()
 
     def offload_adapter(self, adapter_name: str):
         if adapter_name not in self.adapters_:
             return
 
         del self.adapters_[adapter_name]
+        self.lora_groups_.clear()
+
+
+def can_fuse_weight(weights: List[torch.nn.Module]) -> bool:
+    # the quantized or offloaded weight can not be fused
+    if not all(isinstance(weight, torch.nn.Linear) for weight in weights):
+        return False
+    if any(weight.weight.device.type == "meta" for weight in weights):
+        return False
+    if len({(weight.weight.device, weight.weight.dtype) for weight in weights}) > 1:
+        return False
+    return len({weight.bias is None for weight in weights}) == 1
+
+
+class LinearGroup(torch.nn.Module):
+    # the sibling linears share the same input, like q/k/v and gate/up, the
+    #   lora adapters on them are computed by the fused lora kernel
+    def __init__(self, linears: List[Linear]):
+        super().__init__()
+
+        self.linears_ = linears
+        self.out_dims_: List[int] = [linear.weight_.out_features for linear in linears]
+
+        # the concatenated frozen weight of all the linears, set by fuse_weight
+        self.weight_: Optional[torch.Tensor] = None
+        self.bias_: Optional[torch.Tensor] = None
+
+    def fuse_weight(self) -> bool:
+        # concatenate the frozen weights, so all the linears are computed by
+        #   one gemm, the weight of each linear becomes a view of it, so the
+        #   adapters still attach to (and refer) each linear
+        weights = [linear.weight_ for linear in self.linears_]
+        if not can_fuse_weight(weights):
+            return False
+
+        with torch.no_grad():
+            self.weight_ = torch.cat([weight.weight for weight in weights])
+            if weights[0].bias is not None:
+                self.bias_ = torch.cat([weight.bias for weight in weights])
+
+        for weight, out_slice in zip(weights, self.__out_slices()):
+            weight.weight = torch.nn.Parameter(
+                self.weight_[out_slice], requires_grad=False
+            )
+            if self.bias_ is not None:
+                weight.bias = torch.nn.Parameter(
+                    self.bias_[out_slice], requires_grad=False
+                )
+
+        return True
+
+    def __out_slices(self) -> List[slice]:
+        offsets = [0]
+        for out_dim in self.out_dims_:
+            offsets.append(offsets[-1] + out_dim)
+        return [slice(start, end) for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def __base_forward(self, data: torch.Tensor) -> List[torch.Tensor]:
+        if self.weight_ is None:
+            return [linear.weight_.forward(data) for linear in self.linears_]
+
+        # one gemm, and the result of each linear is a view of the output
+        result = F.linear(data, self.weight_, self.bias_)
+        return [result[..., out_slice] for out_slice in self.__out_slices()]
+
+    def forward(self, data: torch.Tensor, input_args: ModelData) -> List[torch.Tensor]:
+        if all(len(linear.adapters_) == 0 for linear in self.linears_):
+            return self.__base_forward(data)
+
+        with nvtx_range("f_linear"):
+            # the adapters update the result of each linear in place, so the
+            #   views of the fused weight's output get their own memory
+            results = [result.contiguous() for result in self.__base_forward(data)]
+        for result in results:
+            set_backward_tracepoint(result.grad_fn, "b_linear")
+
+        results = self.__lora_forward(data, input_args, results)
+
+        return [
+            linear.post_lora_forward(data, input_args, result)
+            for linear, result in zip(self.linears_, results)
+        ]
+
+    def __build_dispatch_plan(
+        self, input_args: ModelData, device: torch.device
+    ) -> LinearGroupDispatchPlan:
+        plans = [linear.dispatch_plan(input_args, device) for linear in self.linears_]
+
+        # share one input (fp32 or the adapters' compute dtype) with all the
+        #   lora kernels of the group
+        dtypes: Set[torch.dtype] = set()
+        for plan in plans:
+            dtypes.update(
+                lora.compute_dtype_ for lora in plan.loras_ if lora is not None
+            )
+            dtypes.update(
+                bucket.adapters_[0].compute_dtype_ for bucket in plan.lora_buckets_
+            )
+
+        fused, unfused = zip(*(split_dropout_loras(plan.loras_) for plan in plans))
+
+        return LinearGroupDispatchPlan(
+            [list(targets) for targets in zip(*fused)],
+            list(unfused),
+            lora_compute_dtype(dtypes),
+        )
+
+    def dispatch_plan(
+        self, input_args: ModelData, device: torch.device
+    ) -> LinearGroupDispatchPlan:
+        # build once by the first forward of the batch
+        plan = input_args.dispatch_plan_.get(id(self))
+        if plan is None:
+            plan = self.__build_dispatch_plan(input_args, device)
+            input_args.dispatch_plan_[id(self)] = plan
+        return plan
+
+    def __lora_forward(
+        self, data: torch.Tensor, input_args: ModelData, results: List[torch.Tensor]
+    ) -> List[torch.Tensor]:
+        plan = self.dispatch_plan(input_args, data.device)
+        data = data.to(plan.compute_dtype_)
+
+        for idx, linear in enumerate(self.linears_):
+            results[idx] = linear.batch_lora_forward(data, input_args, results[idx])
+            if plan.has_unfused_[idx]:
+                results[idx] = linear.loop_lora_forward(
+                    data,
+                    input_args,
+                    results[idx],
+                    plan.unfused_[idx],
+                    *plan.unfused_args_[idx],
+                )
+
+        # all the adapters are computed by the batched kernel
+        if not plan.has_lora_:
+            return results
+
+        with nvtx_range("f_fused_lora"):
+            outputs = FusedLoRAFunction.apply(
+                data,
+                input_args,
+                plan.dropouts_,
+                plan.scalings_,
+                adapter_seeds(plan.adapters_),
+                len(results),
+                *results,
+                *plan.lora_weights(),
+            )
+        for output in outputs:
+            set_backward_tracepoint(output.grad_fn, "b_fused_lora")
+
+        return list(outputs)
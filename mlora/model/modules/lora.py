@@ -1,28 +1,52 @@
 import math
-from typing import Any, Dict, List, Optional, Tuple, override
+from typing import Any, Iterable, List, Optional, Tuple, override
 
 import torch
 import torch.nn.functional as F
 
 from mlora.backends import MPSBackend, get_backend
-from mlora.model.args import ModelData
+from mlora.model.args import ModelData, ModelDataConfig
 
 from .adapter import Adapter
 
-g_cached_range_tensor: Dict[torch.device, torch.Tensor] = {}
-# also max batch size
-g_max_range = 1024
 
+def lora_compute_dtype(dtypes: Iterable[torch.dtype]) -> torch.dtype:
+    # the input is cast once to the widest compute dtype of the adapters
+    ret_dtype: Optional[torch.dtype] = None
+    for dtype in dtypes:
+        if ret_dtype is not None:
+            dtype = torch.promote_types(ret_dtype, dtype)
+        ret_dtype = dtype
+    return torch.float32 if ret_dtype is None else ret_dtype
+
+
+def lora_dropout_seed() -> int:
+    # draw the seed from the global cpu rng, so it follows the torch.manual_seed
+    #   and the rng state restored by the checkpoint recompute
+    return int(torch.randint(0, 2**31 - 1, (1,)).item())
+
+
+def lora_dropout_mask(
+    data: torch.Tensor, dropout: float | torch.Tensor, seed: int
+) -> torch.Tensor:
+    # the same seed always regenerate the same keep mask
+    generator = torch.Generator(device=data.device)
+    generator.manual_seed(seed)
+    keep_prob = torch.rand(
+        data.shape, generator=generator, device=data.device, dtype=torch.float32
+    )
+    return keep_prob >= dropout
 
-def get_range_tensor(device: torch.device, batch_size: int = 1024):
-    global g_cached_range_tensor
-    global g_max_range
-    if device not in g_cached_range_tensor or batch_size > g_max_range:
-        g_max_range = g_max_range if g_max_range > batch_size else batch_size
-        g_cached_range_tensor[device] = torch.arange(
-            0, g_max_range, step=1, device=device
-        )
-    return g_cached_range_tensor[device]
+
+def lora_dropout(
+    data: torch.Tensor, dropout: float, seed: Optional[int]
+) -> torch.Tensor:
+    # dropout == 0 return the data itself (a view), so do not change it in-place
+    if dropout == 0.0:
+        return data
+    if seed is None:
+        return F.dropout(data, p=dropout)
+    return data * lora_dropout_mask(data, dropout, seed) / (1 - dropout)
 
 
 class LoRAFunction(torch.autograd.Function):
@@ -34,49 +58,49 @@ class LoRAFunction(torch.autograd.Function):
         input_args: ModelData,
         dropouts: List[float],
         scalings: List[float],
+        seeds: List[Optional[int]],
         *args,
     ):
-        # the lora module is f32 precision
-        data = data.to(torch.float32)
+        # seeds: regenerate the dropout mask in backward from the seed, so the
+        #   grad is exact, None use the undropped data to compute the grad
+        # args: (lora_a, lora_b) of each config, the frozen adapter is None,
+        #   it is decided by the fp32 master weights (Linear.trainable_lora),
+        #   not by the casted weights, they do not require grad in no_grad
+
+        # the lora module is f32 precision by default, or its compute dtype
+        dtypes = [lora.dtype for lora in args if lora is not None]
+        data = data.to(lora_compute_dtype(dtypes))
 
         save_inputs: Tuple[torch.Tensor | None, ...] = (data,)
 
-        lora_range = get_range_tensor(data.device, data.shape[0])
-        for lora_a, lora_b, lora_config, dropout, scaling in zip(
-            args[::2], args[1::2], input_args.data_config_, dropouts, scalings
+        for lora_a, lora_b, lora_config, dropout, scaling, seed in zip(
+            args[::2], args[1::2], input_args.data_config_, dropouts, scalings, seeds
         ):
             assert not ((lora_a is None) ^ (lora_b is None))
             if lora_a is None and lora_b is None:
                 save_inputs += (None, None, None)
                 continue
 
-            assert not ((lora_a.requires_grad) ^ (lora_b.requires_grad))
-            if not lora_a.requires_grad and not lora_b.requires_grad:
-                save_inputs += (None, None, None)
-                continue
-
             start_idx = lora_config.batch_start_idx_
             end_idx = lora_config.batch_end_idx_
 
-            # must ensure the dropout is not zero
-            # is dropout == 0, dropdata is a data's referece
-            # so the data will be changed
-            assert dropout > 0.0
-
-            drop_data = F.dropout(data[start_idx:end_idx], p=dropout)
+            # scale the rank-r data, dropout == 0 do not copy the input
+            lora_data = data[start_idx:end_idx].to(lora_a.dtype)
+            drop_data = lora_dropout(lora_data, dropout, seed) @ lora_a.transpose(0, 1)
             drop_data.mul_(scaling)
-            drop_data = drop_data @ lora_a.transpose(0, 1)
             lora_data = drop_data @ lora_b.transpose(0, 1)
 
             lora_data = lora_data.to(result.dtype)
 
-            result.index_add_(0, lora_range[start_idx:end_idx], lora_data)
+            # the rows of one adapter are contiguous, add to the slice view
+            result[start_idx:end_idx].add_(lora_data)
 
             save_inputs += (lora_a, lora_b, drop_data)
 
         ctx.input_args = input_args
         ctx.dropouts = dropouts
         ctx.scalings = scalings
+        ctx.seeds = seeds
         ctx.save_for_backward(*save_inputs)
 
         return result
@@ -90,20 +114,10 @@ class LoRAFunction(torch.autograd.Function):
             return torch.empty_like(data)
 
     @staticmethod
-    def in_place_fill_grad_data(grad_data: Optional[torch.Tensor], index: torch.Tensor):
+    def in_place_fill_grad_data(grad_data: Optional[torch.Tensor], rows: slice):
         # mps use zero like, do not need to fill it again
         if grad_data is not None and not isinstance(get_backend(), MPSBackend):
-            grad_data.index_fill_(0, index, 0)
-
-    @staticmethod
-    def in_place_add_grad_data(
-        grad_data: torch.Tensor, index: torch.Tensor, grad_x: torch.Tensor
-    ):
-        # copy faster than add, but mps do not support copy
-        if isinstance(get_backend(), MPSBackend):
-            grad_data.index_add_(0, index, grad_x)
-        else:
-            grad_data.index_copy_(0, index, grad_x)
+            grad_data[rows].zero_()
 
     @staticmethod
     def backward(ctx: Any, *grad_outputs: Any) -> Any:
@@ -113,6 +127,7 @@ class LoRAFunction(torch.autograd.Function):
         grad_input_args = None
         grad_dropouts = None
         grad_scalings = None
+        grad_seeds = None
         grad_loras: Tuple[torch.Tensor | None, ...] = ()
 
         data, *loras = ctx.saved_tensors
@@ -122,17 +137,15 @@ class LoRAFunction(torch.autograd.Function):
         if ctx.needs_input_grad[1]:
             grad_data = LoRAFunction.init_grad_data(data)
 
-        # the lora module is fp32 precision
-        grad_output = grad_output.to(torch.float32)
-        lora_range = get_range_tensor(
-            grad_output.device, batch_size=grad_output.shape[0]
-        )
-        for lora_a, lora_b, drop_data, dropout, scaling, lora_config in zip(
+        # the lora module is fp32 precision by default, or its compute dtype
+        grad_output = grad_output.to(data.dtype)
+        for lora_a, lora_b, drop_data, dropout, scaling, seed, lora_config in zip(
             loras[::3],
             loras[1::3],
             loras[2::3],
             ctx.dropouts,
             ctx.scalings,
+            ctx.seeds,
             ctx.input_args.data_config_,
         ):
             start_idx = lora_config.batch_start_idx_
@@ -142,14 +155,18 @@ class LoRAFunction(torch.autograd.Function):
                 grad_loras += (None, None)
                 # mps do not supprt empty like, so we need fill it
                 LoRAFunction.in_place_fill_grad_data(
-                    grad_data, lora_range[start_idx:end_idx]
+                    grad_data, slice(start_idx, end_idx)
                 )
                 continue
 
             # lora_data shape is batch_size * seq_len * in_dim
-            lora_data = data[start_idx:end_idx]
+            lora_data = data[start_idx:end_idx].to(lora_a.dtype)
+            keep_mask = None
+            if seed is not None and dropout > 0.0:
+                keep_mask = lora_dropout_mask(lora_data, dropout, seed)
+                lora_data = lora_data * keep_mask
             # grad_y shape is batch_size * seq_len * out_dim
-            grad_y = grad_output[start_idx:end_idx]
+            grad_y = grad_output[start_idx:end_idx].to(lora_b.dtype)
 
             # bstage shape is batch_size * seq_len * r
             bstage = grad_y @ lora_b
@@ -162,9 +179,10 @@ class LoRAFunction(torch.autograd.Function):
             # grad_data shape is batch_size * seq_len * in_dim
             if grad_data is not None:
                 grad_x = bstage @ lora_a
-                LoRAFunction.in_place_add_grad_data(
-                    grad_data, lora_range[start_idx:end_idx], grad_x
-                )
+                if keep_mask is not None:
+                    grad_x = grad_x * keep_mask
+                # each row is written once, so copy to the slice view
+                grad_data[start_idx:end_idx].copy_(grad_x)
 
         return (
             grad_result,
@@ -172,6 +190,433 @@ class LoRAFunction(torch.autograd.Function):
             grad_input_args,
             grad_dropouts,
             grad_scalings,
+            grad_seeds,
+            *grad_loras,
+        )
+
+
+class LoRABatchLayout:
+    # the rows of the adapters in one batch group are packed into a
+    #   n_adapters * (max_rows * seq_len) layout, so the group can be
+    #   computed by one bmm, the short segment is padded with zero rows
+    n_adapters_: int
+    max_rows_: int
+
+    is_padded_: bool
+    is_contiguous_: bool
+
+    start_idx_: int
+    end_idx_: int
+
+    rows_: torch.Tensor
+    slots_: torch.Tensor
+
+    def __init__(self, configs: List[ModelDataConfig], device: torch.device):
+        seg_lens = [
+            config.batch_end_idx_ - config.batch_start_idx_ for config in configs
+        ]
+
+        self.n_adapters_ = len(configs)
+        self.max_rows_ = max(seg_lens)
+        self.is_padded_ = any(seg_len != self.max_rows_ for seg_len in seg_lens)
+
+        self.start_idx_ = configs[0].batch_start_idx_
+        self.end_idx_ = configs[-1].batch_end_idx_
+        self.is_contiguous_ = all(
+            prev.batch_end_idx_ == curr.batch_start_idx_
+            for prev, curr in zip(configs[:-1], configs[1:])
+        )
+
+        # the layout is shared by all the linears of the batch, so the index is
+        #   built only once
+        self.rows_ = torch.cat(
+            [
+                torch.arange(
+                    config.batch_start_idx_, config.batch_end_idx_, device=device
+                )
+                for config in configs
+            ]
+        )
+        self.slots_ = torch.cat(
+            [
+                torch.arange(
+                    idx * self.max_rows_, idx * self.max_rows_ + seg_len, device=device
+                )
+                for idx, seg_len in enumerate(seg_lens)
+            ]
+        )
+
+    def gather(self, data: torch.Tensor) -> torch.Tensor:
+        # data shape is batch_size * seq_len * dim
+        if self.is_contiguous_:
+            return data[self.start_idx_ : self.end_idx_]
+        return data.index_select(0, self.rows_)
+
+    def scatter_add(self, target: torch.Tensor, data: torch.Tensor) -> torch.Tensor:
+        # the inverse of gather, add the data to the rows of the target
+        if self.is_contiguous_:
+            return target[self.start_idx_ : self.end_idx_].add_(data)
+        return target.index_add_(0, self.rows_, data)
+
+    def pack(self, data: torch.Tensor) -> torch.Tensor:
+        # rows * seq_len * dim => n_adapters * (max_rows * seq_len) * dim
+        if self.is_padded_:
+            data = data.new_zeros(
+                (self.n_adapters_ * self.max_rows_, *data.shape[1:])
+            ).index_add_(0, self.slots_, data)
+        return data.contiguous().view(self.n_adapters_, -1, data.shape[-1])
+
+    def unpack(self, data: torch.Tensor, seq_len: int) -> torch.Tensor:
+        # n_adapters * (max_rows * seq_len) * dim => rows * seq_len * dim
+        data = data.view(self.n_adapters_ * self.max_rows_, seq_len, data.shape[-1])
+        if self.is_padded_:
+            data = data.index_select(0, self.slots_)
+        return data
+
+
+def lora_bucket_rank(r: int) -> int:
+    # the adapters are put into the bucket with the next power of two rank
+    return 1 << (r - 1).bit_length()
+
+
+class LoRABucket:
+    # the adapters in one bucket have different ranks, all of them are padded
+    #   to the bucket rank and computed by the batched kernel
+    rank_: int
+    config_idx_: List[int]
+    adapters_: List["LoRA"]
+    layout_: LoRABatchLayout
+
+    dropouts_: List[float]
+    scalings_: List[float]
+
+    def __init__(
+        self,
+        rank: int,
+        config_idx: List[int],
+        adapters: List["LoRA"],
+        layout: LoRABatchLayout,
+    ):
+        self.rank_ = rank
+        self.config_idx_ = config_idx
+        self.adapters_ = adapters
+        self.layout_ = layout
+
+        self.dropouts_ = [adapter.dropout_ for adapter in adapters]
+        self.scalings_ = [adapter.scaling_ for adapter in adapters]
+        # all the adapters in one bucket have the same recompute_dropout_
+        self.recompute_dropout_ = adapters[0].recompute_dropout_
+
+    def dropout_seed(self) -> Optional[int]:
+        if not self.recompute_dropout_ or all(p == 0.0 for p in self.dropouts_):
+            return None
+        return lora_dropout_seed()
+
+    def lora_weight(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        # the padded rank dims are zero, so they do not change the result
+        #   and the gradients (the pad's backward just drops them)
+        lora_as: List[torch.Tensor] = []
+        lora_bs: List[torch.Tensor] = []
+        for adapter in self.adapters_:
+            lora_a, lora_b = adapter.compute_weight()
+            lora_as.append(F.pad(lora_a, (0, 0, 0, self.rank_ - adapter.r_)))
+            lora_bs.append(F.pad(lora_b, (0, self.rank_ - adapter.r_)))
+        return torch.stack(lora_as), torch.stack(lora_bs)
+
+
+class BatchLoRAFunction(torch.autograd.Function):
+    # all the lora adapters in the bucket have the same rank, so their weights
+    #   can be stacked to lora_a: n_adapters * r * in_dim
+    #                     lora_b: n_adapters * out_dim * r
+    #   and computed by one batched matmul instead of one matmul per adapter
+    @staticmethod
+    def forward(
+        ctx,
+        result: torch.Tensor,
+        data: torch.Tensor,
+        layout: LoRABatchLayout,
+        dropouts: List[float],
+        scalings: List[float],
+        seed: Optional[int],
+        lora_a: torch.Tensor,
+        lora_b: torch.Tensor,
+    ):
+        # seed: regenerate the dropout mask in backward, see the LoRAFunction
+        # the lora module is f32 precision by default, or its compute dtype
+        data = data.to(lora_a.dtype)
+        seq_len = data.shape[1]
+
+        dropout = torch.tensor(dropouts, dtype=torch.float32, device=data.device)
+        dropout = dropout.view(-1, 1, 1)
+        scaling = torch.tensor(scalings, dtype=torch.float32, device=data.device)
+        scaling = scaling.view(-1, 1, 1)
+        coefficient = (scaling / (1 - dropout)).to(data.dtype)
+
+        # drop_data shape is n_adapters * (max_rows * seq_len) * in_dim
+        drop_data = layout.pack(layout.gather(data))
+        if any(p > 0.0 for p in dropouts):
+            if seed is None:
+                keep_mask = torch.rand_like(drop_data, dtype=torch.float32) >= dropout
+            else:
+                keep_mask = lora_dropout_mask(drop_data, dropout, seed)
+            drop_data = drop_data * keep_mask
+
+        # scale the rank-r data, dropout == 0 do not copy the input
+        # drop_data shape is n_adapters * (max_rows * seq_len) * r
+        drop_data = torch.bmm(drop_data, lora_a.transpose(1, 2))
+        drop_data *= coefficient
+        lora_data = torch.bmm(drop_data, lora_b.transpose(1, 2))
+
+        lora_data = layout.unpack(lora_data, seq_len).to(result.dtype)
+        layout.scatter_add(result, lora_data)
+
+        ctx.layout = layout
+        ctx.dropouts = dropouts
+        ctx.scalings = scalings
+        ctx.seed = seed
+        ctx.save_for_backward(data, lora_a, lora_b, drop_data)
+
+        return result
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        grad_output: torch.Tensor = grad_outputs[0]
+        grad_result = None
+        grad_data: torch.Tensor | None = None
+        grad_lora_a: torch.Tensor | None = None
+        grad_lora_b: torch.Tensor | None = None
+
+        data, lora_a, lora_b, drop_data = ctx.saved_tensors
+        layout: LoRABatchLayout = ctx.layout
+        seq_len = data.shape[1]
+
+        if ctx.needs_input_grad[0]:
+            grad_result = grad_output
+
+        coefficient = torch.tensor(
+            [
+                scaling / (1 - dropout)
+                for scaling, dropout in zip(ctx.scalings, ctx.dropouts)
+            ],
+            dtype=torch.float32,
+            device=data.device,
+        ).view(-1, 1, 1)
+        coefficient = coefficient.to(data.dtype)
+
+        # the lora module is fp32 precision by default, or its compute dtype
+        # grad_y shape is n_adapters * (max_rows * seq_len) * out_dim
+        grad_y = layout.pack(layout.gather(grad_output.to(data.dtype)))
+
+        # bstage shape is n_adapters * (max_rows * seq_len) * r
+        bstage = torch.bmm(grad_y, lora_b)
+        bstage *= coefficient
+
+        # lora_data shape is n_adapters * (max_rows * seq_len) * in_dim
+        lora_data = layout.pack(layout.gather(data))
+        keep_mask = None
+        if ctx.seed is not None and any(p > 0.0 for p in ctx.dropouts):
+            dropout = torch.tensor(ctx.dropouts, device=data.device).view(-1, 1, 1)
+            keep_mask = lora_dropout_mask(lora_data, dropout, ctx.seed)
+            lora_data = lora_data * keep_mask
+
+        if ctx.needs_input_grad[6]:
+            grad_lora_a = torch.bmm(bstage.transpose(1, 2), lora_data)
+
+        if ctx.needs_input_grad[7]:
+            grad_lora_b = torch.bmm(grad_y.transpose(1, 2), drop_data)
+
+        if ctx.needs_input_grad[1]:
+            # the rows not in this group have no gradient
+            grad_x = torch.bmm(bstage, lora_a)
+            if keep_mask is not None:
+                grad_x = grad_x * keep_mask
+            grad_x = layout.unpack(grad_x, seq_len)
+            grad_data = torch.zeros_like(data)
+            layout.scatter_add(grad_data, grad_x)
+
+        return (
+            grad_result,
+            grad_data,
+            None,
+            None,
+            None,
+            None,
+            grad_lora_a,
+            grad_lora_b,
+        )
+
+
+class FusedLoRAFunction(torch.autograd.Function):
+    # the sibling linears (like q/k/v or gate/up) share the same input, so the
+    #   lora_a of one adapter on all the targets can be concatenated to
+    #   lora_a: sum_r * in_dim, the input is upcast and saved only once,
+    #   drop_data @ lora_a is computed by one matmul and then split to
+    #   each target's lora_b, the targets share the dropout mask of the input,
+    #   so the LinearGroup only fuses the adapters without the dropout
+    @staticmethod
+    def forward(
+        ctx,
+        data: torch.Tensor,
+        input_args: ModelData,
+        dropouts: List[Optional[float]],
+        scalings: List[Optional[float]],
+        seeds: List[Optional[int]],
+        n_targets: int,
+        *args,
+    ):
+        # seeds: regenerate the dropout mask in backward, see the LoRAFunction
+        # args: n_targets results, then (lora_a, *lora_bs) for each config
+        results = args[:n_targets]
+        loras = args[n_targets:]
+        stride = n_targets + 1
+
+        # the lora module is f32 precision by default, or its compute dtype
+        lora_as = [lora_a for lora_a in loras[::stride] if lora_a is not None]
+        data = data.to(lora_compute_dtype(lora_a.dtype for lora_a in lora_as))
+
+        save_inputs: Tuple[torch.Tensor | None, ...] = (data,)
+
+        for idx, lora_config, dropout, scaling, seed in zip(
+            range(0, len(loras), stride),
+            input_args.data_config_,
+            dropouts,
+            scalings,
+            seeds,
+        ):
+            lora_a = loras[idx]
+            lora_bs = loras[idx + 1 : idx + stride]
+            if lora_a is None:
+                save_inputs += (None,) * (stride + 1)
+                continue
+            # the config with the lora_a always has its adapter's args
+            assert dropout is not None and scaling is not None
+
+            start_idx = lora_config.batch_start_idx_
+            end_idx = lora_config.batch_end_idx_
+
+            # scale the rank-r data, dropout == 0 do not copy the input
+            # drop_data shape is batch_size * seq_len * sum_r
+            lora_data = data[start_idx:end_idx].to(lora_a.dtype)
+            drop_data = lora_dropout(lora_data, dropout, seed) @ lora_a.transpose(0, 1)
+            drop_data.mul_(scaling)
+
+            for result, lora_b, r_slice in FusedLoRAFunction.split(lora_bs, results):
+                lora_data = drop_data[..., r_slice] @ lora_b.transpose(0, 1)
+                lora_data = lora_data.to(result.dtype)
+                result[start_idx:end_idx].add_(lora_data)
+
+            save_inputs += (lora_a, *lora_bs, drop_data)
+
+        ctx.input_args = input_args
+        ctx.dropouts = dropouts
+        ctx.scalings = scalings
+        ctx.seeds = seeds
+        ctx.n_targets = n_targets
+        ctx.save_for_backward(*save_inputs)
+
+        return results
+
+    @staticmethod
+    def split(lora_bs: Tuple[torch.Tensor | None, ...], targets: Tuple[Any, ...]):
+        # yield the target, its lora_b and its rank slice in the concatenated
+        #   lora_a, the targets without this adapter are skipped
+        offset = 0
+        for target, lora_b in zip(targets, lora_bs):
+            if lora_b is None:
+                continue
+            r = lora_b.shape[1]
+            yield target, lora_b, slice(offset, offset + r)
+            offset += r
+
+    @staticmethod
+    def targets_backward(
+        grad_ys: Tuple[torch.Tensor, ...],
+        lora_bs: Tuple[torch.Tensor | None, ...],
+        drop_data: torch.Tensor,
+    ) -> Tuple[List[torch.Tensor | None], torch.Tensor]:
+        # return the grad of each target's lora_b and the concatenated bstage
+        grad_bs: List[torch.Tensor | None] = [None] * len(lora_bs)
+        bstages: List[torch.Tensor] = []
+        for target, lora_b, r_slice in FusedLoRAFunction.split(
+            lora_bs, tuple(range(len(lora_bs)))
+        ):
+            # grad_y shape is batch_size * seq_len * out_dim
+            grad_y = grad_ys[target].to(lora_b.dtype)
+            grad_bs[target] = torch.sum(
+                grad_y.transpose(1, 2) @ drop_data[..., r_slice], dim=0
+            )
+            bstages.append(grad_y @ lora_b)
+
+        # bstage shape is batch_size * seq_len * sum_r
+        return grad_bs, torch.cat(bstages, dim=-1)
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        grad_data: torch.Tensor | None = None
+        grad_loras: Tuple[torch.Tensor | None, ...] = ()
+
+        data, *loras = ctx.saved_tensors
+        n_targets = ctx.n_targets
+        stride = n_targets + 2
+
+        grad_results = tuple(
+            grad_output if ctx.needs_input_grad[6 + idx] else None
+            for idx, grad_output in enumerate(grad_outputs)
+        )
+        if ctx.needs_input_grad[0]:
+            grad_data = torch.zeros_like(data)
+
+        # the lora module is fp32 precision by default, or its compute dtype
+        grad_ys = tuple(grad_output.to(data.dtype) for grad_output in grad_outputs)
+        for idx, lora_config, dropout, scaling, seed in zip(
+            range(0, len(loras), stride),
+            ctx.input_args.data_config_,
+            ctx.dropouts,
+            ctx.scalings,
+            ctx.seeds,
+        ):
+            lora_a = loras[idx]
+            lora_bs = tuple(loras[idx + 1 : idx + 1 + n_targets])
+            drop_data = loras[idx + 1 + n_targets]
+            if lora_a is None:
+                grad_loras += (None,) * (n_targets + 1)
+                continue
+
+            start_idx = lora_config.batch_start_idx_
+            end_idx = lora_config.batch_end_idx_
+
+            grad_bs, bstage = FusedLoRAFunction.targets_backward(
+                tuple(grad_y[start_idx:end_idx] for grad_y in grad_ys),
+                lora_bs,
+                drop_data,
+            )
+            bstage *= scaling / (1 - dropout)
+
+            lora_data = data[start_idx:end_idx].to(lora_a.dtype)
+            keep_mask = None
+            if seed is not None and dropout > 0.0:
+                keep_mask = lora_dropout_mask(lora_data, dropout, seed)
+                lora_data = lora_data * keep_mask
+
+            grad_a = torch.sum(bstage.transpose(1, 2) @ lora_data, dim=0)
+            grad_loras += (grad_a, *grad_bs)
+
+            # one matmul for the input's gradient of all the targets
+            if grad_data is not None:
+                grad_x = bstage @ lora_a
+                if keep_mask is not None:
+                    grad_x = grad_x * keep_mask
+                grad_x = grad_x.to(grad_data.dtype)
+                grad_data[start_idx:end_idx].add_(grad_x)
+
+        return (
+            grad_data,
+            None,
+            None,
+            None,
+            None,
+            None,
+            *grad_results,
             *grad_loras,
         )
 
@@ -184,6 +629,11 @@ class LoRA(Adapter):
     dropout_: float
     scaling_: float
 
+    # the dtype to compute the adapter, the lora_a and lora_b are always fp32
+    compute_dtype_: torch.dtype
+    # regenerate the dropout mask in backward from the rng seed
+    recompute_dropout_: bool
+
     def __init__(
         self,
         adapter_name: str,
@@ -192,6 +642,8 @@ class LoRA(Adapter):
         r: int,
         alpha: int,
         dropout: float,
+        compute_dtype: torch.dtype = torch.float32,
+        recompute_dropout: bool = False,
     ):
         super().__init__("lora", adapter_name)
 
@@ -205,6 +657,22 @@ class LoRA(Adapter):
         self.r_: int = r
         self.dropout_: float = dropout
         self.scaling_: float = alpha / r
+        self.compute_dtype_: torch.dtype = compute_dtype
+        self.recompute_dropout_: bool = recompute_dropout
+
+    def dropout_seed(self) -> Optional[int]:
+        # a new seed for each forward, None to use the saved dropout data
+        if not self.recompute_dropout_ or self.dropout_ == 0.0:
+            return None
+        return lora_dropout_seed()
+
+    def compute_weight(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        # the fp32 lora_a and lora_b are the master weights for the optimizer
+        #   and the checkpoint, the cast's backward accumulates the grad to them
+        return (
+            self.lora_a_.to(self.compute_dtype_),
+            self.lora_b_.to(self.compute_dtype_),
+        )
 
     def init_weight(
         self, lora_a: torch.Tensor | None = None, lora_b: torch.Tensor | None = None
@@ -8,13 +8,14 @@ from mlora.model.args import LinearInfo, ModelData
 from mlora.model.modules import AdapterModel
 from mlora.profiler import nvtx_range, set_backward_tracepoint
 
-from .linear import Linear
+from .linear import Linear, LinearGroup
 
 
 class MLP(torch.nn.Module):
     gate_: Linear  # also gate FNN * dim
     down_: Linear  # also down dim * FNN
     up_: Linear  # also up   FNN * dim
+    gate_up_: LinearGroup  # the gate and up share the same input
 
     def __init__(self, layer_id: int):
         super().__init__()
@@ -25,8 +26,7 @@ class MLP(torch.nn.Module):
     def forward(self, data: torch.Tensor, input_args: ModelData) -> torch.Tensor:
         # feed forward fully connected
         with nvtx_range("f_mlp"):
-            w1 = self.gate_.forward(data, input_args)
-            w3 = self.up_.forward(data, input_args)
+            w1, w3 = self.gate_up_.forward(data, input_args)
             # same as: data = data + w2_forward(F.silu(w1) * w3, input_args)
             w1_silu = F.silu(w1)
             mlp_output = w1_silu * w3
@@ -35,10 +35,15 @@ class MLP(torch.nn.Module):
 
         return mlp_output
 
-    def from_pretrained(self, mlp_layer: torch.nn.Module) -> None:
+    def from_pretrained(
+        self, mlp_layer: torch.nn.Module, fuse_linear: bool = False
+    ) -> None:
         self.gate_ = Linear(mlp_layer.gate_proj)
         self.down_ = Linear(mlp_layer.down_proj)
         self.up_ = Linear(mlp_layer.up_proj)
+        self.gate_up_ = LinearGroup([self.gate_, self.up_])
+        if fuse_linear:
+            self.gate_up_.fuse_weight()
 
     @property
     def linear_dict(self) -> Dict[str, Linear]:
@@ -1,7 +1,123 @@
+from typing import Any, List, Optional
+
 import torch
+import torch.nn.functional as F
 
 from mlora.model.args import LLMModelArgs
 
+# the number of tokens computed in one chunk by the fused lm_head and loss,
+#   only one chunk_size * vocab_size fp32 logits exists at the same time
+LM_HEAD_CHUNK_SIZE = 4096
+
+
+def lm_head_chunks(n_tokens: int):
+    for start_idx in range(0, n_tokens, LM_HEAD_CHUNK_SIZE):
+        yield start_idx, min(start_idx + LM_HEAD_CHUNK_SIZE, n_tokens)
+
+
+class LMHeadCrossEntropyFunction(torch.autograd.Function):
+    # the mean cross entropy of the lm_head's logits, like the
+    #   F.cross_entropy(F.linear(data, weight).float(), target), the grad of the
+    #   input is computed chunk by chunk in forward (softmax - one_hot) @ weight,
+    #   so the backward only scale it
+    @staticmethod
+    def forward(
+        ctx,
+        data: torch.Tensor,
+        weight: torch.Tensor,
+        target: torch.Tensor,
+        ignore_index: int = -100,
+    ):
+        # data shape is n_tokens * dim, target shape is n_tokens
+        valid = target != ignore_index
+        n_valid = valid.sum().clamp(min=1)
+        # the ignored token use 0 as the index, its loss and grad are masked
+        target = target.masked_fill(~valid, 0).unsqueeze(-1)
+
+        loss = torch.zeros((), dtype=torch.float32, device=data.device)
+        grad_data = torch.empty_like(data) if ctx.needs_input_grad[0] else None
+
+        for start_idx, end_idx in lm_head_chunks(data.shape[0]):
+            logits = F.linear(data[start_idx:end_idx], weight).float()
+            chunk_valid = valid[start_idx:end_idx].unsqueeze(-1)
+            chunk_target = target[start_idx:end_idx]
+
+            lse = torch.logsumexp(logits, dim=-1, keepdim=True)
+            chunk_loss = lse - torch.gather(logits, dim=-1, index=chunk_target)
+            loss += (chunk_loss * chunk_valid).sum()
+
+            if grad_data is None:
+                continue
+
+            # softmax - one_hot, in place on the logits
+            grad_logits = logits.sub_(lse).exp_()
+            grad_logits.scatter_add_(
+                -1, chunk_target, torch.full_like(lse, -1.0, dtype=logits.dtype)
+            )
+            grad_logits.mul_(chunk_valid)
+            grad_data[start_idx:end_idx] = grad_logits.to(weight.dtype) @ weight
+
+        if grad_data is not None:
+            grad_data.div_(n_valid.to(grad_data.dtype))
+        ctx.save_for_backward(grad_data)
+
+        return loss / n_valid
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        grad_output: torch.Tensor = grad_outputs[0]
+        (grad_data,) = ctx.saved_tensors
+
+        if grad_data is not None:
+            grad_data = grad_data * grad_output.to(grad_data.dtype)
+
+        return grad_data, None, None, None
+
+
+class LMHeadLogProbFunction(torch.autograd.Function):
+    # the log prob of the target token, like the
+    #   F.linear(data, weight).float().log_softmax(-1).gather(-1, target), only
+    #   save the input, the logits are recomputed chunk by chunk in backward
+    @staticmethod
+    def forward(ctx, data: torch.Tensor, weight: torch.Tensor, target: torch.Tensor):
+        # data shape is n_tokens * dim, target shape is n_tokens
+        target = target.unsqueeze(-1)
+        log_probs = torch.empty(
+            target.shape[0], dtype=torch.float32, device=data.device
+        )
+
+        for start_idx, end_idx in lm_head_chunks(data.shape[0]):
+            logits = F.linear(data[start_idx:end_idx], weight).float()
+            lse = torch.logsumexp(logits, dim=-1, keepdim=True)
+            chunk_log_probs = torch.gather(logits, -1, target[start_idx:end_idx]) - lse
+            log_probs[start_idx:end_idx] = chunk_log_probs.squeeze(-1)
+
+        ctx.save_for_backward(data, weight, target)
+
+        return log_probs
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        grad_output: torch.Tensor = grad_outputs[0]
+
+        if not ctx.needs_input_grad[0]:
+            return None, None, None
+
+        data, weight, target = ctx.saved_tensors
+
+        grad_data = torch.empty_like(data)
+        grad_y = grad_output.to(torch.float32).unsqueeze(-1)
+        for start_idx, end_idx in lm_head_chunks(data.shape[0]):
+            logits = F.linear(data[start_idx:end_idx], weight).float()
+            chunk_grad_y = grad_y[start_idx:end_idx]
+
+            # (one_hot - softmax) * grad_y, in place on the logits
+            grad_logits = logits.softmax(dim=-1).mul_(-chunk_grad_y)
+            grad_logits.scatter_add_(-1, target[start_idx:end_idx], chunk_grad_y)
+            grad_data[start_idx:end_idx] = grad_logits.to(weight.dtype) @ weight
+
+        return grad_data, None, None
+
 
 class OutputLayer(torch.nn.Module):
     def __init__(self, weight: torch.Tensor, args: LLMModelArgs):
@@ -21,5 +137,19 @@ class OutputLayer(torch.nn.Module):
                 self.lm_head_.weight.copy_(weight)
         self.lm_head_.requires_grad_(False)
 
-    def forward(self, data: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        data: torch.Tensor,
+        output_hidden: bool = False,
+        output_index: Optional[List[int]] = None,
+    ) -> torch.Tensor:
+        # output_hidden: the loss is computed with the lm_head weight by the
+        #   LMHead*Function chunk by chunk, so do not compute the full logits
+        if output_hidden:
+            return data
+        # output_index: only project the positions read by the loss, the output
+        #   is n_positions * vocab_size
+        if output_index is not None:
+            index = torch.tensor(output_index, dtype=torch.long, device=data.device)
+            data = data.flatten(0, 1).index_select(0, index)
         return self.lm_head_(data).float()
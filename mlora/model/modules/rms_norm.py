@@ -1,13 +1,57 @@
+from typing import Any
+
 import torch
 
 
+class RMSNormFunction(torch.autograd.Function):
+    # only save the input and the per-row inverse rms, the grad of the input:
+    #   grad_x = inv_rms * (gw - x_hat * mean(gw * x_hat))
+    #   where x_hat = x * inv_rms, gw = grad_y * weight
+    @staticmethod
+    def forward(ctx, data: torch.Tensor, weight: torch.Tensor, eps: float):
+        # the rms norm is computed in fp32
+        x = data.to(torch.float32)
+        inv_rms = torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + eps)
+
+        ctx.save_for_backward(data, weight, inv_rms)
+
+        return (weight * (x * inv_rms)).to(data.dtype)
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        grad_output: torch.Tensor = grad_outputs[0]
+        grad_data: torch.Tensor | None = None
+        grad_weight: torch.Tensor | None = None
+
+        data, weight, inv_rms = ctx.saved_tensors
+
+        grad_y = grad_output.to(torch.float32)
+        x_hat = data.to(torch.float32) * inv_rms
+
+        if ctx.needs_input_grad[0]:
+            gw = grad_y * weight
+            grad_x = gw - x_hat * (gw * x_hat).mean(-1, keepdim=True)
+            grad_data = (grad_x * inv_rms).to(data.dtype)
+
+        if ctx.needs_input_grad[1]:
+            grad_weight = (grad_y * x_hat).reshape(-1, x_hat.shape[-1]).sum(0)
+            grad_weight = grad_weight.to(weight.dtype)
+
+        return grad_data, grad_weight, None
+
+
 class RMSNorm(torch.nn.Module):
-    def __init__(self, weight: torch.Tensor, eps: float = 1e-6):
+    def __init__(self, weight: torch.Tensor, eps: float = 1e-6, fused: bool = True):
         super().__init__()
         self.norm_eps_ = eps
         self.weight_ = weight
+        # fused: compute by the RMSNormFunction, save less for backward
+        self.fused_ = fused
 
     def forward(self, data: torch.Tensor) -> torch.Tensor:
+        if self.fused_:
+            return RMSNormFunction.apply(data, self.weight_, self.norm_eps_)
+
         input_dtype = data.dtype
 
         v = data.to(torch.float32).pow(2).mean(-1, keepdim=True)
@@ -1,9 +1,12 @@
 import math
-from typing import Dict, List, Tuple, override
+from typing import Any, Dict, List, Optional, Tuple, override
 
 import torch
 
+from mlora.model.args import ModelData
+
 from .adapter import Adapter
+from .lora import lora_dropout, lora_dropout_mask, lora_dropout_seed
 
 # vera name, {q_proj: }
 SHARED_LORA_A: Dict[str, Dict[str, torch.Tensor]] = {}
@@ -22,6 +25,142 @@ def vera_shared_weight(
     )
 
 
+class VeRAFunction(torch.autograd.Function):
+    # result += ((dropout(x) * scaling) @ lora_a^T * d_vec) @ lora_b^T * b_vec
+    #   only the rank-r data (x @ lora_a^T) is saved, the out_dim data for
+    #   the b_vec's grad is recomputed in backward, and the dropout mask is
+    #   regenerated from the seed, so the grads are exact
+    @staticmethod
+    def forward(
+        ctx,
+        result: torch.Tensor,
+        data: torch.Tensor,
+        input_args: ModelData,
+        dropouts: List[Optional[float]],
+        scalings: List[Optional[float]],
+        *args,
+    ):
+        # args: (lora_a, lora_b, d_vec, b_vec) for each config
+        # the vera module is f32 precision
+        data = data.to(torch.float32)
+
+        save_inputs: Tuple[torch.Tensor | None, ...] = (data,)
+        seeds: List[Optional[int]] = []
+
+        for lora_a, lora_b, d_vec, b_vec, lora_config, dropout, scaling in zip(
+            args[::4],
+            args[1::4],
+            args[2::4],
+            args[3::4],
+            input_args.data_config_,
+            dropouts,
+            scalings,
+        ):
+            if lora_a is None:
+                save_inputs += (None, None, None, None, None)
+                seeds.append(None)
+                continue
+
+            start_idx = lora_config.batch_start_idx_
+            end_idx = lora_config.batch_end_idx_
+
+            seed = None if dropout == 0.0 else lora_dropout_seed()
+            seeds.append(seed)
+
+            # drop_data shape is batch_size * seq_len * r
+            drop_data = lora_dropout(data[start_idx:end_idx], dropout, seed)
+            drop_data = drop_data @ lora_a.transpose(0, 1)
+            drop_data.mul_(scaling)
+
+            lora_data = (drop_data * d_vec) @ lora_b.transpose(0, 1)
+            lora_data.mul_(b_vec)
+            result[start_idx:end_idx].add_(lora_data.to(result.dtype))
+
+            save_inputs += (lora_a, lora_b, d_vec, b_vec, drop_data)
+
+        ctx.input_args = input_args
+        ctx.dropouts = dropouts
+        ctx.scalings = scalings
+        ctx.seeds = seeds
+        ctx.save_for_backward(*save_inputs)
+
+        return result
+
+    @staticmethod
+    def vec_backward(
+        grad_y: torch.Tensor,
+        drop_data: torch.Tensor,
+        lora_b: torch.Tensor,
+        d_vec: torch.Tensor,
+        b_vec: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        # return the grad of d_vec, b_vec and drop_data
+        # recompute the out_dim data, it is cheaper than save it
+        lora_data = (drop_data * d_vec) @ lora_b.transpose(0, 1)
+        grad_b_vec = torch.sum(grad_y * lora_data, dim=(0, 1)).view(b_vec.shape)
+
+        # bstage shape is batch_size * seq_len * r
+        bstage = (grad_y * b_vec) @ lora_b
+        grad_d_vec = torch.sum(bstage * drop_data, dim=(0, 1)).view(d_vec.shape)
+
+        return grad_d_vec, grad_b_vec, bstage.mul_(d_vec)
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        grad_output: torch.Tensor = grad_outputs[0]
+        grad_result = None
+        grad_data: torch.Tensor | None = None
+        grad_vecs: Tuple[torch.Tensor | None, ...] = ()
+
+        data, *veras = ctx.saved_tensors
+
+        if ctx.needs_input_grad[0]:
+            grad_result = grad_output
+        if ctx.needs_input_grad[1]:
+            grad_data = torch.zeros_like(data)
+
+        # the vera module is fp32 precision
+        grad_output = grad_output.to(torch.float32)
+        for idx, lora_config, dropout, scaling, seed in zip(
+            range(0, len(veras), 5),
+            ctx.input_args.data_config_,
+            ctx.dropouts,
+            ctx.scalings,
+            ctx.seeds,
+        ):
+            lora_a, lora_b, d_vec, b_vec, drop_data = veras[idx : idx + 5]
+            if lora_a is None:
+                grad_vecs += (None, None, None, None)
+                continue
+
+            start_idx = lora_config.batch_start_idx_
+            end_idx = lora_config.batch_end_idx_
+
+            grad_d_vec, grad_b_vec, bstage = VeRAFunction.vec_backward(
+                grad_output[start_idx:end_idx], drop_data, lora_b, d_vec, b_vec
+            )
+            grad_vecs += (None, None, grad_d_vec, grad_b_vec)
+
+            if grad_data is None:
+                continue
+
+            # grad_x shape is batch_size * seq_len * in_dim
+            grad_x = (bstage @ lora_a).mul_(scaling)
+            if seed is not None:
+                keep_mask = lora_dropout_mask(grad_x, dropout, seed)
+                grad_x = grad_x * keep_mask / (1 - dropout)
+            grad_data[start_idx:end_idx].add_(grad_x)
+
+        return (
+            grad_result,
+            grad_data,
+            None,
+            None,
+            None,
+            *grad_vecs,
+        )
+
+
 class VeRA(Adapter):
     b_vec_: torch.Tensor
     d_vec_: torch.Tensor
@@ -39,6 +39,30 @@ def _add_base_cmd(parser):
         action=argparse.BooleanOptionalAction,
         help="Enable recompute to save memory",
     )
+    parser.add_argument(
+        "--fuse_linear",
+        action=argparse.BooleanOptionalAction,
+        help="Fuse the frozen q/k/v and gate/up weights to one gemm",
+    )
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        default="auto",
+        help="The attention kernel, support: auto, eager, sdpa, chunked",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default="recompute",
+        help="The activation checkpoint of the decoder, "
+        + "support: none, recompute, offload",
+    )
+    parser.add_argument(
+        "--checkpoint_budget",
+        type=float,
+        default=None,
+        help="The activation memory budget (GiB), plan the checkpoint of each layer",
+    )
     # configuration about log
     parser.add_argument(
         "--log_level", type=str, default="INFO", help="Set the log level."
@@ -0,0 +1,94 @@
+from mlora.model.llm.model_llama import precompute_mask
+from mlora.model.modules import attention_backend
+from mlora.model.modules.attention import repeat_kv
+from mlora.model.modules.attention_backend import ATTENTION_BACKEND
+
+import torch
+import unittest
+
+
+class TestAttentionBackend(unittest.TestCase):
+    query = torch.randn(2, 4, 16, 8, dtype=torch.float)
+    # grouped query attention, two query heads share one kv head
+    key = torch.randn(2, 2, 16, 8, dtype=torch.float)
+    value = torch.randn(2, 2, 16, 8, dtype=torch.float)
+
+    def padding_mask(self):
+        mask = torch.zeros(2, 1, 1, 16, dtype=torch.float)
+        mask[1, ..., :5] = torch.finfo(torch.float).min
+        return mask
+
+    def document_mask(self):
+        # the row 0 packs two documents: 6 and 10 tokens
+        positions = [list(range(6)) + list(range(10)), list(range(16))]
+        masks = [[False] * 16, [True] * 5 + [False] * 11]
+        tokens = torch.zeros(2, 16, dtype=torch.long)
+        return precompute_mask(tokens, "cpu", masks, batch_positions=positions)
+
+    def check_backend(self, name: str, mask):
+        outputs = []
+        grads = []
+        for backend in ["eager", name]:
+            query = self.query.clone().requires_grad_(True)
+            output = ATTENTION_BACKEND[backend](query, self.key, self.value, mask)
+            # the padding query's output is not used
+            output[1, :5] = 0
+            output.sum().backward()
+            outputs.append(output)
+            grads.append(query.grad)
+
+        assert torch.allclose(outputs[0], outputs[1], 1e-4, 1e-4)
+        assert torch.allclose(grads[0], grads[1], 1e-4, 1e-4)
+
+    def test_gqa(self):
+        mask = self.padding_mask()
+        output = ATTENTION_BACKEND["eager"](self.query, self.key, self.value, mask)
+        repeat_output = ATTENTION_BACKEND["eager"](
+            self.query, repeat_kv(self.key, 2), repeat_kv(self.value, 2), mask
+        )
+        assert torch.allclose(output[0], repeat_output[0], 1e-4, 1e-4)
+        assert torch.allclose(output[1, 5:], repeat_output[1, 5:], 1e-4, 1e-4)
+
+    def test_document_mask(self):
+        output = ATTENTION_BACKEND["eager"](
+            self.query, self.key, self.value, self.document_mask()
+        )
+        # the second document attends to itself only
+        doc_output = ATTENTION_BACKEND["eager"](
+            self.query[:1, :, 6:], self.key[:1, :, 6:], self.value[:1, :, 6:]
+        )
+        assert torch.allclose(output[:1, 6:], doc_output, 1e-4, 1e-4)
+
+        self.check_backend("sdpa", self.document_mask())
+        chunk_size = attention_backend.ATTENTION_CHUNK_SIZE
+        attention_backend.ATTENTION_CHUNK_SIZE = 6
+        try:
+            self.check_backend("chunked", self.document_mask())
+        finally:
+            attention_backend.ATTENTION_CHUNK_SIZE = chunk_size
+
+    def test_sdpa(self):
+        self.check_backend("sdpa", None)
+        self.check_backend("sdpa", self.padding_mask())
+
+    def test_sdpa_fold(self):
+        enable_gqa = attention_backend.SDPA_ENABLE_GQA
+        attention_backend.SDPA_ENABLE_GQA = False
+        try:
+            self.check_backend("sdpa", None)
+            self.check_backend("sdpa", self.padding_mask())
+        finally:
+            attention_backend.SDPA_ENABLE_GQA = enable_gqa
+
+    def test_chunked(self):
+        chunk_size = attention_backend.ATTENTION_CHUNK_SIZE
+        attention_backend.ATTENTION_CHUNK_SIZE = 6
+        try:
+            self.check_backend("chunked", None)
+            self.check_backend("chunked", self.padding_mask())
+        finally:
+            attention_backend.ATTENTION_CHUNK_SIZE = chunk_size
+
+
+if __name__ == "__main__":
+    unittest.main()
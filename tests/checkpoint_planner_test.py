@@ -0,0 +1,55 @@
+from mlora.model.checkpoint import CheckpointPlanner, LayerCost
+from mlora.model.checkpoint.planner import fit_linear_cost
+
+import unittest
+
+
+class TestCheckpointPlanner(unittest.TestCase):
+    def planner(self, budget: float, copy_time: float) -> CheckpointPlanner:
+        # four layers, each keeps 100 bytes per token and its output is 10 bytes
+        planner = CheckpointPlanner(budget)
+        for layer_id in range(4):
+            planner.costs_[layer_id] = LayerCost(
+                keep_bytes_=(100.0, 0.0),
+                hidden_bytes_=10.0,
+                forward_time_=(1.0, 0.0),
+                copy_time_=copy_time,
+            )
+        return planner
+
+    def test_keep(self):
+        planner = self.planner(1000, 1.0)
+        plan = planner.plan(1, 1, 1)
+        assert list(plan.values()) == ["none"] * 4
+        assert planner.memory(plan, 1, 1) == 400
+
+    def test_recompute(self):
+        # the offload copy is slow, recompute the first layers, the last layer's
+        #   backward still needs the layers before it
+        planner = self.planner(250, 1.0)
+        plan = planner.plan(1, 1, 1)
+        assert list(plan.values()) == ["recompute", "recompute", "none", "none"]
+        assert planner.memory(plan, 1, 1) == 220
+
+    def test_offload(self):
+        # the offload copy is hidden by the compute, so it costs nothing
+        planner = self.planner(250, 0.001)
+        plan = planner.plan(1, 1, 1)
+        assert list(plan.values()) == ["offload", "offload", "none", "none"]
+        assert planner.extra_time(plan, 1, 1) == 0
+
+    def test_over_budget(self):
+        # no plan fits, stop at the least memory: the last layer's backward
+        #   needs its activations, so it is kept
+        planner = self.planner(0, 1.0)
+        plan = planner.plan(1, 1, 1)
+        assert plan[3] == "none"
+        assert planner.memory(plan, 1, 1) == 120
+
+    def test_fit_linear_cost(self):
+        # 3 bytes per token and 8 bytes per adapter with 2 adapters
+        assert fit_linear_cost(3 * 64 + 16, 3 * 32 + 16, (64, 32), 2) == (3.0, 8.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+from mlora.config.dispatcher import DispatcherConfig
+from mlora.executor.dispatcher.dispatcher import Dispatcher, length_groups
+
+import unittest
+
+
+class TestLengthGroups(unittest.TestCase):
+    def test_one_group(self):
+        assert length_groups([2, 4, 1], [256, 4096, 512], 1) == [0, 0, 0]
+
+    def test_split_long_task(self):
+        # the long task runs alone, the short tasks are padded to 512
+        assert length_groups([2, 4, 1], [256, 4096, 512], 2) == [0, 1, 0]
+
+    def test_no_useless_split(self):
+        assert length_groups([2, 2], [256, 256], 4) == [0, 0]
+
+
+class TestDispatcherData(unittest.TestCase):
+    def test_no_running_task(self):
+        # no task to run, both the single and the micro batch path get no data
+        for micro_batch_num in ["1", "2"]:
+            dispatcher = Dispatcher(
+                DispatcherConfig(
+                    {
+                        "name": "default",
+                        "concurrency_num": "2",
+                        "micro_batch_num": micro_batch_num,
+                    }
+                )
+            )
+            assert dispatcher.data() is None
+            assert dispatcher.micro_batches_ == []
+
+
+if __name__ == "__main__":
+    unittest.main()
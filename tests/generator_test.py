@@ -0,0 +1,30 @@
+from mlora.model.generator import sample_tokens
+
+import torch
+import unittest
+
+
+class TestSampleTokens(unittest.TestCase):
+    logits = torch.tensor([[0.0, 3.0, 2.0, 1.0], [4.0, 0.0, 1.0, 3.9]])
+
+    def test_greedy(self):
+        assert sample_tokens(self.logits, temperature=0).tolist() == [1, 0]
+        # only the most likely token is kept
+        assert sample_tokens(self.logits, top_k=1).tolist() == [1, 0]
+        assert sample_tokens(self.logits, top_p=0.01).tolist() == [1, 0]
+
+    def test_top_k(self):
+        logits = self.logits.repeat(64, 1)
+        tokens = sample_tokens(logits, top_k=2).view(64, 2)
+        assert set(tokens[:, 0].tolist()) <= {1, 2}
+        assert set(tokens[:, 1].tolist()) <= {0, 3}
+
+    def test_top_p(self):
+        # the row 1's two tokens cover 0.9, the others are dropped
+        logits = self.logits.repeat(64, 1)
+        tokens = sample_tokens(logits, top_p=0.9).view(64, 2)
+        assert set(tokens[:, 1].tolist()) <= {0, 3}
+
+
+if __name__ == "__main__":
+    unittest.main()
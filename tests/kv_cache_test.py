@@ -0,0 +1,124 @@
+from mlora.model.args import (
+    LLMModelArgs,
+    MLoRAData,
+    MLoRADataConfig,
+    ModelData,
+    ModelDataConfig,
+)
+from mlora.model.llm import LlamaModel
+from mlora.model.modules import KVCache, LoRA
+
+import torch
+import unittest
+from typing import List
+from transformers import LlamaConfig, LlamaForCausalLM
+
+
+def create_model(compute_dtype: torch.dtype, ranks: List[int]) -> LlamaModel:
+    torch.manual_seed(42)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    args = LLMModelArgs(config)
+    args.pad_token_id_ = 0
+    args.device_ = "cpu"
+    model = LlamaModel.convert_model_from_huggingface(LlamaForCausalLM(config), args)
+
+    # each row has its own adapter, so the k/v of the rows are different
+    for adapter_name, r in zip(["a", "b"], ranks):
+        adapter_model = {}
+        for name, info in model.linears_info().items():
+            lora = LoRA(
+                adapter_name, info.in_dim_, info.out_dim_, r, 8, 0.0, compute_dtype
+            )
+            with torch.no_grad():
+                lora.lora_a_.normal_()
+                lora.lora_b_.normal_()
+            adapter_model[name] = lora
+        model.load_adapter(adapter_model)
+    return model
+
+
+class TestKVCache(unittest.TestCase):
+    def setUp(self):
+        self.model_ = create_model(torch.float32, [4, 4])
+
+        self.tokens_ = torch.randint(1, 64, (2, 9)).tolist()
+        # the row 1 is padded on the left
+        self.masks_ = [[False] * 9, [True] * 2 + [False] * 7]
+
+    def model_data(self, start_idx: int, end_idx: int) -> ModelData:
+        return ModelData(
+            batch_tokens_=[tokens[start_idx:end_idx] for tokens in self.tokens_],
+            batch_mask_=[masks[start_idx:end_idx] for masks in self.masks_],
+            data_config_=[
+                ModelDataConfig("a", "lora", 0, 1),
+                ModelDataConfig("b", "lora", 1, 2),
+            ],
+            enable_checkpoint_=False,
+            random_id_=start_idx,
+            task_name_=["a", "b"],
+        )
+
+    def test_decode(self):
+        with torch.no_grad():
+            logits = self.model_.forward(self.model_data(0, 9))
+
+        # the prompt is 6 tokens, then decode one token each step
+        kv_cache = KVCache(16)
+        prompt_logits = self.model_.decode(self.model_data(0, 6), kv_cache)
+        assert torch.allclose(prompt_logits, logits[:, :6], 1e-4, 1e-4)
+
+        for idx in range(6, 9):
+            step_logits = self.model_.decode(self.model_data(idx, idx + 1), kv_cache)
+            assert kv_cache.seq_len_ == idx + 1
+            assert torch.allclose(step_logits[:, 0], logits[:, idx], 1e-4, 1e-4)
+
+    def test_decode_bf16(self):
+        # the generation (no grad) uses the adapters of all the linears, same
+        #   as the training forward, the different ranks are not batched
+        self.model_ = create_model(torch.bfloat16, [4, 8])
+        logits = self.model_.forward(self.model_data(0, 9)).detach()
+
+        kv_cache = KVCache(16)
+        prompt_logits = self.model_.decode(self.model_data(0, 6), kv_cache)
+        assert torch.allclose(prompt_logits, logits[:, :6], 1e-2, 1e-2)
+
+        for idx in range(6, 9):
+            step_logits = self.model_.decode(self.model_data(idx, idx + 1), kv_cache)
+            assert torch.allclose(step_logits[:, 0], logits[:, idx], 1e-2, 1e-2)
+
+
+class TestSplitGrad(unittest.TestCase):
+    def test_split_grad_bf16(self):
+        # the rows without grad are forwarded under no_grad, the low precision
+        #   adapters give the same output as the forward with grad
+        model = create_model(torch.bfloat16, [4, 8])
+        configs = [
+            MLoRADataConfig("a", "lora", 0, 2, None, None, "a"),
+            MLoRADataConfig("b", "lora", 2, 3, None, None, "b", requires_grad=False),
+            MLoRADataConfig("a", "lora", 3, 4, None, None, "a"),
+        ]
+        tokens = torch.randint(1, 64, (4, 8)).tolist()
+        data = MLoRAData(tokens, [[False] * 8] * 4, configs)
+
+        # the reference keeps the autograd graph of all the layers
+        ref_data = data.model_data()
+        ref_data.enable_checkpoint_ = False
+        ref_output = model.forward(ref_data).detach()
+
+        with torch.no_grad():
+            no_grad_output = model.forward(data.split_grad(False).model_data())
+        grad_output = model.forward(data.split_grad(True).model_data())
+        output = data.merge_output(grad_output, no_grad_output).detach()
+
+        assert torch.allclose(output, ref_output, 1e-2, 1e-2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,48 @@
-from mlora.model.modules import LoRAFunction
+from mlora.model.modules import (
+    BatchLoRAFunction,
+    DoRA,
+    DoRAFunction,
+    FusedLoRAFunction,
+    Linear,
+    LinearGroup,
+    LoRA,
+    LoRABatchLayout,
+    LoRABucket,
+    LoRAFunction,
+    VeRA,
+    VeRAFunction,
+)
+from mlora.model.modules.lora import lora_dropout_mask
 from mlora.model.args import ModelData, ModelDataConfig
 
 import torch
 import unittest
 import torch.nn.functional as F
+from typing import List, Optional, Tuple
+
+
+def model_data(
+    segments: List[Tuple[int, int]], adapter_names: Optional[List[str]] = None
+) -> ModelData:
+    # the batch of the configs, the config idx has the rows segments[idx]
+    if adapter_names is None:
+        adapter_names = [""] * len(segments)
+    return ModelData(
+        batch_tokens_=[],
+        batch_mask_=[],
+        data_config_=[
+            ModelDataConfig(name, "lora", start, end)
+            for name, (start, end) in zip(adapter_names, segments)
+        ],
+        enable_checkpoint_=False,
+        random_id_=0,
+        task_name_=[""] * len(segments),
+    )
+
+
+def grad_tensor(tensor: torch.Tensor) -> torch.Tensor:
+    # the leaf copy of the test tensor to get its grad
+    return tensor.clone().detach().requires_grad_(True)
 
 
 class TestLoraFunction(unittest.TestCase):
@@ -13,12 +52,11 @@ class TestLoraFunction(unittest.TestCase):
     weight = torch.randn(2, 4, 32, dtype=torch.float)
 
     def set_test_tensor(self):
-        lora_a = self.lora_a.clone().detach().requires_grad_(True)
-        lora_b = self.lora_b.clone().detach().requires_grad_(True)
-        data = self.data.clone().detach().requires_grad_(True)
-        weight = self.weight.clone().detach().requires_grad_(False)
+        lora_a = grad_tensor(self.lora_a)
+        lora_b = grad_tensor(self.lora_b)
+        data = grad_tensor(self.data)
 
-        return lora_a, lora_b, data, weight
+        return lora_a, lora_b, data, self.weight.clone()
 
     def lora_pytorch(self):
         lora_a, lora_b, in_data, weight = self.set_test_tensor()
@@ -38,17 +76,9 @@ class TestLoraFunction(unittest.TestCase):
 
     def lora_mlora(self):
         lora_a, lora_b, in_data, weight = self.set_test_tensor()
-        input_args = ModelData(
-            batch_tokens_=[],
-            batch_mask_=[],
-            data_config_=[ModelDataConfig("", "", 0, 2)],
-            enable_checkpoint_=False,
-            random_id_=0,
-            task_name_=[""],
-        )
 
         weight = LoRAFunction.apply(
-            weight, in_data, input_args, [1e-4], [2.0], lora_a, lora_b
+            weight, in_data, model_data([(0, 2)]), [1e-4], [2.0], [None], lora_a, lora_b
         )
 
         loss = weight.sum()
@@ -68,5 +98,490 @@ class TestLoraFunction(unittest.TestCase):
         assert torch.allclose(self.py_grad_a, self.mlora_grad_a, 1e-4)
 
 
+class TestLoraDropoutSeed(unittest.TestCase):
+    lora_a = torch.randn(8, 32, dtype=torch.float)
+    lora_b = torch.randn(32, 8, dtype=torch.float)
+    data = torch.randn(2, 4, 32, dtype=torch.float)
+    weight = torch.randn(2, 4, 32, dtype=torch.float)
+
+    def lora_grads(self, dropout, seed):
+        lora_a = grad_tensor(self.lora_a)
+        lora_b = grad_tensor(self.lora_b)
+        in_data = grad_tensor(self.data)
+
+        if seed is None:
+            # the pytorch reference use the mask regenerated from the seed
+            keep_mask = lora_dropout_mask(in_data, dropout, 42)
+            data = in_data * keep_mask / (1 - dropout)
+            data = data @ lora_a.transpose(0, 1)
+            data = data @ lora_b.transpose(0, 1)
+            output = self.weight + data * 2.0
+        else:
+            output = LoRAFunction.apply(
+                self.weight.clone(),
+                in_data,
+                model_data([(0, 2)]),
+                [dropout],
+                [2.0],
+                [seed],
+                lora_a,
+                lora_b,
+            )
+
+        output.sum().backward()
+        return output.detach(), lora_a.grad, lora_b.grad, in_data.grad
+
+    def test_dropout_seed(self):
+        # the grads are exact when the mask is regenerated from the seed
+        for dropout in [0.0, 0.5]:
+            py_results = self.lora_grads(dropout, None)
+            results = self.lora_grads(dropout, 42)
+            for py_result, result in zip(py_results, results):
+                assert torch.allclose(py_result, result, 1e-4, 1e-4)
+
+
+class TestBatchLoraFunction(unittest.TestCase):
+    lora_a = torch.randn(3, 8, 32, dtype=torch.float)
+    lora_b = torch.randn(3, 32, 8, dtype=torch.float)
+    data = torch.randn(5, 4, 32, dtype=torch.float)
+    weight = torch.randn(5, 4, 32, dtype=torch.float)
+    # the last adapter have less rows, so the layout need to be padded
+    segments = [(0, 2), (2, 4), (4, 5)]
+    scalings = [2.0, 1.0, 0.5]
+
+    def set_test_tensor(self):
+        lora_a = grad_tensor(self.lora_a)
+        lora_b = grad_tensor(self.lora_b)
+        data = grad_tensor(self.data)
+
+        return lora_a, lora_b, data, self.weight.clone()
+
+    def lora_pytorch(self):
+        lora_a, lora_b, in_data, weight = self.set_test_tensor()
+
+        outputs = []
+        for idx, (start, end) in enumerate(self.segments):
+            data = in_data[start:end] @ lora_a[idx].transpose(0, 1)
+            data = data @ lora_b[idx].transpose(0, 1)
+            outputs.append(weight[start:end] + data * self.scalings[idx])
+
+        loss = torch.cat(outputs).sum()
+        loss.backward()
+
+        return loss.item(), lora_a.grad, lora_b.grad, in_data.grad
+
+    def lora_mlora(self):
+        lora_a, lora_b, in_data, weight = self.set_test_tensor()
+        layout = LoRABatchLayout(model_data(self.segments).data_config_, in_data.device)
+
+        weight = BatchLoRAFunction.apply(
+            weight, in_data, layout, [0.0] * 3, self.scalings, None, lora_a, lora_b
+        )
+
+        loss = weight.sum()
+        loss.backward()
+
+        return loss.item(), lora_a.grad, lora_b.grad, in_data.grad
+
+    def test_batch_lora(self):
+        py_loss, py_grad_a, py_grad_b, py_grad_input = self.lora_pytorch()
+        loss, grad_a, grad_b, grad_input = self.lora_mlora()
+
+        assert abs(loss - py_loss) < 1e-3 * max(1.0, abs(py_loss))
+        assert torch.allclose(py_grad_input, grad_input, 1e-4, 1e-4)
+        assert torch.allclose(py_grad_b, grad_b, 1e-4, 1e-4)
+        assert torch.allclose(py_grad_a, grad_a, 1e-4, 1e-4)
+
+
+class TestBucketLoraFunction(unittest.TestCase):
+    # different rank adapters in the same bucket
+    ranks = [8, 6, 5]
+    data = torch.randn(6, 4, 32, dtype=torch.float)
+    weight = torch.randn(6, 4, 32, dtype=torch.float)
+    segments = [(0, 2), (2, 4), (4, 6)]
+
+    def create_adapters(self):
+        adapters = []
+        for idx, r in enumerate(self.ranks):
+            adapter = LoRA(f"lora_{idx}", 32, 32, r, 16, 0.0)
+            adapter.init_weight(torch.randn(r, 32), torch.randn(32, r))
+            adapters.append(adapter)
+        return adapters
+
+    def test_bucket_lora(self):
+        adapters = self.create_adapters()
+        in_data = grad_tensor(self.data)
+
+        outputs = []
+        for adapter, (start, end) in zip(adapters, self.segments):
+            data = in_data[start:end] @ adapter.lora_a_.transpose(0, 1)
+            data = data @ adapter.lora_b_.transpose(0, 1)
+            outputs.append(self.weight[start:end] + data * adapter.scaling_)
+        py_output = torch.cat(outputs)
+        py_output.sum().backward()
+
+        py_grads = [(item.lora_a_.grad, item.lora_b_.grad) for item in adapters]
+        py_grad_input = in_data.grad
+
+        in_data.grad = None
+        for adapter in adapters:
+            adapter.lora_a_.grad = None
+            adapter.lora_b_.grad = None
+
+        configs = model_data(self.segments).data_config_
+        bucket = LoRABucket(
+            8, [0, 1, 2], adapters, LoRABatchLayout(configs, in_data.device)
+        )
+        lora_a, lora_b = bucket.lora_weight()
+        weight = BatchLoRAFunction.apply(
+            self.weight.clone(),
+            in_data,
+            bucket.layout_,
+            bucket.dropouts_,
+            bucket.scalings_,
+            None,
+            lora_a,
+            lora_b,
+        )
+        weight.sum().backward()
+
+        assert torch.allclose(py_output, weight, 1e-4, 1e-4)
+        assert torch.allclose(py_grad_input, in_data.grad, 1e-4, 1e-4)
+        for adapter, (py_grad_a, py_grad_b) in zip(adapters, py_grads):
+            assert adapter.lora_a_.grad.shape == (adapter.r_, 32)
+            assert torch.allclose(py_grad_a, adapter.lora_a_.grad, 1e-4, 1e-4)
+            assert torch.allclose(py_grad_b, adapter.lora_b_.grad, 1e-4, 1e-4)
+
+    def test_linear_buckets(self):
+        linear = Linear(torch.nn.Linear(32, 32, bias=False))
+        adapters = self.create_adapters()
+        for adapter in adapters:
+            linear.load_adapter(adapter)
+
+        # the batches of the same adapters with different rows
+        for segments in [self.segments, [(0, 1), (1, 4), (4, 6)]]:
+            input_args = model_data(segments, ["lora_0", "lora_1", "lora_2"])
+            with torch.no_grad():
+                output = linear.forward(self.data, input_args)
+                outputs = []
+                for adapter, (start, end) in zip(adapters, segments):
+                    data = self.data[start:end] @ adapter.lora_a_.transpose(0, 1)
+                    data = data @ adapter.lora_b_.transpose(0, 1) * adapter.scaling_
+                    outputs.append(linear.weight_(self.data[start:end]) + data)
+
+            assert torch.allclose(torch.cat(outputs), output, 1e-4, 1e-4)
+            assert len(input_args.lora_layouts_) == 1
+
+        # the rank groups are cached by the adapters, not the rows
+        assert len(linear.lora_groups_) == 1
+
+
+class TestFusedLoraFunction(unittest.TestCase):
+    # the targets like q/k/v, the second adapter do not have the k target
+    out_dims = [32, 16, 16]
+    targets = [[0, 1, 2], [0, 2]]
+    data = torch.randn(4, 4, 32, dtype=torch.float)
+    weights = [torch.randn(4, 4, out_dim, dtype=torch.float) for out_dim in out_dims]
+    segments = [(0, 2), (2, 4)]
+
+    def create_adapters(self):
+        adapters = []
+        for idx, targets in enumerate(self.targets):
+            adapter_targets = [None] * len(self.out_dims)
+            for target in targets:
+                adapter = LoRA(f"lora_{idx}", 32, self.out_dims[target], 8, 16, 0.0)
+                adapter.init_weight(
+                    torch.randn(8, 32), torch.randn(self.out_dims[target], 8)
+                )
+                adapter_targets[target] = adapter
+            adapters.append(adapter_targets)
+        return adapters
+
+    def test_fused_lora(self):
+        adapters = self.create_adapters()
+        in_data = grad_tensor(self.data)
+
+        py_outputs = []
+        for target, weight in enumerate(self.weights):
+            outputs = []
+            for adapter_targets, (start, end) in zip(adapters, self.segments):
+                adapter = adapter_targets[target]
+                if adapter is None:
+                    outputs.append(weight[start:end])
+                    continue
+                data = in_data[start:end] @ adapter.lora_a_.transpose(0, 1)
+                data = data @ adapter.lora_b_.transpose(0, 1)
+                outputs.append(weight[start:end] + data * adapter.scaling_)
+            py_outputs.append(torch.cat(outputs))
+        sum(output.sum() for output in py_outputs).backward()
+
+        py_grad_input = in_data.grad
+        in_data.grad = None
+        py_grads = []
+        for adapter in sum(adapters, []):
+            if adapter is None:
+                continue
+            py_grads.append((adapter.lora_a_.grad, adapter.lora_b_.grad))
+            adapter.lora_a_.grad = None
+            adapter.lora_b_.grad = None
+
+        input_args = model_data(self.segments)
+        loras = ()
+        for adapter_targets in adapters:
+            targets = [item for item in adapter_targets if item is not None]
+            loras += (
+                torch.cat([item.lora_a_ for item in targets]),
+                *[None if item is None else item.lora_b_ for item in adapter_targets],
+            )
+        outputs = FusedLoRAFunction.apply(
+            in_data,
+            input_args,
+            [0.0, 0.0],
+            [2.0, 2.0],
+            [None, None],
+            3,
+            *[weight.clone() for weight in self.weights],
+            *loras,
+        )
+        sum(output.sum() for output in outputs).backward()
+
+        for py_output, output in zip(py_outputs, outputs):
+            assert torch.allclose(py_output, output, 1e-4, 1e-4)
+        assert torch.allclose(py_grad_input, in_data.grad, 1e-4, 1e-4)
+        grads = [
+            (adapter.lora_a_.grad, adapter.lora_b_.grad)
+            for adapter in sum(adapters, [])
+            if adapter is not None
+        ]
+        for (py_grad_a, py_grad_b), (grad_a, grad_b) in zip(py_grads, grads):
+            assert torch.allclose(py_grad_a, grad_a, 1e-4, 1e-4)
+            assert torch.allclose(py_grad_b, grad_b, 1e-4, 1e-4)
+
+
+class TestLoraComputeDtype(unittest.TestCase):
+    data = torch.randn(2, 4, 32, dtype=torch.float)
+
+    def create_linear(self, compute_dtype):
+        torch.manual_seed(42)
+        linear = Linear(torch.nn.Linear(32, 32, bias=False))
+        adapter = LoRA("lora", 32, 32, 8, 16, 0.0, compute_dtype)
+        adapter.init_weight(None, torch.randn(32, 8) * 0.1)
+        linear.load_adapter(adapter)
+        return linear, adapter
+
+    def forward_backward(self, linear, adapter):
+        in_data = grad_tensor(self.data)
+        output = linear.forward(in_data, model_data([(0, 2)], ["lora"]))
+        output.sum().backward()
+        return output, in_data.grad, adapter.lora_a_.grad, adapter.lora_b_.grad
+
+    def test_bf16(self):
+        results = self.forward_backward(*self.create_linear(torch.float32))
+        linear, adapter = self.create_linear(torch.bfloat16)
+        bf16_results = self.forward_backward(linear, adapter)
+        for result, bf16_result in zip(results, bf16_results):
+            assert torch.allclose(result, bf16_result, 5e-2, 5e-2)
+
+        # the master weights and their grads are fp32
+        for tensor in adapter.get_all_tensors():
+            assert tensor.dtype == torch.float32
+            assert tensor.grad.dtype == torch.float32
+
+        # the casted weights do not require grad in no_grad, the adapter is
+        #   still applied
+        with torch.no_grad():
+            output = linear.forward(self.data, model_data([(0, 2)], ["lora"]))
+        assert torch.allclose(bf16_results[0], output, 1e-6, 1e-6)
+
+
+class TestLinearGroup(unittest.TestCase):
+    # like the q/k/v, only the adapter without the dropout is fused, the
+    #   frozen weights can be fused too
+    out_dims = [32, 16, 16]
+    ranks = [4, 8]
+    dropouts = [0.5, 0.0]
+    data = torch.randn(4, 4, 32, dtype=torch.float)
+    segments = [(0, 2), (2, 4)]
+
+    def create_group(self):
+        linears = []
+        for out_dim in self.out_dims:
+            linear = Linear(torch.nn.Linear(32, out_dim))
+            for idx, (r, dropout) in enumerate(zip(self.ranks, self.dropouts)):
+                adapter = LoRA(f"lora_{idx}", 32, out_dim, r, 16, dropout)
+                adapter.init_weight(None, torch.randn(out_dim, r))
+                linear.load_adapter(adapter)
+            linears.append(linear)
+        return LinearGroup(linears)
+
+    def forward_backward(self, group, separate):
+        in_data = grad_tensor(self.data)
+        input_args = model_data(self.segments, ["lora_0", "lora_1"])
+
+        # the same dropout masks are drawn in the same order
+        torch.manual_seed(42)
+        if separate:
+            outputs = [linear.forward(in_data, input_args) for linear in group.linears_]
+        else:
+            outputs = group.forward(in_data, input_args)
+        sum(output.sum() for output in outputs).backward()
+
+        grads = [in_data.grad]
+        for linear in group.linears_:
+            for adapter in linear.adapters_.values():
+                grads += [adapter.lora_a_.grad, adapter.lora_b_.grad]
+                adapter.lora_a_.grad = None
+                adapter.lora_b_.grad = None
+        return outputs, grads
+
+    def check_close(self, lhs, rhs):
+        for lhs_tensors, rhs_tensors in zip(lhs, rhs):
+            assert len(lhs_tensors) == len(rhs_tensors)
+            for lhs_tensor, rhs_tensor in zip(lhs_tensors, rhs_tensors):
+                assert torch.allclose(lhs_tensor, rhs_tensor, 1e-4, 1e-4)
+
+    def test_dropout(self):
+        group = self.create_group()
+        self.check_close(
+            self.forward_backward(group, True), self.forward_backward(group, False)
+        )
+
+    def test_fuse_weight(self):
+        group = self.create_group()
+        unfused = self.forward_backward(group, False)
+        assert group.fuse_weight()
+        self.check_close(unfused, self.forward_backward(group, False))
+
+
+class TestVeraFunction(unittest.TestCase):
+    data = torch.randn(4, 4, 32, dtype=torch.float)
+    weight = torch.randn(4, 4, 32, dtype=torch.float)
+    segments = [(0, 2), (2, 4)]
+
+    def create_adapters(self):
+        adapters = []
+        for idx in range(len(self.segments)):
+            adapter = VeRA(f"vera_test_{idx}", "q_proj", 32, 32, 8, 16, 0.0, 0.1)
+            VeRA.init_lora_weight(f"vera_test_{idx}", "q_proj")
+            adapter.init_vec_weight(torch.randn(1, 32), torch.randn(1, 8))
+            adapter.enable_grad()
+            adapters.append(adapter)
+        return adapters
+
+    def test_vera(self):
+        adapters = self.create_adapters()
+        in_data = grad_tensor(self.data)
+
+        outputs = []
+        for adapter, (start, end) in zip(adapters, self.segments):
+            data = in_data[start:end] * adapter.scaling_
+            data = data @ adapter.lora_a_.transpose(0, 1) * adapter.d_vec_
+            data = data @ adapter.lora_b_.transpose(0, 1) * adapter.b_vec_
+            outputs.append(self.weight[start:end] + data)
+        py_output = torch.cat(outputs)
+        py_output.sum().backward()
+
+        py_grads = [(item.d_vec_.grad, item.b_vec_.grad) for item in adapters]
+        py_grad_input = in_data.grad
+
+        in_data.grad = None
+        veras = ()
+        for adapter in adapters:
+            adapter.d_vec_.grad = None
+            adapter.b_vec_.grad = None
+            veras += (adapter.lora_a_, adapter.lora_b_, adapter.d_vec_, adapter.b_vec_)
+
+        input_args = model_data(self.segments)
+        output = VeRAFunction.apply(
+            self.weight.clone(),
+            in_data,
+            input_args,
+            [adapter.dropout_ for adapter in adapters],
+            [adapter.scaling_ for adapter in adapters],
+            *veras,
+        )
+        output.sum().backward()
+
+        assert torch.allclose(py_output, output, 1e-4, 1e-4)
+        assert torch.allclose(py_grad_input, in_data.grad, 1e-4, 1e-4)
+        for adapter, (py_grad_d, py_grad_b) in zip(adapters, py_grads):
+            assert torch.allclose(py_grad_d, adapter.d_vec_.grad, 1e-4, 1e-4)
+            assert torch.allclose(py_grad_b, adapter.b_vec_.grad, 1e-4, 1e-4)
+
+
+class TestDoraFunction(unittest.TestCase):
+    data = torch.randn(4, 4, 32, dtype=torch.float)
+    segments = [(0, 2), (2, 4)]
+
+    def create_adapters(self, dropout):
+        adapters = []
+        base_weight = torch.nn.Linear(32, 32, bias=False)
+        for idx in range(len(self.segments)):
+            adapter = DoRA(f"dora_test_{idx}", 32, 32, 8, 16, dropout, base_weight)
+            adapter.init_weight(None, torch.randn(32, 8))
+            # make the magnitude differ from the weight norm
+            adapter.magnitude_.mul_(torch.rand(1, 32) + 0.5)
+            adapter.enable_grad()
+            adapters.append(adapter)
+        return adapters
+
+    def check_dora(self, dropout):
+        adapters = self.create_adapters(dropout)
+        in_data = grad_tensor(self.data)
+        weight = torch.randn(4, 4, 32, dtype=torch.float, requires_grad=True)
+        # the dora always regenerates the dropout mask, so the grad is exact
+        seeds = [adapter.dropout_seed() for adapter in adapters]
+
+        outputs = []
+        for adapter, seed, (start, end) in zip(adapters, seeds, self.segments):
+            scale = (adapter.magnitude_ / adapter.get_weight_norm()).view(1, -1)
+            data = in_data[start:end]
+            if dropout > 0.0:
+                data = data * lora_dropout_mask(data, dropout, seed) / (1 - dropout)
+            data = data @ adapter.lora_a_.transpose(0, 1)
+            data = data @ adapter.lora_b_.transpose(0, 1) * adapter.scaling_
+            outputs.append(weight[start:end] * (scale - 1) + scale * data)
+        py_output = torch.cat(outputs)
+        py_output.sum().backward()
+
+        py_grads = [(item.lora_a_.grad, item.lora_b_.grad) for item in adapters]
+        py_grad_input = in_data.grad
+        py_grad_weight = weight.grad
+
+        in_data.grad = None
+        weight.grad = None
+        doras = ()
+        for adapter in adapters:
+            adapter.lora_a_.grad = None
+            adapter.lora_b_.grad = None
+            scale = (adapter.magnitude_ / adapter.get_weight_norm()).view(1, -1)
+            doras += (adapter.lora_a_, adapter.lora_b_, scale)
+
+        input_args = model_data(self.segments)
+        output = DoRAFunction.apply(
+            weight.clone(),
+            in_data,
+            input_args,
+            [adapter.dropout_ for adapter in adapters],
+            [adapter.scaling_ for adapter in adapters],
+            seeds,
+            *doras,
+        )
+        output.sum().backward()
+
+        assert torch.allclose(py_output, output, 1e-4, 1e-4)
+        assert torch.allclose(py_grad_input, in_data.grad, 1e-4, 1e-4)
+        assert torch.allclose(py_grad_weight, weight.grad, 1e-4, 1e-4)
+        for adapter, (py_grad_a, py_grad_b) in zip(adapters, py_grads):
+            assert torch.allclose(py_grad_a, adapter.lora_a_.grad, 1e-4, 1e-4)
+            assert torch.allclose(py_grad_b, adapter.lora_b_.grad, 1e-4, 1e-4)
+
+    def test_dora(self):
+        self.check_dora(0.0)
+
+    def test_dora_dropout(self):
+        self.check_dora(0.5)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,114 @@
+from mlora.model.args import MLoRAData, MLoRADataConfig
+from mlora.model.modules import LMHeadCrossEntropyFunction, LMHeadLogProbFunction
+import mlora.model.modules.output_layer as output_layer
+
+import torch
+import torch.nn.functional as F
+import unittest
+
+
+class TestLMHeadFunction(unittest.TestCase):
+    def setUp(self):
+        # small chunk size, so the tokens are split into several chunks
+        self.chunk_size_ = output_layer.LM_HEAD_CHUNK_SIZE
+        output_layer.LM_HEAD_CHUNK_SIZE = 5
+
+        self.weight_ = torch.randn(64, 16)
+        self.data_ = torch.randn(23, 16)
+        self.target_ = torch.randint(0, 64, (23,))
+
+    def tearDown(self):
+        output_layer.LM_HEAD_CHUNK_SIZE = self.chunk_size_
+
+    def test_cross_entropy(self):
+        self.target_[3] = -100
+
+        ref_data = self.data_.clone().requires_grad_(True)
+        ref_loss = F.cross_entropy(F.linear(ref_data, self.weight_), self.target_)
+        (ref_loss * 2).backward()
+
+        data = self.data_.clone().requires_grad_(True)
+        loss = LMHeadCrossEntropyFunction.apply(data, self.weight_, self.target_)
+        (loss * 2).backward()
+
+        assert torch.allclose(ref_loss, loss, 1e-5, 1e-5)
+        assert torch.allclose(ref_data.grad, data.grad, 1e-5, 1e-5)
+
+    def test_log_prob(self):
+        grad_output = torch.randn(23)
+
+        ref_data = self.data_.clone().requires_grad_(True)
+        ref_log_prob = (
+            F.linear(ref_data, self.weight_)
+            .log_softmax(-1)
+            .gather(-1, self.target_.unsqueeze(-1))
+            .squeeze(-1)
+        )
+        ref_log_prob.backward(grad_output)
+
+        data = self.data_.clone().requires_grad_(True)
+        log_prob = LMHeadLogProbFunction.apply(data, self.weight_, self.target_)
+        log_prob.backward(grad_output)
+
+        assert torch.allclose(ref_log_prob, log_prob, 1e-5, 1e-5)
+        assert torch.allclose(ref_data.grad, data.grad, 1e-5, 1e-5)
+
+
+class TestOutputPositions(unittest.TestCase):
+    def test_config_output(self):
+        configs = [
+            MLoRADataConfig("a", "lora", 0, 2, None, None, "a", None, [1, -1]),
+            MLoRADataConfig("b", "lora", 2, 3, None, None, "b", None, [0]),
+        ]
+        data = MLoRAData([[0] * 4] * 3, [[False] * 4] * 3, configs)
+        logits = torch.randn(3, 4, 8)
+
+        index = data.model_data().output_index(4)
+        assert index == [1, 3, 5, 7, 8]
+
+        outputs = data.config_output(logits.flatten(0, 1)[index])
+        assert torch.equal(outputs[0], logits[0:2, [1, 3]])
+        assert torch.equal(outputs[1], logits[2:3, [0]])
+
+        # one config needs all the positions, so no positions are selected,
+        #   the other config still gets its positions
+        configs[1].output_positions_ = None
+        assert data.model_data().output_index(4) is None
+        outputs = data.config_output(logits)
+        assert torch.equal(outputs[0], logits[0:2, [1, 3]])
+        assert torch.equal(outputs[1], logits)
+
+    def test_split_grad(self):
+        configs = [
+            MLoRADataConfig("a", "lora", 0, 2, None, None, "a", None, [1, -1]),
+            MLoRADataConfig("b", "lora", 2, 3, None, None, "b", requires_grad=False),
+            MLoRADataConfig("c", "lora", 3, 4, None, None, "c", None, [0]),
+        ]
+        tokens = [[idx] * 4 for idx in range(4)]
+        data = MLoRAData(tokens, [[False] * 4] * 4, configs)
+        logits = torch.randn(4, 4, 8)
+
+        grad_data = data.split_grad(True)
+        no_grad_data = data.split_grad(False)
+        assert grad_data.batch_tokens_ == tokens[0:2] + tokens[3:4]
+        assert no_grad_data.batch_tokens_ == tokens[2:3]
+        assert not no_grad_data.model_data().enable_checkpoint_
+        # the config b needs all the positions, so the split batches do too
+        assert grad_data.model_data().output_index(4) is None
+
+        output = data.merge_output(logits[[0, 1, 3]], logits[[2]])
+        assert torch.equal(output, logits)
+
+        # all the configs declare the positions, the output is compact
+        configs[1].output_positions_ = [2]
+        index = data.model_data().output_index(4)
+        grad_index = data.split_grad(True).model_data().output_index(4)
+        no_grad_index = data.split_grad(False).model_data().output_index(4)
+        grad_output = logits[[0, 1, 3]].flatten(0, 1)[grad_index]
+        no_grad_output = logits[[2]].flatten(0, 1)[no_grad_index]
+        output = data.merge_output(grad_output, no_grad_output)
+        assert torch.equal(output, logits.flatten(0, 1)[index])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+from mlora.executor.task.train_task import (
+    IGNORE_INDEX,
+    TokenPacker,
+    TrainTask,
+    packed_last_index,
+    packed_target,
+)
+from mlora.model.args import packed_positions
+
+import torch
+import unittest
+from types import SimpleNamespace
+
+
+class TestPacking(unittest.TestCase):
+    def test_token_packer(self):
+        packer = TokenPacker(2, 8)
+        for tokens in [[1] * 3, [2] * 4, [3] * 2, [4] * 7]:
+            if not packer.fit(tokens):
+                break
+            packer.add(tokens)
+
+        # the last sample do not fit the two rows
+        assert packer.rows_ == [[1] * 3 + [2] * 4, [3] * 2]
+        assert packer.doc_lens_ == [[3, 4], [2]]
+        assert packer.fit([4] * 6)
+
+    def test_packed_positions(self):
+        masks = [False] * 5 + [True] * 2
+        assert packed_positions([2, 3], masks) == [0, 1, 0, 1, 2, 0, 1]
+        masks = [True] * 2 + [False] * 5
+        assert packed_positions([2, 3], masks) == [0, 1, 0, 1, 0, 1, 2]
+
+    def test_packed_target(self):
+        target = torch.arange(7).view(1, 7)
+        mask = torch.tensor([[True, False, False, False, False, False, False]])
+        doc_lens = [[2, 4]]
+
+        ignore = IGNORE_INDEX
+        packed = packed_target(target, mask, doc_lens)
+        assert packed.tolist() == [[ignore, ignore, 2, ignore, 4, 5, 6]]
+        assert packed_last_index(mask, doc_lens) == ([0, 0], [2, 6])
+
+    def test_pack_data(self):
+        # the task without the context, the sample i is encoded to i tokens
+        task = TrainTask.__new__(TrainTask)
+        task.config_ = SimpleNamespace(mini_batch_size_=1, cutoff_len_=8)
+        task.data_ = [{}] * 6
+        task.now_data_idx_ = 1
+        task.pack_overflow_ = None
+
+        encoded = []
+
+        def encode_data(data_idx_s: int, data_idx_e: int):
+            encoded.append(data_idx_s)
+            return [[data_idx_s] * data_idx_s]
+
+        task._encode_data = encode_data
+
+        (packer,) = task._pack_data(1)
+        assert packer.rows_ == [[1, 2, 2, 3, 3, 3]]
+        assert task.step_data_num_ == 3
+
+        # the sample 4 do not fit the last step, it is encoded only once
+        task.now_data_idx_ += task.step_data_num_
+        (packer,) = task._pack_data(1)
+        assert packer.rows_ == [[4] * 4]
+        assert encoded == [1, 2, 3, 4, 5]
+
+
+if __name__ == "__main__":
+    unittest.main()
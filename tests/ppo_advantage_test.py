@@ -0,0 +1,45 @@
+from mlora.executor.task.ppo_task import discounted_cumsum, normalize, ppo_advantage
+
+import torch
+import unittest
+
+
+def loop_advantage(r, v_, gamma, lamdb, eps):
+    # the advantage of the PPOTask before it is vectorized
+    deltas = torch.zeros_like(v_)
+    for j in range(1, len(deltas[0])):
+        deltas[:, j - 1] = r[:, j - 1] + gamma * v_[:, j] - v_[:, j - 1]
+
+    advantage = torch.zeros_like(v_)
+    for j in range(len(advantage[0]) - 2, -1, -1):
+        advantage[:, j] = deltas[:, j] + gamma * lamdb * advantage[:, j + 1]
+    advantage = normalize(advantage, eps)
+
+    advantage = torch.flip(advantage, [-1])
+    advantage = advantage[:, 0:-1]
+    v_ = v_[:, 0:-1]
+    td_target = advantage + v_
+    return advantage, td_target
+
+
+class TestPPOAdvantage(unittest.TestCase):
+    def test_discounted_cumsum(self):
+        data = torch.tensor([[1.0, 2.0, 3.0]])
+        out = discounted_cumsum(data, 0.5)
+        assert torch.allclose(out, torch.tensor([[1.0 + 1.0 + 0.75, 2.0 + 1.5, 3.0]]))
+
+    def test_advantage(self):
+        r = torch.randn(4, 16)
+        v_ = torch.randn(4, 17)
+        v_[:, -1] = 0
+
+        for gamma, lamdb in [(0.99, 0.95), (1.0, 1.0), (0.9, 0.0)]:
+            ref_advantage, ref_td_target = loop_advantage(r, v_, gamma, lamdb, 1e-6)
+            advantage, td_target = ppo_advantage(r, v_, gamma, lamdb, 1e-6)
+
+            assert torch.allclose(ref_advantage, advantage, 1e-5, 1e-5)
+            assert torch.allclose(ref_td_target, td_target, 1e-5, 1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
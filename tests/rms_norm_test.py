@@ -0,0 +1,36 @@
+from mlora.model.modules import RMSNorm
+
+import torch
+import unittest
+
+
+class TestRMSNormFunction(unittest.TestCase):
+    def check_rms_norm(self, dtype: torch.dtype, atol: float):
+        weight = torch.randn(32, dtype=dtype, requires_grad=True)
+        data = torch.randn(4, 8, 32, dtype=dtype)
+        grad_output = torch.randn(4, 8, 32, dtype=dtype)
+
+        outputs = []
+        grads = []
+        for fused in [False, True]:
+            weight.grad = None
+            in_data = data.clone().requires_grad_(True)
+            output = RMSNorm(weight, 1e-6, fused).forward(in_data)
+            output.backward(grad_output)
+            outputs.append(output)
+            grads.append((in_data.grad, weight.grad))
+
+        assert outputs[0].dtype == outputs[1].dtype
+        assert torch.allclose(outputs[0], outputs[1], atol, atol)
+        for py_grad, grad in zip(grads[0], grads[1]):
+            assert torch.allclose(py_grad, grad, atol, atol)
+
+    def test_fp32(self):
+        self.check_rms_norm(torch.float32, 1e-5)
+
+    def test_bf16(self):
+        self.check_rms_norm(torch.bfloat16, 5e-2)
+
+
+if __name__ == "__main__":
+    unittest.main()